@@ -0,0 +1,58 @@
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from napari_covid_if_annotations.io_utils import COMPRESSIONS, hdf5plugin, read_image, write_image
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+
+def time_function(function, n_repeats=5):
+    times = []
+    for _ in range(n_repeats):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return np.min(times)
+
+
+def bench_compression(shape, n_cells, compressions, chunks, n_repeats):
+    seg = make_segmentation(shape, n_cells)
+    print("Segmentation with shape", shape, "and", n_cells, "cells, chunks", chunks)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for compression in compressions:
+            if compression.split(':')[0] in ('blosc', 'zstd') and hdf5plugin is None:
+                print(f"{compression:>8}: skipped, hdf5plugin is not installed")
+                continue
+            path = os.path.join(tmp_dir, 'seg.h5')
+
+            def write():
+                with h5py.File(path, 'w') as f:
+                    write_image(f, 'seg', seg, compression=compression, chunks=chunks)
+
+            def read():
+                with h5py.File(path, 'r') as f:
+                    return read_image(f, 'seg')
+
+            t_write = time_function(write, n_repeats)
+            t_read = time_function(read, n_repeats)
+            assert np.array_equal(read(), seg)
+            size = os.path.getsize(path)
+            print(f"{compression:>8}: write {t_write:.4f} s, read {t_read:.4f} s,",
+                  f"size {size / 1e6:.2f} MB, ratio {seg.nbytes / size:.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=2, default=[2048, 2048])
+    parser.add_argument('--n_cells', type=int, default=5000)
+    parser.add_argument('--compressions', type=str, nargs='+',
+                        default=['none', 'lzf', 'gzip:1', 'gzip:4', 'gzip:9', 'blosc', 'zstd'],
+                        help=f"compressions to compare, one of {COMPRESSIONS} with optional level")
+    parser.add_argument('--chunks', type=int, nargs=2, default=[256, 256])
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+    bench_compression(tuple(args.shape), args.n_cells, args.compressions, tuple(args.chunks), args.n_repeats)
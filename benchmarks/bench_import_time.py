@@ -0,0 +1,45 @@
+import argparse
+import subprocess
+import sys
+
+import numpy as np
+
+MODULES = [
+    'napari_covid_if_annotations',
+    'napari_covid_if_annotations.io_utils',
+    'napari_covid_if_annotations.layers',
+    'napari_covid_if_annotations.validation',
+    'napari_covid_if_annotations.launcher',
+]
+HEAVY_MODULES = ['napari', 'vispy', 'qtpy', 'dask', 'scipy', 'skimage', 'zarr', 'pandas']
+
+
+def measure_import(module):
+    """ Measure the import time of the module (in a new interpreter) in seconds
+    and return the heavy modules it imports.
+    """
+    code = f"import sys; import {module}; print(' '.join(m for m in {HEAVY_MODULES} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    # the last line of the importtime output contains the cumulative time of the module in us
+    lines = [line for line in result.stderr.split('\n') if line.startswith('import time:')]
+    module_line = [line for line in lines if line.split('|')[-1].strip() == module][-1]
+    return int(module_line.split('|')[1]) / 1e6, result.stdout.strip()
+
+
+def bench_import_time(modules, n_repeats):
+    for module in modules:
+        try:
+            times, imported = zip(*[measure_import(module) for _ in range(n_repeats)])
+        except subprocess.CalledProcessError as e:
+            print(f"{module}: import failed with {e.stderr.strip().split(chr(10))[-1]}")
+            continue
+        print(f"{module}: {np.min(times):.3f} s, imports: {imported[0] or '-'}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, nargs='+', default=MODULES)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+    bench_import_time(args.modules, args.n_repeats)
@@ -0,0 +1,53 @@
+import argparse
+import time
+
+import numpy as np
+
+from napari_covid_if_annotations.image_utils import get_edge_segmentation, map_labels_to_edges
+from napari_covid_if_annotations._tests.utils import make_segmentation, map_labels_to_edges_with_dict
+
+
+def time_function(function, *args, n_repeats=5):
+    times = []
+    for _ in range(n_repeats):
+        t0 = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - t0)
+    return np.min(times), result
+
+
+def bench_label_remap(shape, cell_counts, n_repeats):
+    print("Image shape:", shape)
+    for n_cells in cell_counts:
+        seg = make_segmentation(shape, n_cells)
+        edges = get_edge_segmentation(seg, 2)
+        seg_ids = np.unique(seg)
+        labels = np.random.randint(0, 4, size=len(seg_ids)).astype('int32')
+        labels[0] = 0
+        hide_ids = seg_ids[labels > 0]
+
+        t_dict, expected = time_function(map_labels_to_edges_with_dict, edges, seg_ids,
+                                         labels, hide_ids, 4, n_repeats=n_repeats)
+        t_lut, result = time_function(map_labels_to_edges, edges, seg_ids,
+                                      labels, hide_ids, 4, n_repeats=n_repeats)
+        assert np.array_equal(expected, result)
+
+        # large ids to measure the sparse mapping
+        sparse_edges = edges.astype('uint64')
+        sparse_edges[sparse_edges > 0] += 2 ** 40
+        sparse_ids = seg_ids.astype('uint64')
+        sparse_ids[1:] += 2 ** 40
+        t_sparse, _ = time_function(map_labels_to_edges, sparse_edges, sparse_ids,
+                                    labels, sparse_ids[labels > 0], 4, n_repeats=n_repeats)
+
+        print(f"{n_cells:6d} cells: dict {t_dict:.4f} s, lut {t_lut:.4f} s, searchsorted {t_sparse:.4f} s,",
+              f"speed-up {t_dict / t_lut:.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=2, default=[2048, 2048])
+    parser.add_argument('--cell_counts', type=int, nargs='+', default=[1000, 5000, 20000, 50000])
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+    bench_label_remap(tuple(args.shape), args.cell_counts, args.n_repeats)
@@ -0,0 +1,187 @@
+"""
+Benchmarks for the annotation hot paths, based on pytest-benchmark.
+
+Run them with
+    pytest benchmarks/bench_suite.py --benchmark-autosave
+and compare with a previous run to catch regressions, e.g.
+    pytest benchmarks/bench_suite.py --benchmark-compare --benchmark-compare-fail=min:20%
+
+The data is a synthetic plate-sized image with a segmentation. The image shape and cell counts
+can be set via the environment variables COVID_IF_BENCH_SHAPE and COVID_IF_BENCH_CELLS, e.g.
+    COVID_IF_BENCH_SHAPE=2048,2048 COVID_IF_BENCH_CELLS=1000,20000 pytest benchmarks/bench_suite.py
+The peak memory of each benchmarked function is measured with tracemalloc
+and reported as 'peak_memory_mb' in the extra info of the benchmark (see --benchmark-json).
+"""
+import os
+import tracemalloc
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+
+from napari_covid_if_annotations.annotation_state import AnnotationState
+from napari_covid_if_annotations.image_utils import get_edge_segmentation, get_seg_ids, map_labels_to_edges
+from napari_covid_if_annotations.incremental import DirtyRegions, get_brush_bounding_box
+from napari_covid_if_annotations.io_utils import read_table, write_image, write_table
+from napari_covid_if_annotations.layers import get_layers_from_file, get_segmentation_data, save_labels
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+SHAPE = tuple(int(sh) for sh in os.environ.get('COVID_IF_BENCH_SHAPE', '2048,2048').split(','))
+CELL_COUNTS = [int(n) for n in os.environ.get('COVID_IF_BENCH_CELLS', '1000,5000').split(',')]
+EDGE_WIDTH = 2
+BRUSH_SIZE = 10
+
+
+def record_peak_memory(benchmark, function, *args):
+    """ Run the function once and record the peak memory allocated during the call.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info['peak_memory_mb'] = peak / 1024 ** 2
+
+
+def run_benchmark(benchmark, function, *args):
+    record_peak_memory(benchmark, function, *args)
+    return benchmark(function, *args)
+
+
+def make_labels(seg_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 4, size=len(seg_ids)).astype('int32')
+    labels[0] = 0
+    return labels
+
+
+@pytest.fixture(scope='module', params=CELL_COUNTS, ids=lambda n_cells: f'{n_cells}-cells')
+def plate(request, tmp_path_factory):
+    """ Write a file with the raw data channels, segmentation and infected labels.
+    """
+    n_cells = request.param
+    path = str(tmp_path_factory.mktemp('data') / f'plate_{n_cells}.h5')
+    rng = np.random.default_rng(0)
+    seg = make_segmentation(SHAPE, n_cells)
+    seg_ids = get_seg_ids(seg)
+    labels = make_labels(seg_ids)
+    with h5py.File(path, 'w') as f:
+        for name in ('serum_IgG', 'marker', 'nuclei'):
+            write_image(f, name, rng.integers(0, 1000, size=SHAPE).astype('uint16'))
+        write_image(f, 'cell_segmentation', seg)
+        write_table(f, 'infected_cell_labels', ['label_id', 'infected_label'], [seg_ids, labels])
+    return SimpleNamespace(path=path, seg=seg, seg_ids=seg_ids, labels=labels, n_cells=n_cells)
+
+
+def test_get_layers_from_file(benchmark, plate):
+    def _load():
+        with h5py.File(plate.path, 'r') as f:
+            return get_layers_from_file(f, edge_width=EDGE_WIDTH, use_cache=False)
+    layers = run_benchmark(benchmark, _load)
+    assert len(layers) == 5
+
+
+def test_get_segmentation_data(benchmark, plate):
+    def _get_data():
+        with h5py.File(plate.path, 'r') as f:
+            return get_segmentation_data(f, plate.seg, EDGE_WIDTH)
+    seg_ids, _, _, infected_labels = run_benchmark(benchmark, _get_data)
+    np.testing.assert_array_equal(seg_ids, plate.seg_ids)
+    np.testing.assert_array_equal(infected_labels, plate.labels)
+
+
+def _paint_strokes(seg, n_strokes, seed=0):
+    """ Paint square brush strokes with new labels and record the dirty regions.
+    """
+    rng = np.random.default_rng(seed)
+    dirty_regions = DirtyRegions()
+    next_label = seg.max() + 1
+    for center in rng.integers(BRUSH_SIZE, np.array(seg.shape) - BRUSH_SIZE, size=(n_strokes, seg.ndim)):
+        bb = get_brush_bounding_box(center, BRUSH_SIZE, seg.shape)
+        seg[bb] = next_label
+        next_label += 1
+        dirty_regions.add(bb)
+    return dirty_regions
+
+
+@pytest.mark.parametrize('n_strokes', [1, 10])
+def test_update_layers_core(benchmark, plate, n_strokes):
+    """ The part of update_layers that does not depend on the viewer: update the annotation state
+    after painting and remap the edges in the updated regions.
+    """
+    def _setup():
+        state = AnnotationState(plate.seg.copy(), EDGE_WIDTH, plate.seg_ids, plate.labels.copy())
+        infected_edges, _ = state.map_edges()
+        dirty_regions = _paint_strokes(state.seg, n_strokes)
+        return (state, dirty_regions, infected_edges), {}
+
+    def _update(state, dirty_regions, infected_edges):
+        updated_regions = state.update(dirty_regions)
+        state.get_centroid_properties()
+        state.map_edges(infected_edges, updated_regions)
+        return state.seg_ids
+
+    record_peak_memory(benchmark, _update, *_setup()[0])
+    seg_ids = benchmark.pedantic(_update, setup=_setup, rounds=10)
+    assert len(seg_ids) == len(plate.seg_ids) + n_strokes
+
+
+@pytest.mark.parametrize('from_state', [False, True], ids=['seg-max', 'state'])
+def test_next_label(benchmark, plate, from_state):
+    """ Get the label for painting a new segment, which is done for each press of 'n'.
+    """
+    state = AnnotationState(plate.seg, EDGE_WIDTH, plate.seg_ids, plate.labels)
+    next_label = state.next_label if from_state else (lambda: plate.seg.max() + 1)
+    assert run_benchmark(benchmark, next_label) == plate.seg_ids[-1] + 1
+
+
+@pytest.mark.parametrize('hide', [False, True], ids=['visible', 'hidden'])
+def test_map_labels_to_edges(benchmark, plate, hide):
+    edges = get_edge_segmentation(plate.seg, EDGE_WIDTH)
+    hide_ids = plate.seg_ids[plate.labels > 0] if hide else None
+    result = run_benchmark(benchmark, map_labels_to_edges, edges, plate.seg_ids, plate.labels, hide_ids, 4)
+    assert result.shape == plate.seg.shape
+
+
+@pytest.mark.parametrize('changed', [False, True], ids=['unchanged', 'painted'])
+def test_save_labels(benchmark, plate, tmp_path, changed):
+    """ Save the labels to a file that already has the annotations, like for repeated saves.
+    """
+    filename = str(tmp_path / 'plate.h5')
+    save_path = str(tmp_path / 'plate_annotations.h5')
+    layer = SimpleNamespace(data=plate.seg.copy(), metadata={'filename': filename, 'seg_ids': plate.seg_ids,
+                                                            'infected_labels': plate.labels})
+    layers = [(layer, {}, 'labels')]
+    save_labels(layers)
+    if changed:
+        _paint_strokes(layer.data, 10)
+
+    # we alternate between the two states, so that each save writes the changed chunks
+    states = [plate.seg, layer.data.copy()]
+
+    def _save():
+        layer.data = states.pop()
+        states.insert(0, layer.data)
+        return save_labels(layers)
+
+    assert run_benchmark(benchmark, _save) == [save_path]
+
+
+def test_write_table(benchmark, plate, tmp_path):
+    path = str(tmp_path / 'table.h5')
+    columns = [plate.seg_ids, plate.labels]
+
+    def _write():
+        with h5py.File(path, 'a') as f:
+            write_table(f, 'infected_cell_labels', ['label_id', 'infected_label'], columns, force_write=True)
+    run_benchmark(benchmark, _write)
+
+
+def test_read_table(benchmark, plate):
+    def _read():
+        with h5py.File(plate.path, 'r') as f:
+            return read_table(f, 'infected_cell_labels')
+    _, table = run_benchmark(benchmark, _read)
+    assert table.shape == (len(plate.seg_ids), 2)
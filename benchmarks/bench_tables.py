@@ -0,0 +1,96 @@
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from napari_covid_if_annotations.io_utils import read_table, write_table
+
+
+# the previous implementation, which casts all values to strings
+def write_table_as_strings(f, name, column_names, table, table_string_type='S100'):
+    g = f.require_group('tables/%s' % name)
+    g.create_dataset('cells', data=table.astype(table_string_type), compression='gzip')
+    g.create_dataset('columns', data=np.array(column_names, dtype=table_string_type), compression='gzip')
+    g.create_dataset('visible', data=np.ones(len(column_names), dtype='uint8'), compression='gzip')
+
+
+def read_table_from_strings(f, name, table_string_type='U100'):
+    g = f['tables/%s' % name]
+    table = g['cells'][:]
+    column_names = [col_name.decode('utf-8') for col_name in g['columns'][:]]
+
+    def _col_dtype(column):
+        try:
+            column.astype('int')
+            return 'int'
+        except ValueError:
+            pass
+        try:
+            column.astype('float')
+            return 'float'
+        except ValueError:
+            pass
+        return table_string_type
+
+    dtypes = [_col_dtype(col) for col in table.T]
+    columns = [col.astype(dtype) for col, dtype in zip(table.T, dtypes)]
+    n_rows = table.shape[0]
+    table = [[col[row] for col in columns] for row in range(n_rows)]
+    return column_names, pd.DataFrame(table).values
+
+
+def time_function(function, *args, n_repeats=5):
+    times = []
+    for _ in range(n_repeats):
+        t0 = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - t0)
+    return np.min(times)
+
+
+def bench_tables(row_counts, n_repeats):
+    column_names = ['label_id', 'infected_label']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_rows in row_counts:
+            seg_ids = np.arange(n_rows, dtype='uint32')
+            labels = np.random.randint(0, 4, size=n_rows).astype('int32')
+            table = np.stack([seg_ids, labels], axis=1)
+
+            old_path = os.path.join(tmp_dir, f'old-{n_rows}.h5')
+            new_path = os.path.join(tmp_dir, f'new-{n_rows}.h5')
+
+            def write_old():
+                with h5py.File(old_path, 'w') as f:
+                    write_table_as_strings(f, 'labels', column_names, table)
+
+            def write_new():
+                with h5py.File(new_path, 'w') as f:
+                    write_table(f, 'labels', column_names, [seg_ids, labels])
+
+            def read(path, read_function):
+                with h5py.File(path, 'r') as f:
+                    return read_function(f, 'labels')[1]
+
+            t_write_old = time_function(write_old, n_repeats=n_repeats)
+            t_write_new = time_function(write_new, n_repeats=n_repeats)
+            t_read_old = time_function(read, old_path, read_table_from_strings, n_repeats=n_repeats)
+            t_read_legacy = time_function(read, old_path, read_table, n_repeats=n_repeats)
+            t_read_new = time_function(read, new_path, read_table, n_repeats=n_repeats)
+            assert np.array_equal(read(new_path, read_table), read(old_path, read_table_from_strings))
+
+            size_old, size_new = os.path.getsize(old_path), os.path.getsize(new_path)
+            print(f"{n_rows:7d} rows: write strings {t_write_old:.4f} s, columnar {t_write_new:.4f} s;",
+                  f"read strings {t_read_old:.4f} s, strings (new reader) {t_read_legacy:.4f} s,",
+                  f"columnar {t_read_new:.4f} s; file size {size_old / 1e6:.2f} MB vs {size_new / 1e6:.2f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--row_counts', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+    bench_tables(args.row_counts, args.n_repeats)
@@ -1,33 +1,43 @@
 import argparse
 import os
-import subprocess
-import warnings
 from glob import glob
 
-import h5py
-import napari
-import numpy as np
-import pandas as pd
+from napari_covid_if_annotations.io_utils import open_file, read_columns, read_image
+from napari_covid_if_annotations.status import load_status_index
+from napari_covid_if_annotations.sync import S3Storage, sync
+from napari_covid_if_annotations.validation import get_label_mask, validate_files
 
-from napari_covid_if_annotations.io_utils import read_image, has_table
-from napari_covid_if_annotations.layers import get_segmentation_data
 
+# the bucket that contains the uploads, the endpoint and credentials can be set via environment variables
+S3_ENDPOINT = os.environ.get('COVID_IF_S3_ENDPOINT', 'https://s3.embl.de')
+S3_BUCKET = 'covid-if'
+S3_PREFIX = 'round1'
 
-def get_file_lists():
-    files = subprocess.check_output(['mc', 'ls', 'embl/covid-if/round1']).decode('utf-8')
-    files = files.split('\n')
-    files = [ff.split()[-1] for ff in files if len(ff.split()) > 1]
-    files = [ff for ff in files if ff.endswith('.h5')]
 
-    uploaded_annotations = [ff for ff in files if ff.endswith('annotations.h5')]
+def get_storage(n_connections=8):
+    return S3Storage(S3_BUCKET, S3_PREFIX, endpoint_url=S3_ENDPOINT, n_connections=n_connections)
+
 
+def get_file_lists(storage):
+    # we only consider the files at the top level of the prefix
+    files = [key for key in storage.list() if '/' not in key and key.endswith('.h5')]
+    uploaded_annotations = [ff for ff in files if ff.endswith('annotations.h5')]
     return files, uploaded_annotations
 
 
+def get_file_name(upload):
+    # the file name of the image corresponding to the uploaded annotations
+    return os.path.split(upload.replace('_annotations.h5', '.h5'))[1]
+
+
 def check_uploads():
 
-    files, uploaded_annotations = get_file_lists()
-    checked_files = pd.read_excel('./annotation_status.xlsx')['FileName'].values
+    files, uploaded_annotations = get_file_lists(get_storage())
+    with load_status_index() as index:
+        checked_files = index.names('first_pass', 'second_pass', 'checked')
+        # register the new uploads, so that we can track their status
+        n_new = index.add([get_file_name(upload) for upload in uploaded_annotations])
+    files = set(files)
 
     for upload in uploaded_annotations:
         print("Have upload", upload)
@@ -42,81 +52,37 @@ def check_uploads():
             print("This file is new!")
         print()
 
-    print("Found", len(uploaded_annotations), "uploads")
+    print("Found", len(uploaded_annotations), "uploads,", n_new, "were added to the status index")
 
 
-def sync_uploads():
-    prefix = 'embl/covid-if/round1'
+def sync_uploads(n_workers=8):
     out_root = '/g/kreshuk/data/covid/ground-truth/embl-annotations'
-    os.makedirs(out_root, exist_ok=True)
-    _, uploaded_annotations = get_file_lists()
-    checked_files = pd.read_excel('./annotation_status.xlsx')['FileName'].values
+    storage = get_storage(n_connections=n_workers)
+    _, uploaded_annotations = get_file_lists(storage)
+    with load_status_index() as index:
+        checked_files = index.names('first_pass', 'second_pass', 'checked')
 
-    for upload in uploaded_annotations:
-        file_name = upload.replace('_annotations.h5', '.h5')
-        file_name = os.path.split(file_name)[1]
-        if file_name in checked_files:
-            continue
+    to_sync = [upload for upload in uploaded_annotations if get_file_name(upload) not in checked_files]
+    synced = sync(storage, out_root, keys=to_sync, n_workers=n_workers)
+    print("Downloaded", len(synced), "of", len(to_sync), "uploads")
 
-        in_path = os.path.join(prefix, upload)
-        out_path = os.path.join(out_root, upload)
-        cmd = ['mc', 'cp', in_path, out_path]
-        subprocess.run(cmd)
 
-
-def validate_upload(ff, input_root):
+def view_upload(ff, input_root):
     file_name = os.path.split(ff)[1].replace('_annotations', '')
     in_file = os.path.join(input_root, file_name)
     assert os.path.exists(in_file), in_file
 
-    exp_labels = np.array([0, 1, 2, 3])
-
-    with h5py.File(in_file, 'r') as f:
+    with open_file(in_file, 'r') as f:
         serum = read_image(f, 'serum_IgG')
         marker = read_image(f, 'marker')
 
-    with h5py.File(ff, 'r') as f:
+    with open_file(ff, 'r') as f:
         seg = read_image(f, 'cell_segmentation')
-        if not has_table(f, 'infected_cell_labels'):
-            warnings.warn(f"{file_name} does not have labels!")
-            return
-        (label_ids, centroids,
-         _, infected_cell_labels) = get_segmentation_data(f, seg, edge_width=1)
-
-    n_labels = len(infected_cell_labels) - 1
-    unique_labels = np.unique(infected_cell_labels)
-    if not np.array_equal(unique_labels, exp_labels):
-        print("Found unexpected labels for", file_name)
-        print(unique_labels)
-
-    print("Check annotations for file:", file_name)
-
-    # print percentage of infected / control / uncertain / unlabeled
-    n_unlabeled = (infected_cell_labels == 0).sum() - 1
-    frac_unlabeled = float(n_unlabeled) / n_labels
-    print("Unlabeled:", n_unlabeled, "/", n_labels, "=", frac_unlabeled, "%")
-
-    n_infected = (infected_cell_labels == 1).sum()
-    frac_infected = float(n_infected) / n_labels
-    print("infected:", n_infected, "/", n_labels, "=", frac_infected, "%")
-
-    n_control = (infected_cell_labels == 2).sum()
-    frac_control = float(n_control) / n_labels
-    print("control:", n_control, "/", n_labels, "=", frac_control, "%")
-
-    n_uncertain = (infected_cell_labels == 3).sum()
-    frac_uncertain = float(n_uncertain) / n_labels
-    print("uncertain:", n_uncertain, "/", n_labels, "=", frac_uncertain, "%")
-
-    # make label mask
-    label_mask = np.zeros_like(seg)
-    label_mask[np.isin(seg, label_ids[infected_cell_labels == 1])] = 1
-    label_mask[np.isin(seg, label_ids[infected_cell_labels == 2])] = 2
-    label_mask[np.isin(seg, label_ids[infected_cell_labels == 3])] = 3
-    label_mask[np.isin(seg, label_ids[infected_cell_labels == 0])] = 4
-
-    label_mask[seg == 0] = 0
+        _, (label_ids, infected_cell_labels) = read_columns(f, 'infected_cell_labels')
+    label_mask = get_label_mask(seg, label_ids, infected_cell_labels)
 
+    # we only need napari to view the upload, the validation runs headless
+    import napari
     with napari.gui_qt():
         viewer = napari.Viewer(title=file_name)
         viewer.add_image(serum)
@@ -125,19 +91,35 @@ def validate_upload(ff, input_root):
         viewer.add_labels(label_mask, visible=True)
 
 
-def validate_uploads():
+def validate_uploads(n_workers=None, summary_path='./validation_summary.csv', view=False):
     input_root = '/g/kreshuk/data/covid/for_annotation/round1'
     annotations_root = '/g/kreshuk/data/covid/ground-truth/embl-annotations'
     files = glob(os.path.join(annotations_root, '*.h5'))
     files.sort()
 
-    checked_files = pd.read_excel('./annotation_status.xlsx')['FileName'].values
-    for ff in files:
-        file_name = ff.replace('_annotations.h5', '.h5')
-        file_name = os.path.split(file_name)[1]
-        if file_name in checked_files:
-            continue
-        validate_upload(ff, input_root)
+    with load_status_index() as index:
+        checked_files = index.names('first_pass', 'second_pass', 'checked')
+    files = [ff for ff in files if get_file_name(ff) not in checked_files]
+
+    summary = validate_files(files, n_workers)
+    if len(summary) == 0:
+        print("No new uploads to validate")
+        return
+
+    # the valid uploads have passed the first check
+    with load_status_index() as index:
+        index.add([get_file_name(ff) for ff in files])
+        for ff, valid in zip(files, summary['valid']):
+            if valid:
+                index.set_status(get_file_name(ff), 'first_pass')
+    summary.to_csv(summary_path, index=False)
+    print("Validated", len(summary), "uploads,", (~summary['valid']).sum(), "have problems")
+    print("The summary was written to", summary_path)
+
+    if view:
+        for ff, has_labels, error in zip(files, summary['has_labels'], summary['error']):
+            if has_labels and not error:
+                view_upload(ff, input_root)
 
 
 def debug():
@@ -145,7 +127,8 @@ def debug():
     annotations_root = '/g/kreshuk/data/covid/ground-truth/embl-annotations'
     fname = '20200417_132123_311_WellD06_PointD06_0005_ChannelDAPI,WF_GFP,TRITC,WF_Cy5,DIA_Seq0365_annotations.h5'
     path = os.path.join(annotations_root, fname)
-    validate_upload(path, input_root)
+    print(validate_files([path], n_workers=1).iloc[0])
+    view_upload(path, input_root)
 
 
 if __name__ == '__main__':
@@ -154,6 +137,13 @@ if __name__ == '__main__':
     parser.add_argument('--sync', type=int, default=0)
     parser.add_argument('--validate', type=int, default=0)
     parser.add_argument('--debug', type=int, default=0)
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help="number of processes for the validation, by default the number of cpus")
+    parser.add_argument('--n_sync_workers', type=int, default=8,
+                        help="number of concurrent downloads for syncing the uploads")
+    parser.add_argument('--summary_path', type=str, default='./validation_summary.csv')
+    parser.add_argument('--view', type=int, default=0,
+                        help="view the uploads with labels in napari after the validation")
 
     args = parser.parse_args()
 
@@ -161,10 +151,10 @@ if __name__ == '__main__':
         check_uploads()
 
     if bool(args.sync):
-        sync_uploads()
+        sync_uploads(args.n_sync_workers)
 
     if bool(args.validate):
-        validate_uploads()
+        validate_uploads(args.n_workers, args.summary_path, bool(args.view))
 
     if bool(args.debug):
         debug()
@@ -0,0 +1,38 @@
+import argparse
+import os
+
+from napari_covid_if_annotations.io_utils import COMPRESSIONS, convert_file, get_file_type
+
+
+def convert_files(paths, out_folder, file_format, compression=None, chunks=None, contiguous=False):
+    """ Convert h5 files to zarr or n5 containers (or vice versa).
+    """
+    ext = '.' + file_format
+    for path in paths:
+        if get_file_type(path) is None:
+            print("Skipping", path, "with unknown file format")
+            continue
+        name = os.path.splitext(os.path.basename(path.rstrip('/')))[0]
+        out_folder_ = os.path.dirname(path) if out_folder is None else out_folder
+        out_path = os.path.join(out_folder_, name + ext)
+        if os.path.exists(out_path):
+            print("Skipping", path, "because", out_path, "exists already")
+            continue
+        print("Converting", path, "to", out_path)
+        convert_file(path, out_path, compression=compression, chunks=chunks, contiguous=contiguous)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', type=str)
+    parser.add_argument('--out_folder', type=str, default=None,
+                        help="folder for the converted files, by default next to the input files")
+    parser.add_argument('--format', type=str, default='zarr', choices=['zarr', 'n5', 'h5'])
+    parser.add_argument('--compression', type=str, default=None,
+                        help=f"one of {COMPRESSIONS}, optionally with the level, e.g. gzip:1")
+    parser.add_argument('--chunks', type=int, nargs=2, default=None)
+    parser.add_argument('--contiguous', type=int, default=0,
+                        help="store the images contiguous and uncompressed, so that they can be memory mapped (h5 only)")
+    args = parser.parse_args()
+    convert_files(args.paths, args.out_folder, args.format, args.compression, args.chunks,
+                  bool(args.contiguous))
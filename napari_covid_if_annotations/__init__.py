@@ -3,8 +3,8 @@ try:
 except ImportError:
     __version__ = "unknown"
 
+# NOTE the key bindings are registered when the reader is used (see io_hooks.reader_function)
+# or the viewer is launched, so importing the package does not import napari
 from .io_hooks import napari_get_reader
-from . import _key_bindings
 
 __all__ = ["napari_get_reader"]
-del _key_bindings
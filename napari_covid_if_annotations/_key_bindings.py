@@ -5,30 +5,11 @@ from napari import Viewer
 from napari._vispy.vispy_points_layer import VispyPointsLayer
 VispyPointsLayer._highlight_width = 0
 
-from .image_utils import get_edge_segmentation, get_centroids, map_labels_to_edges
-from .layers import get_centroid_properties, save_labels
-
-
-def update_infected_labels_from_segmentation(seg_ids, prev_seg_ids, infected_labels):
-    assert len(infected_labels) == len(prev_seg_ids), f"{len(infected_labels)}, {len(prev_seg_ids)}"
-    if np.array_equal(seg_ids, prev_seg_ids):
-        return infected_labels
-    else:
-        new_infected_labels = np.zeros_like(seg_ids)
-        mask_a = np.isin(seg_ids, prev_seg_ids)
-        mask_b = np.isin(prev_seg_ids, seg_ids)
-
-        new_infected_labels[mask_a] = infected_labels[mask_b]
-        assert len(new_infected_labels) == len(seg_ids), f"{len(new_infected_labels)}, {len(seg_ids)}"
-
-        return new_infected_labels
-
-
-# NOTE we expect len(point_labels) == len(infected_labels) - 1
-# because we don't have a point for the background
-def update_infected_labels_from_points(point_labels, infected_labels):
-    assert len(point_labels) == len(infected_labels) - 1
-    return np.array([0] + point_labels.tolist())
+from .annotation_state import AnnotationState, update_infected_labels_from_points
+from .incremental import DirtyRegions, get_brush_bounding_box
+from .layers import LabelsWriter, get_centroid_properties, get_labels_snapshot
+from .profiling import timed, timed_stage
+from .saving import BackgroundSaver
 
 
 def modify_points_layer(viewer):
@@ -44,6 +25,100 @@ def modify_points_layer(viewer):
         viewer.layers['infected-vs-control'].mouse_drag_callbacks.append(next_on_click)
 
 
+def modify_segmentation_layer(viewer):
+    """ Record the regions changed by painting in the segmentation layer,
+    so that update_layers only needs to recompute them.
+    """
+    layer = viewer.layers['cell-segmentation']
+    if getattr(layer, '_dirty_regions', None) is not None:
+        return
+    dirty_regions = DirtyRegions()
+    paint, fill = layer.paint, layer.fill
+
+    # the annotation state needs to know the painted labels, so that it does not hand them out as new labels
+    def mark_painted(new_label):
+        state = getattr(layer, '_annotation_state', None)
+        if state is not None:
+            state.mark_painted(new_label)
+
+    def tracked_paint(coord, new_label, *args, **kwargs):
+        dirty_regions.add(get_brush_bounding_box(coord, layer.brush_size, layer.data.shape))
+        mark_painted(new_label)
+        return paint(coord, new_label, *args, **kwargs)
+
+    # a fill can change arbitrary regions, so we need to find the changes
+    # by comparing with the last state
+    def tracked_fill(coord, new_label, *args, **kwargs):
+        dirty_regions.mark_unknown()
+        mark_painted(new_label)
+        return fill(coord, new_label, *args, **kwargs)
+
+    layer.paint = tracked_paint
+    layer.fill = tracked_fill
+
+    # the same for undo and redo, which restore the previous values without painting
+    # (other changes that are not tracked are found when updating, see update_segmentation_cache)
+    def track_history(function):
+        def tracked_function(*args, **kwargs):
+            dirty_regions.mark_unknown()
+            return function(*args, **kwargs)
+        return tracked_function
+
+    for name in ('undo', 'redo'):
+        if hasattr(layer, name):
+            setattr(layer, name, track_history(getattr(layer, name)))
+    layer._dirty_regions = dirty_regions
+
+
+def update_outlines(viewer, state, updated_regions, hide_annotated_segments):
+    outlines_layer = viewer.layers['cell-outlines']
+    infected_edges, changed = state.map_edges(outlines_layer.data, updated_regions, hide_annotated_segments)
+    if changed:
+        with timed_stage('layers'):
+            outlines_layer.data = infected_edges
+
+
+def get_annotation_state(viewer):
+    """ Get the annotation state of the segmentation layer and update it with the changes in the viewer.
+
+    The state is initialized from the layer data and metadata if the segmentation was replaced,
+    e.g. because new annotations were loaded. Returns the state and the regions where the edges
+    have changed (None if everything was recomputed).
+    """
+    seg_layer = viewer.layers['cell-segmentation']
+    edge_width = viewer.layers['cell-outlines'].metadata['edge_width']
+    dirty_regions = getattr(seg_layer, '_dirty_regions', None)
+    # the point labels are aligned with the segment ids from the last update
+    point_labels = viewer.layers['infected-vs-control'].properties['cell_type']
+
+    state = getattr(seg_layer, '_annotation_state', None)
+    if state is None or not state.is_valid(seg_layer.data, edge_width):
+        metadata = seg_layer.metadata
+        infected_labels = update_infected_labels_from_points(point_labels, metadata['infected_labels'])
+        state = AnnotationState(seg_layer.data, edge_width, metadata['seg_ids'], infected_labels)
+        seg_layer._annotation_state = state
+        if dirty_regions is not None:
+            dirty_regions.clear()
+        return state, None
+
+    state.set_point_labels(point_labels)
+    return state, state.update(dirty_regions)
+
+
+def get_next_label(layer):
+    """ Get the label for painting a new segment in the segmentation layer.
+
+    The annotation state keeps track of the used ids, but it only knows about the painted labels
+    if painting is tracked (see modify_segmentation_layer). Otherwise, or if the segmentation was
+    replaced since the last update, we need to look at the segmentation.
+    """
+    state = getattr(layer, '_annotation_state', None)
+    tracked = getattr(layer, '_dirty_regions', None) is not None
+    if tracked and state is not None and state.is_valid(layer.data):
+        return state.next_label()
+    return layer.data.max() + 1
+
+
 #
 # keybindings for the viewer
 #
@@ -53,74 +128,63 @@ def paint_new_label(viewer):
     layer = viewer.layers['cell-segmentation']
     viewer.layers.unselect_all()
     layer.selected = True
-    seg = layer.data
-    next_label = seg.max() + 1
+    next_label = get_next_label(layer)
     layer.mode = 'paint'
     layer.selected_label = next_label
 
 
+def get_saver(viewer):
+    saver = getattr(viewer, '_background_saver', None)
+    if saver is None:
+        saver = BackgroundSaver(LabelsWriter())
+        viewer._background_saver = saver
+    return saver
+
+
 @Viewer.bind_key('Shift-S')
 def _save_labels(viewer):
     # we need to update before saving, otherwise segmentation
     update_layers(viewer)
-    to_save = [
-        (viewer.layers['cell-segmentation'], {}, 'labels')
-    ]
-    save_labels(to_save)
+    # write a copy of the current labels in the background, so that the viewer doesn't freeze
+    snapshot = get_labels_snapshot(viewer.layers['cell-segmentation'])
+    get_saver(viewer).submit(*snapshot)
 
 
 @Viewer.bind_key('u')
+@timed()
 def update_layers(viewer):
-    # get the segmentation as well as the previous seg ids and infected labels
-    # from the segmentation layer
+    # update the segment ids, centroids and infected labels, only recomputing
+    # the regions that were painted since the last update if possible
+    state, updated_regions = get_annotation_state(viewer)
+
     seg_layer = viewer.layers['cell-segmentation']
-    seg = seg_layer.data
     metadata = seg_layer.metadata
-    prev_seg_ids, infected_labels = metadata['seg_ids'], metadata['infected_labels']
-    seg_ids = np.unique(seg)
-
-    # get the updated labels from the point layer properties
-    points_layer = viewer.layers['infected-vs-control']
-    point_labels = points_layer.properties['cell_type']
-    infected_labels = update_infected_labels_from_points(point_labels, infected_labels)
-
-    # the seg ids might have changed because labels were erased or new labels were added
-    # in this case, we need to update the infected labels
-    infected_labels = update_infected_labels_from_segmentation(seg_ids, prev_seg_ids, infected_labels)
-    metadata.update({'seg_ids': seg_ids, 'infected_labels': infected_labels})
-
+    metadata.update({'seg_ids': state.seg_ids, 'infected_labels': state.infected_labels})
     hide_annotated_segments = metadata['hide_annotated_segments']
-    if hide_annotated_segments:
-        # TODO the most elegant vay to hide annotated segments would be to
-        hidden_segments = seg_ids[infected_labels > 0]
-        # color_dict = {seg_id: 'transparent' for seg_id in hidden_segments}
-    else:
-        hidden_segments = None
-    viewer.layers['cell-segmentation'].metadata = metadata
+    seg_layer.metadata = metadata
 
     # get the new centroids and update the centroid properties
-    centroids = get_centroids(seg)
-    properties = get_centroid_properties(centroids, infected_labels)
-
-    viewer.layers['infected-vs-control'].data = centroids
-    viewer.layers['infected-vs-control'].properties = properties
-
-    # hide the points of annotated cells if we are in hidden mode
-    if hide_annotated_segments:
-        viewer.layers['infected-vs-control'].edge_color_cycle[1:, -1] = 0.2
-        viewer.layers['infected-vs-control'].face_color_cycle[1:, -1] = 0.2
-    else:
-        # make sure all alpha values are set to 1, in order to properly toggle visibility
-        viewer.layers['infected-vs-control'].edge_color_cycle[1:, -1] = 1
-        viewer.layers['infected-vs-control'].face_color_cycle[1:, -1] = 1
-
-    if viewer.layers['infected-vs-control'].visible:
-        viewer.layers['infected-vs-control'].refresh_colors()
-
-    edge_width = viewer.layers['cell-outlines'].metadata['edge_width']
-    edges = get_edge_segmentation(seg, edge_width)
-    infected_edges = map_labels_to_edges(edges, seg_ids, infected_labels, hidden_segments, remap_background=4)
-    viewer.layers['cell-outlines'].data = infected_edges
+    with timed_stage('ids_and_centroids'):
+        centroids = state.centroids
+    properties = get_centroid_properties(centroids, state.infected_labels)
+
+    with timed_stage('layers'):
+        viewer.layers['infected-vs-control'].data = centroids
+        viewer.layers['infected-vs-control'].properties = properties
+
+        # hide the points of annotated cells if we are in hidden mode
+        if hide_annotated_segments:
+            viewer.layers['infected-vs-control'].edge_color_cycle[1:, -1] = 0.2
+            viewer.layers['infected-vs-control'].face_color_cycle[1:, -1] = 0.2
+        else:
+            # make sure all alpha values are set to 1, in order to properly toggle visibility
+            viewer.layers['infected-vs-control'].edge_color_cycle[1:, -1] = 1
+            viewer.layers['infected-vs-control'].face_color_cycle[1:, -1] = 1
+
+        if viewer.layers['infected-vs-control'].visible:
+            viewer.layers['infected-vs-control'].refresh_colors()
+
+    update_outlines(viewer, state, updated_regions, hide_annotated_segments)
 
 
 @Viewer.bind_key('h')
@@ -0,0 +1,260 @@
+import numpy as np
+import pytest
+from hypothesis import given, strategies as st
+
+from napari_covid_if_annotations.annotation_state import AnnotationState, update_infected_labels_from_segmentation
+from napari_covid_if_annotations.image_utils import get_ids_and_centroids, map_labels_to_edges
+from napari_covid_if_annotations.incremental import DirtyRegions
+from napari_covid_if_annotations.layers import write_labels
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+
+def make_state(edge_width=1, seed=0):
+    seg = make_segmentation(shape=(128, 128), n_cells=20, seed=seed)
+    seg_ids = np.unique(seg)
+    labels = np.random.default_rng(seed).integers(0, 4, size=len(seg_ids)).astype('int32')
+    labels[0] = 0
+    return AnnotationState(seg, edge_width, seg_ids, labels), labels
+
+
+def check_state(state):
+    seg_ids, centroids = get_ids_and_centroids(state.seg)
+    np.testing.assert_array_equal(state.seg_ids, seg_ids)
+    np.testing.assert_allclose(state.centroids, centroids)
+    assert len(state.infected_labels) == len(state.seg_ids)
+    assert state.infected_labels[0] == 0
+
+
+def test_initialize():
+    state, labels = make_state()
+    check_state(state)
+    np.testing.assert_array_equal(state.infected_labels, labels)
+
+    # without labels all segments are unlabeled
+    state = AnnotationState(state.seg)
+    assert (state.infected_labels == 0).all()
+
+    # the labels are aligned with the ids of the segmentation
+    seg = state.seg.copy()
+    seg[seg == 3] = 0
+    state = AnnotationState(seg, 1, np.unique(state.seg), labels)
+    check_state(state)
+    assert 3 not in state.seg_ids
+    np.testing.assert_array_equal(state.infected_labels, np.delete(labels, 3))
+
+
+@pytest.mark.parametrize('with_dirty_regions', [False, True])
+def test_update(with_dirty_regions):
+    state, labels = make_state()
+    seg = state.seg
+    new_id = seg.max() + 1
+    bb = np.s_[10:20, 10:20]
+    erased_ids = np.setdiff1d(seg, seg[~np.isin(seg, seg[bb])])
+    seg[bb] = new_id
+    dirty_regions = None
+    if with_dirty_regions:
+        dirty_regions = DirtyRegions()
+        dirty_regions.add(bb)
+
+    updated_regions = state.update(dirty_regions)
+    assert updated_regions is not None and len(updated_regions) > 0
+    check_state(state)
+    assert state.get_label(new_id) == 0
+    # the labels of the other segments don't change
+    for seg_id, label in zip(np.unique(seg), state.infected_labels):
+        if seg_id not in erased_ids and seg_id != new_id:
+            assert label == labels[seg_id]
+
+
+def test_labels():
+    state, labels = make_state()
+    state.set_label(5, 3)
+    assert state.get_label(5) == 3
+    with pytest.raises(KeyError):
+        state.get_label(state.seg.max() + 1)
+    with pytest.raises(KeyError):
+        state.set_label(0, 1)
+
+    point_labels = np.ones(len(state.seg_ids) - 1, dtype='int32')
+    state.set_point_labels(point_labels)
+    np.testing.assert_array_equal(state.infected_labels[1:], point_labels)
+    assert state.infected_labels[0] == 0
+    np.testing.assert_array_equal(state.hidden_segments, state.seg_ids[1:])
+    np.testing.assert_array_equal(state.get_centroid_properties()['cell_type'], point_labels)
+
+
+@pytest.mark.parametrize('hide', [False, True])
+def test_map_edges(hide):
+    state, _ = make_state(edge_width=2)
+    hidden = state.hidden_segments if hide else None
+
+    def expected_edges():
+        return map_labels_to_edges(state.edges, state.seg_ids, state.infected_labels, hidden, remap_background=4)
+
+    infected_edges, changed = state.map_edges(hide_annotated_segments=hide)
+    assert changed
+    np.testing.assert_array_equal(infected_edges, expected_edges())
+
+    # nothing was updated
+    infected_edges, changed = state.map_edges(infected_edges, [], hide)
+    assert not changed
+
+    # paint a new segment, the edges are only remapped in the updated regions
+    state.seg[30:40, 30:40] = state.seg.max() + 1
+    updated_regions = state.update()
+    new_edges, changed = state.map_edges(infected_edges, updated_regions, hide)
+    assert changed and new_edges is infected_edges
+    np.testing.assert_array_equal(new_edges, expected_edges())
+
+    # changing a label needs a full update
+    state.set_label(state.seg_ids[1], 0 if state.get_label(state.seg_ids[1]) > 0 else 1)
+    hidden = state.hidden_segments if hide else None
+    new_edges, changed = state.map_edges(infected_edges, [], hide)
+    assert changed
+    np.testing.assert_array_equal(new_edges, expected_edges())
+
+
+def test_from_file_and_save(tmp_path):
+    path = str(tmp_path / 'annotations.h5')
+    state, labels = make_state()
+    state.save(path)
+    loaded = AnnotationState.from_file(path)
+    np.testing.assert_array_equal(loaded.seg, state.seg)
+    np.testing.assert_array_equal(loaded.infected_labels, labels)
+
+    # the state can be saved with any writer that has the signature of write_labels
+    saved = []
+    state.save(path, writer=lambda *args: saved.append(args) or write_labels(*args))
+    assert len(saved) == 1
+
+
+def reconcile_with_dict(seg_ids, prev_seg_ids, infected_labels):
+    prev_labels = dict(zip(prev_seg_ids.tolist(), infected_labels.tolist()))
+    return np.array([prev_labels.get(seg_id, 0) for seg_id in seg_ids.tolist()], dtype=infected_labels.dtype)
+
+
+def to_seg_ids(ids, dtype='uint32'):
+    return np.array(sorted(set(ids) | {0}), dtype=dtype)
+
+
+id_sets = st.sets(st.integers(1, 2 ** 32 - 1), max_size=50) | st.sets(st.integers(1, 100), max_size=50)
+
+
+@given(prev_ids=id_sets, new_ids=id_sets, seed=st.integers(0, 2 ** 16))
+def test_update_infected_labels_from_segmentation(prev_ids, new_ids, seed):
+    prev_seg_ids, seg_ids = to_seg_ids(prev_ids), to_seg_ids(new_ids)
+    infected_labels = np.random.default_rng(seed).integers(0, 4, size=len(prev_seg_ids)).astype('int32')
+    infected_labels[0] = 0
+
+    result = update_infected_labels_from_segmentation(seg_ids, prev_seg_ids, infected_labels)
+    assert result.dtype == infected_labels.dtype
+    np.testing.assert_array_equal(result, reconcile_with_dict(seg_ids, prev_seg_ids, infected_labels))
+
+    # the labels of persistent ids are kept and new ids are unlabeled
+    _, prev_index, index = np.intersect1d(prev_seg_ids, seg_ids, return_indices=True)
+    np.testing.assert_array_equal(result[index], infected_labels[prev_index])
+    assert (np.delete(result, index) == 0).all()
+
+    # reconciling back and forth keeps the labels of the ids in both
+    back = update_infected_labels_from_segmentation(prev_seg_ids, seg_ids, result)
+    np.testing.assert_array_equal(back[prev_index], infected_labels[prev_index])
+
+
+@given(ids=st.sets(st.integers(1, 2 ** 31), max_size=50), n_new=st.integers(1, 10))
+def test_update_infected_labels_with_new_labels(ids, n_new):
+    # painting new labels only adds ids after the current maximum
+    prev_seg_ids = to_seg_ids(ids)
+    infected_labels = np.arange(len(prev_seg_ids), dtype='int32') % 4
+    infected_labels[0] = 0
+    seg_ids = np.concatenate([prev_seg_ids, prev_seg_ids[-1] + np.arange(1, n_new + 1, dtype='uint32')])
+    result = update_infected_labels_from_segmentation(seg_ids, prev_seg_ids, infected_labels)
+    np.testing.assert_array_equal(result[:len(prev_seg_ids)], infected_labels)
+    assert (result[len(prev_seg_ids):] == 0).all()
+
+
+# the offset tests the sparse matching for large ids
+@pytest.mark.parametrize('offset', [0, 2 ** 40])
+def test_update_infected_labels_many_cells(offset):
+    rng = np.random.default_rng(0)
+    prev_seg_ids = to_seg_ids(rng.choice(10 ** 6, size=50000, replace=False) + 1 + offset, dtype='uint64')
+    seg_ids = to_seg_ids(np.concatenate([rng.choice(prev_seg_ids[1:], size=40000, replace=False),
+                                         rng.choice(10 ** 6, size=5000) + 10 ** 6 + offset]), dtype='uint64')
+    infected_labels = rng.integers(0, 4, size=len(prev_seg_ids)).astype('int32')
+    infected_labels[0] = 0
+    result = update_infected_labels_from_segmentation(seg_ids, prev_seg_ids, infected_labels)
+    np.testing.assert_array_equal(result, reconcile_with_dict(seg_ids, prev_seg_ids, infected_labels))
+
+
+def test_update_infected_labels_unsorted():
+    with pytest.raises(ValueError):
+        update_infected_labels_from_segmentation(np.array([0, 3, 2]), np.array([0, 2]), np.zeros(2, dtype='int32'))
+
+
+def test_next_label():
+    state, _ = make_state()
+    max_id = int(state.seg.max())
+    assert state.next_label() == max_id + 1
+    # the label is only used once it is painted
+    assert state.next_label() == max_id + 1
+    state.mark_painted(max_id + 1)
+    assert state.next_label() == max_id + 2
+
+    # painting without updating first, e.g. pressing 'n' several times
+    state.seg[:5, :5] = max_id + 1
+    state.seg[-5:, -5:] = max_id + 2
+    state.mark_painted(max_id + 2)
+    state.update()
+    assert state.next_label() == max_id + 3
+    check_state(state)
+
+
+def test_next_label_reuse_ids():
+    state, _ = make_state()
+    state = AnnotationState(state.seg, reuse_ids=True)
+    max_id = int(state.seg.max())
+    state.seg[np.isin(state.seg, [3, 5])] = 0
+    state.update()
+    assert state.next_label() == 3
+    state.mark_painted(3)
+    assert state.next_label() == 5
+
+    # ids that were painted again are not free anymore
+    state.seg[:5, :5] = 5
+    state.update()
+    assert state.next_label() == max_id + 1
+
+    # erased ids are not reused by default
+    state = AnnotationState(state.seg)
+    state.seg[state.seg == 7] = 0
+    state.update()
+    assert state.next_label() == max_id + 1
+
+
+def test_next_label_after_undo():
+    state, _ = make_state()
+    state = AnnotationState(state.seg, reuse_ids=True)
+    max_id = int(state.seg.max())
+    dirty_regions = DirtyRegions()
+
+    # erase a cell and restore it without tracking the change, like undo does
+    mask = state.seg == 2
+    values = state.seg[mask]
+    for coord in zip(*np.nonzero(mask)):
+        dirty_regions.add(tuple(slice(c, c + 1) for c in coord))
+    state.seg[mask] = 0
+    state.update(dirty_regions)
+    assert state.next_label() == 2
+
+    state.seg[mask] = values
+    state.update(dirty_regions)
+    check_state(state)
+    assert state.next_label() == max_id + 1
+
+
+def test_next_label_overflow():
+    seg = np.full((8, 8), 254, dtype='uint8')
+    state = AnnotationState(seg)
+    assert state.next_label() == 255
+    state.mark_painted(255)
+    with pytest.raises(ValueError):
+        state.next_label()
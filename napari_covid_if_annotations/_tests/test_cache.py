@@ -0,0 +1,87 @@
+import os
+
+import h5py
+import numpy as np
+
+from napari_covid_if_annotations import cache, layers
+from napari_covid_if_annotations.cache import evict, get_cache_key, load_from_cache, save_to_cache
+from napari_covid_if_annotations.layers import get_layers_from_file
+from napari_covid_if_annotations._tests.utils import write_test_data
+
+
+def test_save_and_load(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    data = {'a': np.random.rand(10, 10), 'b': [np.arange(4), np.arange(2)]}
+    assert load_from_cache('key', cache_dir=cache_dir) is None
+    save_to_cache('key', data, cache_dir=cache_dir)
+
+    loaded = load_from_cache('key', mmap=('a',), cache_dir=cache_dir)
+    assert isinstance(loaded['a'], np.memmap)
+    np.testing.assert_array_equal(loaded['a'], data['a'])
+    assert len(loaded['b']) == 2
+    for expected, result in zip(data['b'], loaded['b']):
+        np.testing.assert_array_equal(expected, result)
+
+
+def test_evict(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    data = {'a': np.zeros(1000, dtype='uint8')}
+    for i, key in enumerate(('a', 'b', 'c')):
+        save_to_cache(key, data, cache_dir=cache_dir)
+        os.utime(os.path.join(cache_dir, key), (i, i))
+    # using 'a' makes 'b' the least recently used entry
+    load_from_cache('a', cache_dir=cache_dir)
+    evict(cache_dir, max_size=2500)
+    assert sorted(os.listdir(cache_dir)) == ['a', 'c']
+
+
+def test_get_cache_key(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path)
+    key = get_cache_key(path, saturation_factor=1., edge_width=2)
+    assert key == get_cache_key(path, edge_width=2, saturation_factor=1.)
+    assert key != get_cache_key(path, saturation_factor=1., edge_width=1)
+    with h5py.File(path, 'a') as f:
+        f.attrs['modified'] = True
+    assert key != get_cache_key(path, saturation_factor=1., edge_width=2)
+
+    # the key depends on the modification time of the file instead of its content
+    key = get_cache_key(path, saturation_factor=1., edge_width=2)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert key != get_cache_key(path, saturation_factor=1., edge_width=2)
+
+
+def test_get_layers_from_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path)
+    with h5py.File(path, 'r') as f:
+        expected = get_layers_from_file(f, use_cache=True)
+
+    # the second time the file is opened nothing should be recomputed
+    def _fail(*args, **kwargs):
+        raise AssertionError("Data should be loaded from the cache")
+    monkeypatch.setattr(layers, 'get_raw_data', _fail)
+    monkeypatch.setattr(layers, 'get_segmentation_data', _fail)
+    with h5py.File(path, 'r') as f:
+        result = get_layers_from_file(f, use_cache=True)
+
+    for (expected_data, expected_kwargs, _), (data, kwargs, _) in zip(expected, result):
+        np.testing.assert_array_equal(expected_data, data)
+    # the outlines are modified in-place when the layers are updated
+    assert result[3][0].flags.writeable
+
+
+def test_lazy_data_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path)
+
+    # lazy data is not cached, so the cache key should not be computed
+    def _fail(*args, **kwargs):
+        raise AssertionError("The cache should not be used for lazy data")
+    monkeypatch.setattr(layers, 'get_cache_key', _fail)
+    with h5py.File(path, 'r') as f:
+        get_layers_from_file(f, lazy=True, use_cache=True)
+    assert not os.path.exists(cache.CACHE_DIR)
@@ -1,15 +1,13 @@
 import numpy as np
-from napari_covid_if_annotations import napari_get_reader
+from napari_covid_if_annotations import cache, napari_get_reader
+from napari_covid_if_annotations._tests.utils import write_test_data
 
 
 # tmp_path is a pytest fixture
-def test_reader(tmp_path):
-    """An example of how you might test your plugin."""
-
-    # write some fake data using your supported file format
-    my_test_file = str(tmp_path / "myfile.npy")
-    original_data = np.random.rand(20, 20)
-    np.save(my_test_file, original_data)
+def test_reader(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    my_test_file = str(tmp_path / "myfile.h5")
+    seg = write_test_data(my_test_file)
 
     # try to read it back in
     reader = napari_get_reader(my_test_file)
@@ -18,11 +16,15 @@ def test_reader(tmp_path):
     # make sure we're delivering the right format
     layer_data_list = reader(my_test_file)
     assert isinstance(layer_data_list, list) and len(layer_data_list) > 0
-    layer_data_tuple = layer_data_list[0]
-    assert isinstance(layer_data_tuple, tuple) and len(layer_data_tuple) > 0
-
-    # make sure it's the same as it started
-    np.testing.assert_allclose(original_data, layer_data_tuple[0])
+    for layer_data_tuple in layer_data_list:
+        assert isinstance(layer_data_tuple, tuple) and len(layer_data_tuple) == 3
+
+    # make sure the segmentation is the same as the one we have written
+    layer_types = {kwargs['name']: layer_type for _, kwargs, layer_type in layer_data_list}
+    assert layer_types['cell-segmentation'] == 'labels'
+    assert layer_types['infected-vs-control'] == 'points'
+    seg_data = next(data for data, kwargs, _ in layer_data_list if kwargs['name'] == 'cell-segmentation')
+    np.testing.assert_array_equal(seg, seg_data)
 
 
 def test_get_reader_pass():
@@ -0,0 +1,98 @@
+import numpy as np
+from scipy.ndimage import binary_dilation
+from skimage.measure import regionprops
+from skimage.segmentation import find_boundaries
+from skimage.transform import downscale_local_mean
+
+from napari_covid_if_annotations import image_utils
+from napari_covid_if_annotations.image_utils import (downscale_image, get_boundaries, get_centroids,
+                                                     get_edge_segmentation, get_segmentation_features,
+                                                     histogram_quantile, map_labels_to_edges)
+from napari_covid_if_annotations._tests.utils import make_segmentation, map_labels_to_edges_with_dict
+
+
+def _check_map_labels_to_edges(seg):
+    edges = get_edge_segmentation(seg, 2)
+    seg_ids = np.unique(seg)
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, size=len(seg_ids)).astype('int32')
+    labels[0] = 0
+
+    for hide_ids in (None, seg_ids[labels > 0]):
+        for remap_background in (None, 4):
+            expected = map_labels_to_edges_with_dict(edges, seg_ids, labels, hide_ids, remap_background)
+            result = map_labels_to_edges(edges, seg_ids, labels, hide_ids, remap_background)
+            np.testing.assert_array_equal(result, expected)
+
+
+def test_map_labels_to_edges():
+    _check_map_labels_to_edges(make_segmentation())
+
+
+def test_map_labels_to_edges_sparse(monkeypatch):
+    seg = make_segmentation()
+    # use large ids and make sure that we use the sparse mapping
+    seg[seg > 0] += np.uint32(2 ** 30)
+    monkeypatch.setattr(image_utils, 'MAX_DENSE_LUT_SIZE', 2 ** 16)
+    _check_map_labels_to_edges(seg)
+
+
+def test_get_boundaries():
+    seg = make_segmentation()
+    np.testing.assert_array_equal(get_boundaries(seg), find_boundaries(seg, mode='thick'))
+    seg3d = np.stack([seg, np.roll(seg, 3, axis=0)])
+    np.testing.assert_array_equal(get_boundaries(seg3d), find_boundaries(seg3d, mode='thick'))
+
+
+def test_get_segmentation_features():
+    seg = make_segmentation(n_cells=100)
+    for edge_width in (1, 2):
+        seg_ids, centroids, edges = get_segmentation_features(seg, edge_width)
+        np.testing.assert_array_equal(seg_ids, np.unique(seg))
+        expected_centroids = np.array([prop['centroid'] for prop in regionprops(seg)])
+        np.testing.assert_allclose(centroids, expected_centroids)
+
+        boundaries = find_boundaries(seg, mode='thick')
+        if edge_width > 1:
+            boundaries = binary_dilation(boundaries, iterations=edge_width - 1)
+        np.testing.assert_array_equal(edges, np.where(boundaries, seg, 0))
+
+
+def test_get_segmentation_features_large_ids():
+    seg = make_segmentation().astype('uint64')
+    seg[seg > 0] += np.uint64(2 ** 40)
+    seg_ids, centroids, _ = get_segmentation_features(seg, 1)
+    np.testing.assert_array_equal(seg_ids, np.unique(seg))
+    assert len(centroids) == len(seg_ids) - 1
+
+
+def test_get_centroids():
+    seg = make_segmentation(n_cells=100)
+    # make the ids non-consecutive
+    seg[seg > 0] = 3 * seg[seg > 0] + 7
+    expected = np.array([prop['centroid'] for prop in regionprops(seg)])
+    np.testing.assert_allclose(get_centroids(seg), expected)
+
+    # without background all ids have a centroid
+    seg[seg == 0] = 1
+    expected = np.array([prop['centroid'] for prop in regionprops(seg)])
+    centroids = get_centroids(seg)
+    assert len(centroids) == len(np.unique(seg))
+    np.testing.assert_allclose(centroids, expected)
+
+
+def test_histogram_quantile():
+    rng = np.random.default_rng(0)
+    for size in (1, 2, 1001, 5000):
+        values = rng.integers(0, 2 ** 16, size=size).astype('uint16')
+        hist = np.bincount(values)
+        for q in (0., .01, .5, .99, 1.):
+            np.testing.assert_allclose(histogram_quantile(hist, q), np.quantile(values, q))
+
+
+def test_downscale_image():
+    rng = np.random.default_rng(0)
+    im = rng.random((60, 48, 4)).astype('float32')
+    for factor in (2, 3, 4):
+        expected = downscale_local_mean(im, (factor, factor, 1))
+        np.testing.assert_allclose(downscale_image(im, factor=factor, n_axes=2), expected, rtol=1e-5)
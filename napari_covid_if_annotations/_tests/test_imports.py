@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+import pytest
+
+
+def get_imported_modules(module, candidates):
+    code = f"import sys; import {module}; print(' '.join(m for m in {candidates} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+@pytest.mark.parametrize('module', ['napari_covid_if_annotations',
+                                    'napari_covid_if_annotations.io_utils',
+                                    'napari_covid_if_annotations.layers',
+                                    'napari_covid_if_annotations.annotation_state',
+                                    'napari_covid_if_annotations.validation'])
+def test_no_gui_imports(module):
+    # the reader hook and the headless scripts must not import the gui libraries
+    assert get_imported_modules(module, ['napari', 'vispy', 'qtpy']) == []
+
+
+def test_io_utils_imports():
+    assert get_imported_modules('napari_covid_if_annotations.io_utils', ['dask', 'scipy', 'zarr']) == []
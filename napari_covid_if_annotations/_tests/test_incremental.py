@@ -0,0 +1,115 @@
+import numpy as np
+
+from napari_covid_if_annotations.image_utils import get_centroids, get_edge_segmentation
+from napari_covid_if_annotations.incremental import (DirtyRegions, SegmentationCache,
+                                                     get_brush_bounding_box,
+                                                     update_segmentation_cache)
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+
+def check_cache(cache, seg, edge_width):
+    np.testing.assert_array_equal(cache.seg_ids, np.unique(seg))
+    np.testing.assert_allclose(cache.centroids, get_centroids(seg))
+    np.testing.assert_array_equal(cache.edges, get_edge_segmentation(seg, edge_width))
+
+
+def paint(seg, coord, brush_size, label, dirty_regions):
+    dirty_regions.add(get_brush_bounding_box(coord, brush_size, seg.shape))
+    bb = tuple(slice(max(int(c - brush_size / 2 + .5), 0), int(c + brush_size / 2 + .5)) for c in coord)
+    seg[bb] = label
+
+
+def test_incremental_update():
+    for edge_width in (1, 2, 3):
+        seg = make_segmentation()
+        cache = SegmentationCache(seg, edge_width)
+        check_cache(cache, seg, edge_width)
+
+        dirty_regions = DirtyRegions()
+        # paint a new label, erase part of a cell and paint over an existing cell
+        paint(seg, (30, 40), 10, seg.max() + 1, dirty_regions)
+        paint(seg, (34, 44), 10, 0, dirty_regions)
+        paint(seg, (200, 120), 6, seg[10, 10], dirty_regions)
+        # completely erase one cell
+        erased = seg[128, 128]
+        mask = seg == erased
+        for coord in zip(*np.nonzero(mask)):
+            dirty_regions.add(get_brush_bounding_box(coord, 1, seg.shape))
+        seg[mask] = 0
+
+        cache, updated = update_segmentation_cache(cache, seg, edge_width, dirty_regions)
+        assert updated is not None
+        assert not dirty_regions.bounding_boxes
+        check_cache(cache, seg, edge_width)
+
+
+def test_update_unknown_region():
+    seg = make_segmentation(seed=1)
+    cache = SegmentationCache(seg, 2)
+    dirty_regions = DirtyRegions()
+    dirty_regions.mark_unknown()
+    seg[seg == seg[50, 50]] = seg.max() + 1
+    cache, updated = update_segmentation_cache(cache, seg, 2, dirty_regions)
+    assert updated is not None
+    check_cache(cache, seg, 2)
+
+
+def test_untracked_changes():
+    seg = make_segmentation(seed=3)
+    cache = SegmentationCache(seg, 2)
+    dirty_regions = DirtyRegions()
+
+    # erase a cell, then restore it without marking the region, like undo does
+    mask = seg == 2
+    values = seg[mask]
+    for coord in zip(*np.nonzero(mask)):
+        dirty_regions.add(get_brush_bounding_box(coord, 1, seg.shape))
+    seg[mask] = 0
+    cache, _ = update_segmentation_cache(cache, seg, 2, dirty_regions)
+    check_cache(cache, seg, 2)
+
+    seg[mask] = values
+    paint(seg, (30, 40), 4, seg.max() + 1, dirty_regions)
+    cache, updated = update_segmentation_cache(cache, seg, 2, dirty_regions)
+    assert updated is not None
+    assert 2 in cache.seg_ids
+    check_cache(cache, seg, 2)
+
+
+def test_full_recompute():
+    seg = make_segmentation(seed=2)
+    cache = SegmentationCache(seg, 1)
+
+    # large changes trigger a full recompute
+    seg[:200] = seg.max() + 1
+    dirty_regions = DirtyRegions()
+    dirty_regions.add((slice(0, 200), slice(0, 256)))
+    cache, updated = update_segmentation_cache(cache, seg, 1, dirty_regions)
+    assert updated is None
+    check_cache(cache, seg, 1)
+
+    # replacing the data invalidates the cache
+    new_seg = make_segmentation(seed=3)
+    new_cache, updated = update_segmentation_cache(cache, new_seg, 1)
+    assert new_cache is not cache and updated is None
+    check_cache(new_cache, new_seg, 1)
+
+
+def test_large_ids():
+    # large ids would need huge arrays if the counts were indexed by id
+    large_seg = make_segmentation(seed=2).astype('uint64')
+    large_seg[large_seg > 0] += 2 ** 40
+    small_seg = make_segmentation(seed=2).astype('uint64')
+    for seg in (large_seg, small_seg):
+        cache = SegmentationCache(seg, 2)
+        check_cache(cache, seg, 2)
+
+        dirty_regions = DirtyRegions()
+        # paint a new large label, erase part of a cell and paint over an existing cell
+        paint(seg, (30, 40), 10, 2 ** 41, dirty_regions)
+        paint(seg, (34, 44), 10, 0, dirty_regions)
+        paint(seg, (200, 120), 6, seg[10, 10], dirty_regions)
+        cache, updated = update_segmentation_cache(cache, seg, 2, dirty_regions)
+        assert updated is not None
+        check_cache(cache, seg, 2)
+        assert cache.ids is not None and len(cache.counts) < 1000
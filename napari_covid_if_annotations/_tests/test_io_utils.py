@@ -0,0 +1,200 @@
+import dask.array as da
+import h5py
+import numpy as np
+import pytest
+
+from napari_covid_if_annotations import io_utils
+from napari_covid_if_annotations.io_utils import (convert_file, get_changed_chunks, get_compression_options,
+                                                  get_n_scales, has_table, open_file, read_columns, read_image,
+                                                  read_mmap, read_multiscale_image, read_table, set_write_options,
+                                                  write_image, write_table)
+from napari_covid_if_annotations._tests.utils import make_segmentation, write_test_data
+
+
+def test_read_image_lazy(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    seg = write_test_data(path, shape=(1100, 600))
+    with h5py.File(path, 'r') as f:
+        lazy_seg = read_image(f, 'cell_segmentation', lazy=True)
+        eager_seg = read_image(f, 'cell_segmentation')
+    # the lazy data must still be readable after the file was closed
+    assert isinstance(lazy_seg, da.Array)
+    np.testing.assert_array_equal(lazy_seg.compute(), seg)
+    np.testing.assert_array_equal(lazy_seg[500:700, 100:300].compute(), eager_seg[500:700, 100:300])
+
+
+def test_write_multiscale_image(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    image = np.random.rand(101, 64).astype('float32')
+    seg = make_segmentation(shape=(101, 64))
+    with h5py.File(path, 'w') as f:
+        write_image(f, 'image', image, n_scales=3)
+        write_image(f, 'seg', seg, n_scales=3, is_label=True)
+
+    with h5py.File(path, 'r') as f:
+        assert get_n_scales(f, 'image') == 3
+        pyramid = read_multiscale_image(f, 'image')
+        seg_pyramid = read_multiscale_image(f, 'seg', lazy=True)
+
+    assert [im.shape for im in pyramid] == [(101, 64), (51, 32), (26, 16)]
+    np.testing.assert_allclose(pyramid[1][10, 5], image[20:22, 10:12].mean(), rtol=1e-6)
+    # label pyramids must not contain new ids
+    assert [im.shape for im in seg_pyramid] == [(101, 64), (51, 32), (26, 16)]
+    np.testing.assert_array_equal(seg_pyramid[2].compute(), seg[::4, ::4])
+
+
+def test_write_only_changed(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    seg = write_test_data(path, shape=(300, 200))
+    with h5py.File(path, 'r') as f:
+        chunks = f['cell_segmentation/s0'].chunks
+
+    new_seg = seg.copy()
+    new_seg[5:10, 5:10] = seg.max() + 1
+    new_seg[-1, -1] = 0
+    changed = get_changed_chunks(new_seg, seg, chunks)
+    assert len(changed) == 2
+    assert all(bb[0].start % chunks[0] == 0 and bb[1].start % chunks[1] == 0 for bb in changed)
+
+    for reference in (None, seg):
+        with h5py.File(path, 'a') as f:
+            write_image(f, 'cell_segmentation', new_seg, only_changed=True, reference=reference)
+        with h5py.File(path, 'r') as f:
+            np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), new_seg)
+
+
+def write_string_table(f, name, column_names, table):
+    # the table layout used by previous versions
+    g = f.require_group('tables/%s' % name)
+    g.create_dataset('cells', data=table.astype('S100'))
+    g.create_dataset('columns', data=np.array(column_names, dtype='S100'))
+    g.create_dataset('visible', data=np.ones(len(column_names), dtype='uint8'))
+
+
+def test_read_write_table(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    seg_ids = np.arange(100, dtype='uint32')
+    labels = np.random.randint(0, 4, size=100).astype('int32')
+    names = np.array(['cell-%i' % ii for ii in range(100)])
+    with h5py.File(path, 'w') as f:
+        write_table(f, 'labels', ['label_id', 'infected_label'], [seg_ids, labels])
+        write_table(f, 'mixed', ['label_id', 'name'], [seg_ids, names])
+        write_string_table(f, 'old', ['label_id', 'infected_label'], np.stack([seg_ids, labels], axis=1))
+
+    with h5py.File(path, 'r') as f:
+        assert f['tables/labels/column_data/1'].dtype == np.dtype('int32')
+        for name in ('labels', 'old'):
+            assert has_table(f, name)
+            column_names, table = read_table(f, name)
+            assert column_names == ['label_id', 'infected_label']
+            assert table.dtype.kind == 'i'
+            np.testing.assert_array_equal(table, np.stack([seg_ids, labels], axis=1))
+
+        _, table = read_table(f, 'mixed')
+    assert table.dtype == object
+    assert list(table[:, 1]) == list(names)
+
+    # overwriting a table in the old layout converts it to the new one
+    with h5py.File(path, 'a') as f:
+        write_table(f, 'old', ['label_id', 'infected_label'], [seg_ids, labels], force_write=True)
+        assert 'cells' not in f['tables/old'] and has_table(f, 'old')
+
+
+def test_round_trip_mixed_table(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    seg_ids = np.arange(10, dtype='uint32')
+    scores = np.linspace(0, 1, 10)
+    names = np.array(['cell-%i' % ii for ii in range(9)] + ['zelle-ü'])
+    with h5py.File(path, 'w') as f:
+        write_table(f, 'mixed', ['label_id', 'score', 'name'], [seg_ids, scores, names])
+        _, table = read_table(f, 'mixed')
+        assert table.dtype == object
+        # writing the object table that was read keeps the numeric columns numeric
+        write_table(f, 'copy', ['label_id', 'score', 'name'], table)
+
+    with h5py.File(path, 'r') as f:
+        assert f['tables/copy/column_data/0'].dtype.kind == 'i'
+        assert f['tables/copy/column_data/1'].dtype.kind == 'f'
+        assert f['tables/copy/column_data/2'].dtype.kind == 'S'
+        _, columns = read_columns(f, 'copy')
+    np.testing.assert_array_equal(columns[0], seg_ids)
+    np.testing.assert_array_equal(columns[1], scores)
+    assert list(columns[2]) == list(names)
+
+
+def test_write_options(tmp_path, monkeypatch):
+    path = str(tmp_path / 'data.h5')
+    seg = make_segmentation(shape=(300, 200))
+    monkeypatch.setattr(io_utils, 'DEFAULT_COMPRESSION', io_utils.DEFAULT_COMPRESSION)
+    monkeypatch.setattr(io_utils, 'DEFAULT_CHUNKS', io_utils.DEFAULT_CHUNKS)
+
+    compressions = ['none', 'lzf', 'gzip:1']
+    if io_utils.hdf5plugin is not None:
+        compressions += ['blosc', 'zstd:5']
+    with h5py.File(path, 'w') as f:
+        for compression in compressions:
+            write_image(f, compression, seg, compression=compression, chunks=(64, 512))
+        set_write_options(compression='lzf', chunks=(32, 32))
+        write_image(f, 'default', seg)
+
+    with h5py.File(path, 'r') as f:
+        assert f['none/s0'].compression is None
+        assert f['gzip:1/s0'].compression == 'gzip' and f['gzip:1/s0'].compression_opts == 1
+        assert f['lzf/s0'].chunks == (64, 200)
+        assert f['default/s0'].compression == 'lzf' and f['default/s0'].chunks == (32, 32)
+        for name in compressions + ['default']:
+            np.testing.assert_array_equal(read_image(f, name), seg)
+
+    for invalid in ('lz4', 'lzf:3', 'gzip:x'):
+        with pytest.raises(ValueError):
+            get_compression_options(invalid)
+
+
+@pytest.mark.parametrize('ext', ['.zarr', '.n5'])
+def test_convert_file(tmp_path, ext):
+    pytest.importorskip('zarr')
+    path = str(tmp_path / 'data.h5')
+    seg = write_test_data(path, shape=(300, 200))
+    names = np.array(['cell-%i' % ii for ii in range(10)])
+    with h5py.File(path, 'a') as f:
+        write_table(f, 'names', ['label_id', 'name'], [np.arange(10, dtype='uint32'), names])
+        write_image(f, 'multiscale', seg, n_scales=2, is_label=True)
+
+    out_path = str(tmp_path / ('data' + ext))
+    convert_file(path, out_path, chunks=(128, 128))
+    with open_file(out_path, 'r') as f:
+        assert f['cell_segmentation/s0'].chunks == (128, 128)
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), seg)
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation', lazy=True).compute(), seg)
+        assert get_n_scales(f, 'multiscale') == 2
+        column_names, table = read_table(f, 'names')
+    assert column_names == ['label_id', 'name']
+    assert list(table[:, 1]) == list(names)
+
+    # only the changed chunks are written for zarr containers as well
+    seg[:10, :10] = 0
+    with open_file(out_path, 'a') as f:
+        write_image(f, 'cell_segmentation', seg, only_changed=True)
+    with open_file(out_path, 'r') as f:
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), seg)
+
+
+def test_read_mmap(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    seg = write_test_data(path, shape=(300, 200))
+    contiguous_path = str(tmp_path / 'contiguous.h5')
+    convert_file(path, contiguous_path, contiguous=True)
+
+    with h5py.File(path, 'r') as f:
+        # chunked and compressed datasets cannot be memory mapped
+        assert read_mmap(f['cell_segmentation/s0']) is None
+        assert not isinstance(read_image(f, 'cell_segmentation', mmap=True), np.memmap)
+        marker = read_image(f, 'marker')
+
+    with h5py.File(contiguous_path, 'r') as f:
+        data = read_image(f, 'cell_segmentation', mmap=True)
+        lazy_marker = read_image(f, 'marker', mmap=True, lazy=True)
+    assert isinstance(data, np.memmap) and not data.flags.writeable
+    np.testing.assert_array_equal(data, seg)
+    assert isinstance(lazy_marker, da.Array)
+    np.testing.assert_array_equal(lazy_marker.compute(), marker)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from napari_covid_if_annotations.annotation_state import AnnotationState
+from napari_covid_if_annotations._key_bindings import get_next_label, modify_segmentation_layer
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+
+class FakeLabelsLayer:
+    """ The parts of the napari labels layer that are used for painting.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.brush_size = 5
+
+    def paint(self, coord, new_label, refresh=True):
+        bb = tuple(slice(max(int(c) - 2, 0), int(c) + 3) for c in coord)
+        self.data[bb] = new_label
+
+    def fill(self, coord, new_label, refresh=True):
+        self.data[self.data == self.data[tuple(coord)]] = new_label
+
+
+def make_layer(tracked):
+    seg = make_segmentation(shape=(64, 64), n_cells=10)
+    layer = FakeLabelsLayer(seg)
+    if tracked:
+        viewer = type('FakeViewer', (), {'layers': {'cell-segmentation': layer}})()
+        modify_segmentation_layer(viewer)
+    layer._annotation_state = AnnotationState(seg)
+    return layer
+
+
+def test_next_label_untracked():
+    # e.g. for layers opened via the reader hook, where painting is not tracked
+    layer = make_layer(tracked=False)
+    first_label = get_next_label(layer)
+    assert first_label == layer.data.max() + 1
+    layer.paint((10, 10), first_label)
+    # painting a new cell without updating must not reuse the label
+    second_label = get_next_label(layer)
+    assert second_label != first_label
+    assert second_label == first_label + 1
+
+
+def test_next_label_tracked():
+    layer = make_layer(tracked=True)
+    first_label = get_next_label(layer)
+    layer.paint((10, 10), first_label)
+    assert layer._annotation_state.next_label() == first_label + 1
+    assert get_next_label(layer) == first_label + 1
+
+    # the state is not used anymore if the segmentation was replaced
+    layer.data = np.zeros_like(layer.data)
+    assert get_next_label(layer) == 1
@@ -0,0 +1,79 @@
+import threading
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+
+from napari_covid_if_annotations import _key_bindings
+from napari_covid_if_annotations.io_utils import read_image
+from napari_covid_if_annotations.launcher.covid_if_annotations import load_data_and_annotations, make_show_next_image
+from napari_covid_if_annotations.layers import get_save_path, write_labels
+from napari_covid_if_annotations.prefetch import Prefetcher
+from napari_covid_if_annotations.saving import BackgroundSaver
+from napari_covid_if_annotations._tests.utils import write_test_data
+
+
+class FakeLayerList(list):
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return next(layer for layer in self if layer.name == key)
+        return super().__getitem__(key)
+
+
+class FakeViewer:
+    """ The parts of the napari viewer that are used for switching images.
+    """
+    def __init__(self):
+        self.layers = FakeLayerList()
+        self.title = ''
+
+    def _add_layer(self, data, name, metadata=None, properties=None, **kwargs):
+        self.layers.append(SimpleNamespace(name=name, data=data, metadata=metadata, properties=properties))
+
+    add_image = add_labels = add_points = _add_layer
+
+
+def test_switch_images_while_saving(tmp_path, monkeypatch):
+    paths = [str(tmp_path / f'data{ii}.h5') for ii in range(2)]
+    for ii, path in enumerate(paths):
+        write_test_data(path, seed=ii)
+    # we don't need to update the layers for saving the fake viewer
+    monkeypatch.setattr(_key_bindings, 'update_layers', lambda viewer: None)
+
+    # block the first save, so that the following saves are requested while it is running
+    started, release = threading.Event(), threading.Event()
+
+    def slow_write_labels(*args):
+        started.set()
+        release.wait()
+        write_labels(*args)
+
+    viewer = FakeViewer()
+    viewer._background_saver = BackgroundSaver(slow_write_labels)
+    file_pairs = [(path, None) for path in paths]
+    prefetcher = Prefetcher(file_pairs, lambda pair: load_data_and_annotations(pair, 1, 1, False), n_prefetch=1)
+    show_next_image = make_show_next_image(file_pairs, prefetcher)
+    show_next_image(viewer)
+
+    seg_layer = viewer.layers['cell-segmentation']
+    seg_layer.data[:10, :10] = 1
+    _key_bindings._save_labels(viewer)
+    started.wait()
+    # the final state of the first image is saved while the first save is running
+    seg_layer.data[:10, :10] = 2
+    expected = [seg_layer.data.copy()]
+    show_next_image(viewer)
+    assert viewer.title == 'data1.h5'
+
+    seg_layer = viewer.layers['cell-segmentation']
+    seg_layer.data[:10, :10] = 3
+    expected.append(seg_layer.data.copy())
+    show_next_image(viewer)
+
+    release.set()
+    viewer._background_saver.wait()
+    prefetcher.close()
+    assert viewer._background_saver.last_error is None
+    for path, expected_seg in zip(paths, expected):
+        with h5py.File(get_save_path(path), 'r') as f:
+            np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), expected_seg)
@@ -0,0 +1,90 @@
+import h5py
+import numpy as np
+import pytest
+import skimage.color as skc
+
+from napari_covid_if_annotations.io_utils import convert_file, open_file, read_image, write_image
+from napari_covid_if_annotations.layers import (get_layers_from_file, get_normalization, get_raw_data,
+                                                increase_saturation)
+from napari_covid_if_annotations._tests.utils import write_test_data
+
+
+def test_get_raw_data_lazy(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    # small enough for all blocks to be sampled, so the lazy normalization is exact
+    seg = write_test_data(path, shape=(512, 512))
+    with h5py.File(path, 'r') as f:
+        raw, marker = get_raw_data(f, seg, saturation_factor=1)
+        lazy_raw, lazy_marker = get_raw_data(f, seg, saturation_factor=1, lazy=True)
+    np.testing.assert_allclose(lazy_raw.compute(), raw, atol=1e-6)
+    np.testing.assert_allclose(lazy_marker.compute(), marker, atol=1e-6)
+
+
+def test_get_raw_data_multiscale(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path, shape=(300, 200))
+    with h5py.File(path, 'a') as f:
+        for name in ('serum_IgG', 'marker', 'nuclei', 'cell_segmentation'):
+            image = read_image(f, name)
+            del f[name]
+            write_image(f, name, image, n_scales=2, is_label=name == 'cell_segmentation')
+
+    with h5py.File(path, 'r') as f:
+        layers = get_layers_from_file(f, lazy=True)
+    raw, raw_kwargs, _ = layers[0]
+    assert raw_kwargs['multiscale']
+    assert [im.shape for im in raw] == [(300, 200, 3), (150, 100, 3)]
+    # the segmentation is not multiscale, because it needs to be painted
+    assert layers[2][0].shape == (300, 200)
+
+
+def test_get_normalization():
+    rng = np.random.default_rng(0)
+    im = rng.gamma(2., 200., size=(128, 128)).astype('uint16')
+    bg_mask = rng.random(im.shape) < 0.3
+    for mask in (bg_mask, bg_mask[:, ::-1], np.zeros_like(bg_mask)):
+        # the histogram based normalization for 16 bit data must agree with the float computation
+        np.testing.assert_allclose(get_normalization(im, mask),
+                                   get_normalization(im.astype('float32'), mask), rtol=1e-5)
+
+
+def test_increase_saturation():
+    rng = np.random.default_rng(0)
+    raw = rng.random((64, 64, 3)).astype('float32')
+    for saturation_factor in (1.5, 3.):
+        hsv = skc.rgb2hsv(raw)
+        hsv[..., 1] *= saturation_factor
+        expected = skc.hsv2rgb(hsv).clip(0, 1)
+        np.testing.assert_allclose(increase_saturation(raw, saturation_factor), expected, atol=1e-5)
+
+
+def test_get_layers_from_zarr(tmp_path):
+    pytest.importorskip('zarr')
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path)
+    zarr_path = str(tmp_path / 'data.zarr')
+    convert_file(path, zarr_path)
+
+    with h5py.File(path, 'r') as f:
+        expected = get_layers_from_file(f)
+    with open_file(zarr_path, 'r') as f:
+        layers = get_layers_from_file(f)
+    assert layers[2][1]['metadata']['filename'] == zarr_path
+    for (data, _, layer_type), (expected_data, _, expected_type) in zip(layers, expected):
+        assert layer_type == expected_type
+        np.testing.assert_array_equal(data, expected_data)
+
+
+def test_get_layers_from_contiguous_file(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path)
+    contiguous_path = str(tmp_path / 'contiguous.h5')
+    convert_file(path, contiguous_path, contiguous=True)
+
+    for saturation_factor in (1., 1.5):
+        with h5py.File(path, 'r') as f:
+            expected = get_layers_from_file(f, saturation_factor)
+        with h5py.File(contiguous_path, 'r') as f:
+            layers = get_layers_from_file(f, saturation_factor)
+        for (data, _, _), (expected_data, _, _) in zip(layers, expected):
+            np.testing.assert_array_equal(data, expected_data)
@@ -0,0 +1,31 @@
+import threading
+
+import pytest
+
+from napari_covid_if_annotations.prefetch import Prefetcher
+
+
+def test_prefetcher():
+    loaded = []
+    lock = threading.Lock()
+
+    def load(item):
+        with lock:
+            loaded.append(item)
+        if item == 'fail':
+            raise RuntimeError("Could not load")
+        return item.upper()
+
+    prefetcher = Prefetcher(['a', 'b', 'c', 'd', 'fail'], load, n_prefetch=2)
+    assert prefetcher.get(0) == 'A'
+    # the next two items are loaded in the background
+    assert prefetcher.get(1) == 'B'
+    assert set(loaded) >= {'a', 'b', 'c'}
+    assert prefetcher.get(3) == 'D'
+    with pytest.raises(RuntimeError):
+        prefetcher.get(4)
+    with pytest.raises(IndexError):
+        prefetcher.get(5)
+    prefetcher.close()
+    # every item is loaded only once
+    assert sorted(loaded) == ['a', 'b', 'c', 'd', 'fail']
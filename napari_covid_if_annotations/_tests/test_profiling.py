@@ -0,0 +1,114 @@
+import json
+import threading
+
+import h5py
+import pytest
+
+from napari_covid_if_annotations import profiling
+from napari_covid_if_annotations.layers import get_layers_from_file
+from napari_covid_if_annotations.profiling import TimingLog, format_entry, timed, timed_operation, timed_stage
+from napari_covid_if_annotations._tests.utils import write_test_data
+
+
+def test_timed_operation():
+    log = TimingLog()
+    with timed_operation('update', log=log):
+        with timed_stage('a'):
+            pass
+        with timed_stage('b'):
+            pass
+        with timed_stage('a'):
+            pass
+    # stages outside of an operation are ignored
+    with timed_stage('c'):
+        pass
+
+    entries = log.entries()
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry['operation'] == 'update'
+    assert list(entry['stages']) == ['a', 'b']
+    assert entry['total'] >= sum(entry['stages'].values())
+    assert format_entry(entry).startswith('update: ')
+
+
+def test_nested_operations(monkeypatch):
+    log = TimingLog()
+    monkeypatch.setattr(profiling, 'TIMINGS', log)
+
+    @timed()
+    def inner():
+        with timed_stage('inner_stage'):
+            pass
+
+    with timed_operation('outer'):
+        inner()
+    inner()
+
+    entries = log.entries()
+    assert [entry['operation'] for entry in entries] == ['outer', 'inner']
+    assert all('inner_stage' in entry['stages'] for entry in entries)
+
+
+def test_operations_in_threads():
+    log = TimingLog()
+
+    def _run(name):
+        with timed_operation(name, log=log):
+            with timed_stage(name + '_stage'):
+                pass
+
+    with timed_operation('main', log=log):
+        thread = threading.Thread(target=_run, args=('thread',))
+        thread.start()
+        thread.join()
+
+    entries = {entry['operation']: entry for entry in log.entries()}
+    assert set(entries) == {'main', 'thread'}
+    assert entries['main']['stages'] == {}
+    assert list(entries['thread']['stages']) == ['thread_stage']
+
+
+def test_rolling_log_and_dump(tmp_path):
+    path = str(tmp_path / 'timings.jsonl')
+    log = TimingLog(max_entries=3)
+    for ii in range(5):
+        with timed_operation(f'op{ii}', log=log):
+            pass
+    assert [entry['operation'] for entry in log.entries()] == ['op2', 'op3', 'op4']
+    assert [entry['operation'] for entry in log.entries(n=1)] == ['op4']
+    assert len(log.entries(operation='op0')) == 0
+    assert log.summary(2).split('\n')[0].startswith('op4')
+
+    assert log.dump(path) == 3
+    with open(path) as f:
+        dumped = [json.loads(line) for line in f]
+    assert dumped == log.entries()
+
+
+def test_timings_of_get_layers_from_file(tmp_path, monkeypatch):
+    log = TimingLog(path=str(tmp_path / 'timings.jsonl'))
+    monkeypatch.setattr(profiling, 'TIMINGS', log)
+    path = str(tmp_path / 'data.h5')
+    write_test_data(path)
+    with h5py.File(path, 'r') as f:
+        get_layers_from_file(f, use_cache=False)
+
+    entry, = log.entries()
+    assert entry['operation'] == 'get_layers_from_file'
+    assert {'read', 'raw', 'ids_and_centroids', 'boundaries', 'remap'} <= set(entry['stages'])
+    # the entries are written to the log file directly
+    with open(log.path) as f:
+        assert json.loads(f.read()) == entry
+
+
+def test_unwritable_log_file(tmp_path):
+    log = TimingLog(path=str(tmp_path / 'missing' / 'timings.jsonl'))
+    with pytest.warns(UserWarning):
+        with timed_operation('op0', log=log):
+            pass
+    assert log.path is None
+    # the timings are still recorded and we only warn once
+    with timed_operation('op1', log=log):
+        pass
+    assert [entry['operation'] for entry in log.entries()] == ['op0', 'op1']
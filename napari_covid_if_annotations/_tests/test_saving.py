@@ -0,0 +1,136 @@
+import threading
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+
+from napari_covid_if_annotations.io_utils import open_file, read_image, read_table
+from napari_covid_if_annotations.layers import LabelsWriter, get_labels_snapshot, get_save_path, write_labels
+from napari_covid_if_annotations.saving import BackgroundSaver
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+
+def test_background_saver_coalesces():
+    started, release = threading.Event(), threading.Event()
+    saved = []
+
+    def save(path, value):
+        started.set()
+        release.wait()
+        saved.append((path, value))
+
+    saver = BackgroundSaver(save)
+    saver.submit('a.h5', 1)
+    started.wait()
+    # these are requested while the first save is running, only the last one should be written
+    saver.submit('a.h5', 2)
+    saver.submit('a.h5', 3)
+    assert saver.is_saving
+    assert saver.status_message() == "saving ..."
+    release.set()
+    saver.wait()
+    assert saved == [('a.h5', 1), ('a.h5', 3)]
+    assert not saver.is_saving
+    assert saver.status_message().startswith("saved at")
+
+
+def test_background_saver_several_paths():
+    started, release = threading.Event(), threading.Event()
+    saved = []
+
+    def save(path, value):
+        started.set()
+        release.wait()
+        saved.append((path, value))
+
+    saver = BackgroundSaver(save)
+    saver.submit('a.h5', 1)
+    started.wait()
+    # the requests are only coalesced for the same path, so the last state of a is not lost
+    saver.submit('a.h5', 2)
+    saver.submit('b.h5', 1)
+    saver.submit('c.h5', 1)
+    saver.submit('b.h5', 2)
+    release.set()
+    saver.wait()
+    assert saved == [('a.h5', 1), ('a.h5', 2), ('b.h5', 2), ('c.h5', 1)]
+
+
+def test_background_saver_failure():
+    def save(value):
+        raise OSError("disk full")
+
+    saver = BackgroundSaver(save)
+    saver.submit(1)
+    saver.wait()
+    assert isinstance(saver.last_error, OSError)
+    assert saver.status_message() == "save failed: disk full"
+
+
+def test_save_snapshot(tmp_path):
+    seg = make_segmentation()
+    seg_ids = np.unique(seg)
+    infected_labels = np.random.randint(0, 4, size=len(seg_ids)).astype('int32')
+    infected_labels[0] = 0
+    layer = SimpleNamespace(data=seg, metadata={'filename': str(tmp_path / 'data.h5'),
+                                                'seg_ids': seg_ids, 'infected_labels': infected_labels})
+
+    snapshot = get_labels_snapshot(layer)
+    save_path = snapshot[0]
+    assert save_path == str(tmp_path / 'data_annotations.h5')
+    # changes after the snapshot must not be saved
+    expected = seg.copy()
+    seg[:10] = 0
+
+    saver = BackgroundSaver(write_labels)
+    saver.submit(*snapshot)
+    saver.wait()
+    assert saver.last_error is None
+
+    with h5py.File(save_path, 'r') as f:
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), expected)
+        _, table = read_table(f, 'infected_cell_labels')
+    np.testing.assert_array_equal(table[:, 0], seg_ids)
+    np.testing.assert_array_equal(table[:, 1], infected_labels)
+
+
+def test_labels_writer(tmp_path):
+    save_path = str(tmp_path / 'data_annotations.h5')
+    seg = make_segmentation()
+    seg_ids = np.unique(seg)
+    infected_labels = np.zeros(len(seg_ids), dtype='int32')
+
+    writer = LabelsWriter()
+    writer(save_path, seg, seg_ids, infected_labels)
+    new_seg = seg.copy()
+    new_seg[:10] = 0
+    writer(save_path, new_seg, seg_ids, infected_labels)
+    with h5py.File(save_path, 'r') as f:
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), new_seg)
+
+    # the file was changed by someone else, so the last written data must not be used as reference
+    write_labels(save_path, seg, seg_ids, infected_labels)
+    writer(save_path, new_seg.copy(), seg_ids, infected_labels)
+    with h5py.File(save_path, 'r') as f:
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), new_seg)
+
+
+def test_save_labels_zarr(tmp_path):
+    pytest.importorskip('zarr')
+    save_path = str(tmp_path / 'data_annotations.zarr')
+    seg = make_segmentation()
+    seg_ids = np.unique(seg)
+    infected_labels = np.random.randint(0, 4, size=len(seg_ids)).astype('int32')
+    infected_labels[0] = 0
+    assert get_save_path(str(tmp_path / 'data.zarr')) == save_path
+
+    writer = LabelsWriter()
+    writer(save_path, seg, seg_ids, infected_labels)
+    new_seg = seg.copy()
+    new_seg[:10] = 0
+    writer(save_path, new_seg, seg_ids, infected_labels)
+    with open_file(save_path, 'r') as f:
+        np.testing.assert_array_equal(read_image(f, 'cell_segmentation'), new_seg)
+        _, table = read_table(f, 'infected_cell_labels')
+    np.testing.assert_array_equal(table[:, 1], infected_labels)
@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+from napari_covid_if_annotations.status import StatusIndex, load_status_index
+
+
+def test_status_transitions(tmp_path):
+    path = str(tmp_path / 'status.sqlite')
+    with StatusIndex(path) as index:
+        assert index.add(['a.h5', 'b.h5', 'c.h5']) == 3
+        # files that are in the index already are not changed
+        assert index.add(['a.h5', 'd.h5'], status='checked') == 1
+        assert index.get_status('a.h5') == 'new' and 'd.h5' in index
+
+        index.set_status('a.h5', 'first_pass')
+        index.set_status('a.h5', 'second_pass')
+        index.set_status('b.h5', 'first_pass')
+        with pytest.raises(ValueError):
+            index.set_status('c.h5', 'checked')
+        with pytest.raises(ValueError):
+            index.set_status('c.h5', 'done')
+        with pytest.raises(ValueError):
+            index.set_status('e.h5', 'first_pass')
+        index.set_status('c.h5', 'checked', force=True)
+
+    # the index is persistent
+    with StatusIndex(path) as index:
+        assert len(index) == 4
+        assert index.names('second_pass') == {'a.h5'}
+        assert index.names('first_pass', 'checked') == {'b.h5', 'c.h5', 'd.h5'}
+        assert index.counts() == {'first_pass': 1, 'second_pass': 1, 'checked': 2}
+
+
+def test_import_xlsx(tmp_path):
+    pytest.importorskip('openpyxl')
+    xlsx_path = str(tmp_path / 'annotation_status.xlsx')
+    pd.DataFrame({'FileName': ['a.h5', 'b.h5', 'c.h5', 'd.h5'],
+                  'Status': ['ok', 'proofread', 'no_labels', 'second_pass']}).to_excel(xlsx_path, index=False)
+
+    path = str(tmp_path / 'status.sqlite')
+    with load_status_index(path, xlsx_path) as index:
+        # images that were proofread already must not be proofread again
+        assert index.names('checked') == {'a.h5', 'b.h5', 'c.h5'}
+        assert index.names('second_pass') == {'d.h5'}
+        index.set_status('d.h5', 'checked')
+
+    # the index is only initialized from the table once
+    with load_status_index(path, xlsx_path) as index:
+        assert index.get_status('d.h5') == 'checked'
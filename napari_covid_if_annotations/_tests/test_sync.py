@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+from napari_covid_if_annotations.sync import (PART_SUFFIX, LocalStorage, ObjectChangedError,
+                                              download, get_md5, sync)
+
+
+def write_file(path, size, seed=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = np.random.default_rng(seed).integers(0, 256, size=size, dtype='uint8').tobytes()
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_sync(tmp_path):
+    remote, local = str(tmp_path / 'remote'), str(tmp_path / 'local')
+    data = {f'file{ii}_annotations.h5': write_file(os.path.join(remote, f'file{ii}_annotations.h5'), 3000, ii)
+            for ii in range(5)}
+    data['sub/file.h5'] = write_file(os.path.join(remote, 'sub', 'file.h5'), 10)
+    storage = LocalStorage(remote)
+
+    synced = sync(storage, local, n_workers=3)
+    assert sorted(synced) == sorted(data)
+    for key, content in data.items():
+        assert read_file(os.path.join(local, key)) == content
+
+    # nothing changed, so nothing needs to be downloaded
+    assert sync(storage, local) == []
+
+    # only the changed file is synced again
+    data['file1_annotations.h5'] = write_file(os.path.join(remote, 'file1_annotations.h5'), 3000, seed=42)
+    assert sync(storage, local, keys=['file0_annotations.h5', 'file1_annotations.h5']) == ['file1_annotations.h5']
+    assert read_file(os.path.join(local, 'file1_annotations.h5')) == data['file1_annotations.h5']
+
+
+def test_resume_download(tmp_path):
+    remote, local = str(tmp_path / 'remote'), str(tmp_path / 'local')
+    key = 'file.h5'
+    content = write_file(os.path.join(remote, key), 5000)
+    storage = LocalStorage(remote)
+    info = storage.list()[key]
+
+    # simulate an interrupted download
+    out_path = os.path.join(local, key)
+    os.makedirs(local)
+    with open(out_path + PART_SUFFIX, 'wb') as f:
+        f.write(content[:2000])
+    with open(out_path + PART_SUFFIX + '.etag', 'w') as f:
+        f.write(info.etag)
+
+    starts = []
+    read = storage.read
+
+    def read_and_record(key, start=0, etag=None):
+        starts.append(start)
+        return read(key, start=start, etag=etag)
+
+    storage.read = read_and_record
+    download(storage, key, info, out_path)
+    assert starts == [2000]
+    assert read_file(out_path) == content
+    assert not os.path.exists(out_path + PART_SUFFIX)
+
+    # the object changed since listing it
+    write_file(os.path.join(remote, key), 5000, seed=1)
+    with pytest.raises(ObjectChangedError):
+        download(storage, key, info, out_path)
+    assert get_md5(out_path) == info.etag
@@ -0,0 +1,84 @@
+import h5py
+import numpy as np
+
+from napari_covid_if_annotations.io_utils import write_image, write_table
+from napari_covid_if_annotations.layers import write_labels
+from napari_covid_if_annotations.validation import get_label_mask, validate_files
+from napari_covid_if_annotations._tests.utils import make_segmentation
+
+
+def test_get_label_mask():
+    seg = make_segmentation()
+    seg_ids = np.unique(seg)
+    infected_labels = np.random.randint(0, 4, size=len(seg_ids)).astype('int32')
+    infected_labels[0] = 0
+
+    expected = np.zeros_like(seg)
+    for label in (1, 2, 3):
+        expected[np.isin(seg, seg_ids[infected_labels == label])] = label
+    expected[np.isin(seg, seg_ids[infected_labels == 0])] = 4
+    expected[seg == 0] = 0
+    np.testing.assert_array_equal(get_label_mask(seg, seg_ids, infected_labels), expected)
+
+
+def test_get_label_mask_mismatched_ids():
+    seg = make_segmentation()
+    seg_ids = np.unique(seg)
+    infected_labels = np.ones(len(seg_ids), dtype='int32')
+    infected_labels[0] = 0
+
+    # the annotations are for a different segmentation: the segmentation has an id that is larger
+    # than the ids in the table and an id that is missing in the table
+    mismatched_seg = seg.copy()
+    mismatched_seg[:10, :10] = seg_ids[-1] + 10
+    missing_id = seg_ids[5]
+    mismatched_ids = np.delete(seg_ids, 5)
+    mismatched_labels = np.delete(infected_labels, 5)
+
+    for large_offset in (0, 2 ** 40):
+        this_seg = mismatched_seg.astype('uint64')
+        this_seg[this_seg > 0] += large_offset
+        these_ids = mismatched_ids.astype('uint64')
+        these_ids[1:] += large_offset
+        mask = get_label_mask(this_seg, these_ids, mismatched_labels)
+        unknown = (mismatched_seg == missing_id) | (mismatched_seg == seg_ids[-1] + 10)
+        assert (mask[unknown] == 0).all()
+        assert (mask[~unknown & (seg != 0)] == 1).all()
+
+
+def test_validate_files(tmp_path):
+    seg = make_segmentation()
+    seg_ids = np.unique(seg)
+    infected_labels = np.zeros(len(seg_ids), dtype='int32')
+    infected_labels[1:11] = 1
+    infected_labels[11:16] = 2
+
+    valid_path = str(tmp_path / 'valid_annotations.h5')
+    write_labels(valid_path, seg, seg_ids, infected_labels)
+
+    unexpected_path = str(tmp_path / 'unexpected_annotations.h5')
+    unexpected_labels = infected_labels.copy()
+    unexpected_labels[-1] = 5
+    with h5py.File(unexpected_path, 'w') as f:
+        write_image(f, 'cell_segmentation', seg)
+        write_table(f, 'infected_cell_labels', ['label_id', 'infected_label'], [seg_ids, unexpected_labels])
+
+    no_labels_path = str(tmp_path / 'no_labels_annotations.h5')
+    with h5py.File(no_labels_path, 'w') as f:
+        write_image(f, 'cell_segmentation', seg)
+
+    missing_path = str(tmp_path / 'missing_annotations.h5')
+    paths = [valid_path, unexpected_path, no_labels_path, missing_path]
+    summary = validate_files(paths, n_workers=2)
+
+    assert list(summary['valid']) == [True, False, False, False]
+    valid = summary.iloc[0]
+    n_cells = len(seg_ids) - 1
+    assert valid['n_cells'] == n_cells
+    assert (valid['n_infected'], valid['n_control'], valid['n_uncertain']) == (10, 5, 0)
+    assert valid['n_unlabeled'] == n_cells - 15
+    assert np.isclose(valid['frac_infected'], 10 / n_cells)
+
+    assert summary.iloc[1]['unexpected_labels'] == '5'
+    assert not summary.iloc[2]['has_labels'] and summary.iloc[2]['error'] == ''
+    assert summary.iloc[3]['error'] != ''
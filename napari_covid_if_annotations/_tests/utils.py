@@ -0,0 +1,43 @@
+import h5py
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from napari_covid_if_annotations.io_utils import write_image
+
+
+def make_segmentation(shape=(256, 256), n_cells=50, seed=0, background_fraction=0.05):
+    """ Make a random voronoi-like segmentation with some background pixels.
+    """
+    rng = np.random.default_rng(seed)
+    seeds = np.zeros(shape, dtype='uint32')
+    coords = tuple(rng.integers(0, sh, size=n_cells) for sh in shape)
+    seeds[coords] = np.arange(1, n_cells + 1)
+    _, indices = distance_transform_edt(seeds == 0, return_indices=True)
+    seg = seeds[tuple(indices)]
+    seg[rng.random(shape) < background_fraction] = 0
+    return seg
+
+
+# the previous implementation of map_labels_to_edges, which sorts all pixels with np.unique
+# and then maps the unique values with a python dict, used as reference in tests and benchmarks
+def map_labels_to_edges_with_dict(edges, seg_ids, labels, hide_ids=None, remap_background=None):
+    replace_dict = dict(zip(seg_ids, labels))
+    if hide_ids is not None:
+        for hide_id in hide_ids:
+            replace_dict[hide_id] = 0 if remap_background is None else remap_background
+    if remap_background is not None:
+        replace_dict[0] = remap_background
+    unique_values, inverse_indices = np.unique(edges, return_inverse=True)
+    return np.array([replace_dict[val] for val in unique_values])[inverse_indices].reshape(edges.shape)
+
+
+def write_test_data(path, shape=(256, 256), n_cells=50, seed=0):
+    """ Write a file with random raw data channels and a cell segmentation.
+    """
+    rng = np.random.default_rng(seed)
+    seg = make_segmentation(shape, n_cells, seed)
+    with h5py.File(path, 'w') as f:
+        for name in ('serum_IgG', 'marker', 'nuclei'):
+            write_image(f, name, rng.integers(0, 1000, size=shape).astype('uint16'))
+        write_image(f, 'cell_segmentation', seg)
+    return seg
@@ -0,0 +1,255 @@
+"""
+Annotation state of one image, independent of the viewer.
+
+AnnotationState owns the cell segmentation, its segment ids and centroids and the
+infected labels of the segments, and keeps them in sync when the segmentation is painted
+or the labels are changed. The viewer key bindings are a thin adapter that
+passes the layer data to the state and writes the results back to the layers,
+so the state can also be used in scripts and tests without a viewer.
+"""
+import heapq
+
+import numpy as np
+
+from .image_utils import MAX_DENSE_LUT_SIZE, map_labels_to_edges
+from .incremental import SegmentationCache, update_segmentation_cache
+from .io_utils import has_table, open_file, read_columns, read_image
+from .layers import get_centroid_properties, write_labels
+from .profiling import timed_stage
+
+# value of the background and of hidden segments in the infected edges
+HIDDEN_LABEL = 4
+
+
+def _check_sorted(ids, name):
+    if len(ids) > 1 and not (ids[1:] > ids[:-1]).all():
+        raise ValueError(f"{name} must be sorted and unique")
+
+
+def update_infected_labels_from_segmentation(seg_ids, prev_seg_ids, infected_labels):
+    """ Get the labels for the new segment ids from the labels of the previous segment ids.
+
+    The labels of ids that are in both are kept, new ids are unlabeled and the labels of
+    removed ids are dropped; a relabeled segment is a removed and a new id.
+    Both id arrays must be sorted and unique. The labels are looked up in a dense lookup table
+    for small ids and by matching the ids with np.searchsorted, i.e. in O(n log n), for large ids.
+    """
+    assert len(infected_labels) == len(prev_seg_ids), f"{len(infected_labels)}, {len(prev_seg_ids)}"
+    if np.array_equal(seg_ids, prev_seg_ids):
+        return infected_labels
+    _check_sorted(seg_ids, 'seg_ids')
+    _check_sorted(prev_seg_ids, 'prev_seg_ids')
+
+    if len(seg_ids) == 0 or len(prev_seg_ids) == 0:
+        return np.zeros(len(seg_ids), dtype=infected_labels.dtype)
+
+    max_id = max(int(seg_ids[-1]), int(prev_seg_ids[-1]))
+    if max_id < MAX_DENSE_LUT_SIZE:
+        lut = np.zeros(max_id + 1, dtype=infected_labels.dtype)
+        lut[prev_seg_ids] = infected_labels
+        return lut[seg_ids]
+
+    new_infected_labels = np.zeros(len(seg_ids), dtype=infected_labels.dtype)
+    index = np.searchsorted(prev_seg_ids, seg_ids)
+    # ids larger than all previous ids are mapped past the end
+    index[index == len(prev_seg_ids)] = 0
+    found = prev_seg_ids[index] == seg_ids
+    new_infected_labels[found] = infected_labels[index[found]]
+    return new_infected_labels
+
+
+# NOTE we expect len(point_labels) == len(infected_labels) - 1
+# because we don't have a point for the background
+def update_infected_labels_from_points(point_labels, infected_labels):
+    assert len(point_labels) == len(infected_labels) - 1
+    return np.array([0] + point_labels.tolist())
+
+
+def get_effective_labels(infected_labels, hide_annotated_segments):
+    """ Get the labels as they are shown in the outlines, i.e. with hidden segments mapped to HIDDEN_LABEL.
+    """
+    if not hide_annotated_segments:
+        return infected_labels
+    return np.where(infected_labels > 0, HIDDEN_LABEL, infected_labels)
+
+
+def labels_changed(prev_seg_ids, prev_labels, seg_ids, labels):
+    """ Check if the labels changed for any of the ids that are present before and after the update.
+    """
+    _, prev_index, index = np.intersect1d(prev_seg_ids, seg_ids,
+                                          assume_unique=True, return_indices=True)
+    return not np.array_equal(prev_labels[prev_index], labels[index])
+
+
+class AnnotationState:
+    """ Segmentation, segment ids, centroids and infected labels of one image.
+
+    The infected labels are aligned with the (sorted) segment ids, the first id is the background.
+    The segmentation is modified in place, e.g. by painting in the viewer, and update must be called
+    afterwards to bring the ids, centroids and labels up to date. Only the regions that
+    were painted are recomputed if they are passed to update.
+
+    The state also keeps track of the largest id and, if reuse_ids is True, of the ids
+    that were erased, so that next_label does not need to look at the segmentation.
+    Erased ids that are restored, e.g. by undo, are only removed from the free ids at the next update,
+    so reusing ids is off by default.
+    """
+    def __init__(self, seg, edge_width=1, seg_ids=None, infected_labels=None, reuse_ids=False):
+        self.edge_width = edge_width
+        self.reuse_ids = reuse_ids
+        self._cache = SegmentationCache(seg, edge_width)
+        self.seg_ids = self._cache.seg_ids
+        self._max_id = int(self.seg_ids[-1]) if len(self.seg_ids) > 0 else 0
+        # the erased ids, as heap to get the smallest one and as set to remove ids that are painted again
+        self._free_id_heap, self._free_ids = [], set()
+        if infected_labels is None:
+            self.infected_labels = np.zeros(len(self.seg_ids), dtype='int32')
+        else:
+            assert seg_ids is not None
+            self.infected_labels = update_infected_labels_from_segmentation(self.seg_ids, seg_ids,
+                                                                            infected_labels)
+        # the infected edges, segment ids and effective labels of the last call to map_edges
+        self._edge_state = None
+
+    @classmethod
+    def from_file(cls, path, edge_width=1, infected_label_name='infected_cell_labels'):
+        """ Load the segmentation and the infected labels if the file has them.
+        """
+        seg_ids, infected_labels = None, None
+        with open_file(path, 'r') as f:
+            seg = read_image(f, 'cell_segmentation')
+            if has_table(f, infected_label_name):
+                _, (seg_ids, infected_labels) = read_columns(f, infected_label_name)
+                infected_labels = infected_labels.astype('int32')
+        return cls(seg, edge_width, seg_ids, infected_labels)
+
+    @property
+    def seg(self):
+        return self._cache.source
+
+    @property
+    def centroids(self):
+        """ The centroids of the foreground segments, aligned with seg_ids[1:].
+        """
+        return self._cache.centroids
+
+    @property
+    def edges(self):
+        return self._cache.edges
+
+    @property
+    def hidden_segments(self):
+        """ The ids of the annotated segments, which are hidden if the annotated segments are hidden.
+        """
+        return self.seg_ids[self.infected_labels > 0]
+
+    def is_valid(self, seg, edge_width=None):
+        # the state becomes invalid if the segmentation was replaced
+        return self._cache.is_valid(seg, self.edge_width if edge_width is None else edge_width)
+
+    def update(self, dirty_regions=None):
+        """ Update the ids, centroids and labels after the segmentation was changed.
+
+        dirty_regions are the regions painted since the last update, if they are not given
+        the changed regions are found by comparing with the state at the last update.
+        Labels of segments that still exist are kept, new segments are unlabeled.
+        Returns the list of regions where the edges have changed or None if everything was recomputed.
+        """
+        self._cache, updated_regions = update_segmentation_cache(self._cache, self.seg, self.edge_width,
+                                                                 dirty_regions)
+        seg_ids = self._cache.seg_ids
+        with timed_stage('labels'):
+            self.infected_labels = update_infected_labels_from_segmentation(seg_ids, self.seg_ids,
+                                                                            self.infected_labels)
+            self._update_free_ids(seg_ids)
+        self.seg_ids = seg_ids
+        return updated_regions
+
+    def _update_free_ids(self, seg_ids):
+        if len(seg_ids) > 0:
+            self._max_id = max(self._max_id, int(seg_ids[-1]))
+        if not self.reuse_ids or np.array_equal(seg_ids, self.seg_ids):
+            return
+        # ids that were painted again are not free anymore
+        self._free_ids.difference_update(np.setdiff1d(seg_ids, self.seg_ids, assume_unique=True).tolist())
+        for seg_id in np.setdiff1d(self.seg_ids, seg_ids, assume_unique=True).tolist():
+            if seg_id != 0 and seg_id not in self._free_ids:
+                self._free_ids.add(seg_id)
+                heapq.heappush(self._free_id_heap, seg_id)
+
+    def next_label(self):
+        """ Get an unused id for painting a new segment.
+
+        This is the smallest erased id if reuse_ids is True and an id was erased, otherwise
+        the largest id + 1. The id is only marked as used once it is painted, see mark_painted.
+        """
+        # the heap can contain ids that were painted again, we remove them lazily
+        while self._free_id_heap and self._free_id_heap[0] not in self._free_ids:
+            heapq.heappop(self._free_id_heap)
+        if self._free_id_heap:
+            return self._free_id_heap[0]
+        if self._max_id >= np.iinfo(self.seg.dtype).max:
+            raise ValueError(f"All ids of the segmentation dtype {self.seg.dtype} are used")
+        return self._max_id + 1
+
+    def mark_painted(self, label):
+        """ Record that the label was painted, so that it is not returned by next_label anymore.
+        """
+        label = int(label)
+        self._max_id = max(self._max_id, label)
+        self._free_ids.discard(label)
+
+    def set_point_labels(self, point_labels):
+        """ Set the labels from the labels of the centroid points, which are aligned with seg_ids[1:].
+        """
+        with timed_stage('labels'):
+            self.infected_labels = update_infected_labels_from_points(point_labels, self.infected_labels)
+
+    def get_label(self, seg_id):
+        return self.infected_labels[self._get_index(seg_id)]
+
+    def set_label(self, seg_id, label):
+        self.infected_labels[self._get_index(seg_id)] = label
+
+    def _get_index(self, seg_id):
+        index = np.searchsorted(self.seg_ids, seg_id)
+        if seg_id == 0 or index == len(self.seg_ids) or self.seg_ids[index] != seg_id:
+            raise KeyError(f"Segment {seg_id} is not in the segmentation")
+        return index
+
+    def get_centroid_properties(self):
+        return get_centroid_properties(self.centroids, self.infected_labels)
+
+    def map_edges(self, infected_edges=None, updated_regions=None, hide_annotated_segments=False):
+        """ Map the infected labels to the edges of the segments.
+
+        If infected_edges is the result of the last call, only the updated regions are remapped
+        in place, unless the labels of the other segments have changed.
+        (new ids can only appear and old ids can only disappear inside of the updated regions)
+        Returns the infected edges and whether they have changed.
+        """
+        effective_labels = get_effective_labels(self.infected_labels, hide_annotated_segments)
+        hidden_segments = self.hidden_segments if hide_annotated_segments else None
+
+        prev_state = self._edge_state
+        full_update = (updated_regions is None or prev_state is None or
+                       infected_edges is None or infected_edges is not prev_state[0] or
+                       labels_changed(prev_state[1], prev_state[2], self.seg_ids, effective_labels))
+
+        with timed_stage('remap'):
+            if full_update:
+                infected_edges = map_labels_to_edges(self.edges, self.seg_ids, self.infected_labels,
+                                                     hidden_segments, remap_background=HIDDEN_LABEL)
+            else:
+                for bb in updated_regions:
+                    infected_edges[bb] = map_labels_to_edges(self.edges[bb], self.seg_ids, self.infected_labels,
+                                                             hidden_segments, remap_background=HIDDEN_LABEL)
+
+        # the labels can be changed in place, so we need to keep a copy
+        self._edge_state = (infected_edges, self.seg_ids, effective_labels.copy())
+        return infected_edges, full_update or bool(updated_regions)
+
+    def save(self, save_path, writer=write_labels):
+        """ Save the segmentation and infected labels with writer, e.g. a LabelsWriter.
+        """
+        writer(save_path, self.seg, self.seg_ids, self.infected_labels)
@@ -0,0 +1,158 @@
+"""
+Persistent on-disk cache for the layer data derived from an input file.
+
+The cache entries are keyed by the path, size and modification time of the file
+and the parameters of the preprocessing, so files that are opened repeatedly (e.g. when proofreading)
+don't need to be preprocessed again. Each entry is a directory with one .npy file
+per array, so that large arrays can be memory mapped when they are loaded.
+The total size of the cache is bounded and the least recently used entries are evicted.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('COVID_IF_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'covid-if-annotations'))
+# maximal size of the cache in bytes, set to 0 to disable caching
+CACHE_SIZE = int(os.environ.get('COVID_IF_CACHE_SIZE', 4 * 1024 ** 3))
+INDEX_NAME = 'index.json'
+TMP_PREFIX = '.tmp-'
+
+
+def get_file_hash(path, block_size=2 ** 20):
+    """ Get the hash of the file content, or of the content of all files for a directory (e.g. zarr).
+    """
+    if os.path.isdir(path):
+        file_paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        file_paths = [path]
+
+    file_hash = hashlib.blake2b(digest_size=16)
+    for file_path in file_paths:
+        if file_path != path:
+            file_hash.update(os.path.relpath(file_path, path).encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_state(path):
+    """ Get the absolute path, size and modification time of the file, or of all files for a directory.
+
+    This is much cheaper than hashing the content and changes whenever the file is written.
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    size, mtime = 0, os.stat(path).st_mtime_ns
+    for root, _, names in os.walk(path):
+        for name in names:
+            stat = os.stat(os.path.join(root, name))
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+    return [os.path.abspath(path), size, mtime]
+
+
+def get_cache_key(path, **params):
+    """ Get the cache key for the file at path and the parameters used to derive the cached data.
+    """
+    file_state = json.dumps(get_file_state(path))
+    file_hash = hashlib.blake2b(file_state.encode('utf-8'), digest_size=16).hexdigest()
+    params = json.dumps(params, sort_keys=True)
+    param_hash = hashlib.blake2b(params.encode('utf-8'), digest_size=8).hexdigest()
+    return f"{file_hash}-{param_hash}"
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def evict(cache_dir=None, max_size=None, keep=None):
+    """ Remove the least recently used entries until the cache is smaller than max_size.
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_size = CACHE_SIZE if max_size is None else max_size
+    if not os.path.exists(cache_dir):
+        return
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if not name.startswith(TMP_PREFIX)]
+    entries = [entry for entry in entries if os.path.isdir(entry) and entry != keep]
+    entries.sort(key=os.path.getmtime)
+
+    sizes = [_entry_size(entry) for entry in entries]
+    total_size = sum(sizes) + (0 if keep is None else _entry_size(keep))
+    for entry, size in zip(entries, sizes):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
+
+
+def save_to_cache(key, data, cache_dir=None, max_size=None):
+    """ Save the arrays in data to the cache.
+
+    The values of data can be arrays or lists of arrays (for multiscale data).
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_size = CACHE_SIZE if max_size is None else max_size
+    if max_size <= 0:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(entry):
+        return
+
+    # write to a temporary directory first, so that we never load incomplete entries
+    tmp_entry = tempfile.mkdtemp(dir=cache_dir, prefix=TMP_PREFIX)
+    index = {}
+    for name, value in data.items():
+        if isinstance(value, list):
+            index[name] = len(value)
+            for scale, array in enumerate(value):
+                np.save(os.path.join(tmp_entry, f'{name}-s{scale}.npy'), np.asarray(array))
+        else:
+            index[name] = None
+            np.save(os.path.join(tmp_entry, f'{name}.npy'), np.asarray(value))
+    with open(os.path.join(tmp_entry, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another process has written the same entry in the meantime
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return
+    evict(cache_dir, max_size, keep=entry)
+
+
+def load_from_cache(key, mmap=(), cache_dir=None):
+    """ Load the data for key from the cache, returns None if it is not cached.
+
+    The arrays with names in mmap are loaded as read-only memory maps.
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    entry = os.path.join(cache_dir, key)
+    index_path = os.path.join(entry, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        index = json.load(f)
+
+    def _load(file_name, name):
+        return np.load(os.path.join(entry, file_name), mmap_mode='r' if name in mmap else None)
+
+    data = {}
+    for name, n_scales in index.items():
+        if n_scales is None:
+            data[name] = _load(f'{name}.npy', name)
+        else:
+            data[name] = [_load(f'{name}-s{scale}.npy', name) for scale in range(n_scales)]
+
+    # mark the entry as recently used
+    os.utime(entry)
+    return data
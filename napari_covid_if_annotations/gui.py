@@ -1,11 +1,19 @@
 import os
+from qtpy.QtCore import QTimer
 from qtpy.QtWidgets import QLabel, QPushButton, QCheckBox
 from ._key_bindings import (
+    get_saver,
     update_layers,
     toggle_hide_annotated_segments,
     paint_new_label,
     _save_labels,
 )
+from .profiling import DEFAULT_DUMP_PATH, TIMINGS
+
+# interval for updating the save status in milliseconds
+SAVE_STATUS_INTERVAL = 250
+# number of operations for which the timings are shown
+N_TIMINGS_SHOWN = 5
 
 
 def connect_to_viewer(viewer):
@@ -15,6 +23,43 @@ def connect_to_viewer(viewer):
     save_gui_btn = QPushButton("save annotations [shift + s]")
     save_gui_btn.clicked.connect(lambda: _save_labels(viewer))
 
+    # show the status of the saves that run in the background
+    save_status = QLabel()
+
+    def update_save_status():
+        message = get_saver(viewer).status_message()
+        if message.startswith("save failed"):
+            message = f"<font color='red'>{message}</font>"
+        save_status.setText(message)
+    update_save_status()
+    save_status_timer = QTimer(save_status)
+    save_status_timer.timeout.connect(update_save_status)
+    save_status_timer.start(SAVE_STATUS_INTERVAL)
+
+    # show the timings of the last operations, e.g. updating the layers or saving
+    timings = QLabel()
+    timings.setToolTip("time of the last operations and their stages in ms")
+
+    def update_timings():
+        timings.setText(TIMINGS.summary(N_TIMINGS_SHOWN))
+    update_timings()
+    save_status_timer.timeout.connect(update_timings)
+
+    # show where the timings were written in the dock and in the status bar
+    dump_status = QLabel()
+
+    def dump_timings():
+        path = os.path.abspath(DEFAULT_DUMP_PATH)
+        try:
+            message = f"wrote {TIMINGS.dump(path)} timings to {path}"
+            dump_status.setText(message)
+        except OSError as e:
+            message = f"writing the timings to {path} failed: {e}"
+            dump_status.setText(f"<font color='red'>{message}</font>")
+        viewer.status = message
+    dump_timings_btn = QPushButton("dump timings")
+    dump_timings_btn.clicked.connect(dump_timings)
+
     update_gui_btn = QPushButton("update layers [u]")
     update_gui_btn.clicked.connect(lambda: update_layers(viewer))
 
@@ -44,7 +89,22 @@ def connect_to_viewer(viewer):
         tooltip.setText(qtext)
 
     viewer.window.add_dock_widget(
-        [tooltip, update_gui_btn, hide_gui_btn, paint_gui_btn, save_gui_btn],
+        [tooltip, update_gui_btn, hide_gui_btn, paint_gui_btn, save_gui_btn, save_status,
+         timings, dump_timings_btn, dump_status],
+        area="right",
+        allowed_areas=["right", "left"],
+    )
+
+
+def add_session_controls(viewer, show_next_image):
+    """ Add the gui elements for proofreading sessions with several images.
+    """
+    next_gui_btn = QPushButton("next image [shift + n]")
+    next_gui_btn.clicked.connect(lambda: show_next_image(viewer))
+    viewer.bind_key('Shift-N', show_next_image)
+
+    viewer.window.add_dock_widget(
+        [next_gui_btn],
         area="right",
         allowed_areas=["right", "left"],
     )
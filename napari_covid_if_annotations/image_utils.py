@@ -1,7 +1,6 @@
 import numpy as np
-from scipy.ndimage.morphology import binary_dilation
-from skimage.measure import regionprops
-from skimage.segmentation import find_boundaries
+
+from .profiling import timed_stage
 
 
 def normalize(im):
@@ -19,33 +18,209 @@ def quantile_normalize(im, low=.01, high=.99):
     return np.clip(im, 0., 1.)
 
 
+def use_histogram(im):
+    """ Check if the statistics of the image can be computed from a dense histogram of its values.
+    """
+    return im.dtype.kind == 'u' and im.dtype.itemsize <= 2
+
+
+def get_sorted_values(hist, ranks):
+    """ Get the values at the given ranks of the sorted data from its histogram.
+    """
+    return np.searchsorted(np.cumsum(hist), ranks, side='right')
+
+
+def histogram_quantile(hist, q):
+    """ Compute the quantile from a histogram of integer values, same as np.quantile.
+    """
+    pos = (hist.sum() - 1) * q
+    low, high = get_sorted_values(hist, [int(np.floor(pos)), int(np.ceil(pos))])
+    return low + (pos - np.floor(pos)) * (high - low)
+
+
+def downscale_image(image, is_label=False, factor=2, n_axes=None):
+    """ Downscale the image by factor along the first n_axes axes (all axes by default).
+
+    Uses the mean of the blocks for intensity images and nearest neighbor
+    downscaling for label images, so that no new label ids are introduced.
+    """
+    n_axes = image.ndim if n_axes is None else n_axes
+    if is_label:
+        return image[tuple(slice(None, None, factor) for _ in range(n_axes))]
+
+    # pad to a multiple of the factor so that we can compute the block means with a reshape
+    padding = [(0, -sh % factor) for sh in image.shape[:n_axes]] + [(0, 0)] * (image.ndim - n_axes)
+    if any(pad for _, pad in padding):
+        image = np.pad(image, padding, mode='edge')
+    block_shape = sum(((sh // factor, factor) for sh in image.shape[:n_axes]), ()) + image.shape[n_axes:]
+    downscaled = image.reshape(block_shape).mean(axis=tuple(range(1, 2 * n_axes, 2)))
+    if np.issubdtype(image.dtype, np.integer):
+        downscaled = np.round(downscaled)
+    return downscaled.astype(image.dtype)
+
+
+def get_boundaries(seg):
+    """ Get the thick boundaries between segments, same as find_boundaries(seg, mode='thick').
+
+    Computed by comparing all pixels with their direct neighbors, which is much
+    cheaper than the grey dilation and erosion used by find_boundaries.
+    """
+    boundaries = np.zeros(seg.shape, dtype='bool')
+    for axis in range(seg.ndim):
+        lower = tuple(slice(None, -1) if ax == axis else slice(None) for ax in range(seg.ndim))
+        upper = tuple(slice(1, None) if ax == axis else slice(None) for ax in range(seg.ndim))
+        diff = seg[lower] != seg[upper]
+        boundaries[lower] |= diff
+        boundaries[upper] |= diff
+    return boundaries
+
+
 def get_edge_segmentation(seg, edge_width):
     edge_seg = seg.copy()
-    boundaries = find_boundaries(seg, mode='thick')
+    boundaries = get_boundaries(seg)
     if edge_width > 1:
+        from scipy.ndimage import binary_dilation
         boundaries = binary_dilation(boundaries, iterations=edge_width-1)
     edge_seg[~boundaries] = 0
     return edge_seg
 
 
+def update_edge_segmentation(edge_seg, seg, edge_width, bb):
+    """ Recompute the edge segmentation in-place for the pixels affected by changes inside of bb.
+
+    Returns the bounding box of the region of edge_seg that was rewritten.
+    """
+    # the boundaries depend on the segmentation within edge_width of a pixel,
+    # so changes in bb affect the edges up to edge_width pixels outside of it and
+    # we need to compute them with a halo of the same size around that region
+    affected_bb = expand_bounding_box(bb, edge_width, seg.shape)
+    outer_bb = expand_bounding_box(bb, 2 * edge_width + 1, seg.shape)
+    local_bb = tuple(slice(aff.start - out.start, aff.stop - out.start)
+                     for aff, out in zip(affected_bb, outer_bb))
+    edge_seg[affected_bb] = get_edge_segmentation(seg[outer_bb], edge_width)[local_bb]
+    return affected_bb
+
+
+def expand_bounding_box(bb, margin, shape):
+    return tuple(slice(max(b.start - margin, 0), min(b.stop + margin, sh))
+                 for b, sh in zip(bb, shape))
+
+
+def get_bounding_box(mask):
+    """ Get the bounding box of the foreground in a binary mask, None if it is empty.
+    """
+    bb = []
+    for axis in range(mask.ndim):
+        projection = np.flatnonzero(mask.any(axis=tuple(ax for ax in range(mask.ndim) if ax != axis)))
+        if projection.size == 0:
+            return None
+        bb.append(slice(int(projection[0]), int(projection[-1]) + 1))
+    return tuple(bb)
+
+
+def compute_label_sums(ids, coordinates, n_ids=0):
+    """ Compute the pixel counts and coordinate sums per id with np.bincount.
+
+    ids is a flat array of label ids and coordinates a list with the
+    matching flat coordinate array for each axis. The results are indexed by id.
+    """
+    ids = ids.astype('int64', copy=False)
+    counts = np.bincount(ids, minlength=n_ids)
+    sums = np.stack([np.bincount(ids, weights=coords, minlength=n_ids)
+                     for coords in coordinates], axis=1)
+    return counts, sums
+
+
+def get_label_sums(seg):
+    """ Compute the pixel counts and coordinate sums for all ids in the segmentation.
+    """
+    coordinates = []
+    for axis, size in enumerate(seg.shape):
+        coord_shape = [1] * seg.ndim
+        coord_shape[axis] = size
+        coords = np.arange(size, dtype='float64').reshape(coord_shape)
+        coordinates.append(np.broadcast_to(coords, seg.shape).ravel())
+    return compute_label_sums(seg.ravel(), coordinates)
+
+
+def get_ids_and_centroids(seg):
+    """ Compute the segment ids and centroids from the pixel counts and coordinate sums per id.
+
+    The centroids are aligned with the foreground ids, i.e. with np.unique(seg)[1:]
+    if the segmentation has background, which is the same order as for regionprops.
+    """
+    if seg.size > 0 and seg.max() >= MAX_DENSE_LUT_SIZE:
+        # the sums are indexed by id, so we need to relabel large ids consecutively
+        seg_ids, consecutive_seg = np.unique(seg, return_inverse=True)
+        counts, sums = get_label_sums(consecutive_seg.reshape(seg.shape))
+    else:
+        counts, sums = get_label_sums(seg)
+        seg_ids = np.flatnonzero(counts).astype(seg.dtype)
+        counts, sums = counts[seg_ids], sums[seg_ids]
+
+    foreground = seg_ids != 0
+    centroids = sums[foreground] / counts[foreground, None]
+    return seg_ids, centroids
+
+
+def get_seg_ids(seg):
+    """ Get the sorted ids of the segmentation, same as np.unique(seg) but faster for small ids.
+    """
+    if seg.size == 0 or seg.max() >= MAX_DENSE_LUT_SIZE:
+        return np.unique(seg)
+    return np.flatnonzero(np.bincount(seg.ravel())).astype(seg.dtype)
+
+
+def get_segmentation_features(seg, edge_width):
+    """ Compute the segment ids, centroids and edge segmentation with a single sweep over the segmentation.
+    """
+    with timed_stage('ids_and_centroids'):
+        seg_ids, centroids = get_ids_and_centroids(seg)
+    with timed_stage('boundaries'):
+        edges = get_edge_segmentation(seg, edge_width)
+    return seg_ids, centroids, edges
+
+
 def get_centroids(seg):
-    props = regionprops(seg)
-    return np.array([prop['centroid'] for prop in props])
+    _, centroids = get_ids_and_centroids(seg)
+    return centroids
+
+
+# the largest id for which we map values with a dense lookup table,
+# for larger ids we use a sparse mapping based on np.searchsorted instead
+MAX_DENSE_LUT_SIZE = 2 ** 24
+
+
+def map_values(x, keys, values):
+    """ Map the values of x to new values, where keys must be sorted and contain all values of x.
+
+    Uses a dense lookup table if the largest key is small enough and a sparse
+    mapping with np.searchsorted otherwise, so we never need to sort x.
+    """
+    if len(keys) > 0 and keys[-1] < MAX_DENSE_LUT_SIZE:
+        lut = np.zeros(int(keys[-1]) + 1, dtype=values.dtype)
+        lut[keys] = values
+        return lut[x]
+    return values[np.searchsorted(keys, x)]
 
 
 def apply_dict_to_array(x, my_dict):
-    unique_values, inverse_indices = np.unique(x, return_inverse=True)
-    return np.array([my_dict[val] for val in unique_values])[inverse_indices].reshape(x.shape)
+    keys = np.array(sorted(my_dict.keys()))
+    values = np.array([my_dict[key] for key in keys])
+    return map_values(x, keys, values)
 
 
 def map_labels_to_edges(edges, seg_ids, labels, hide_ids=None, remap_background=None):
     assert len(seg_ids) == len(labels)
-    replace_dict = dict(zip(seg_ids, labels))
+    seg_ids, labels = np.asarray(seg_ids), np.asarray(labels)
+    hide_ids = np.zeros(0, dtype=seg_ids.dtype) if hide_ids is None else np.asarray(hide_ids, dtype=seg_ids.dtype)
+    background = np.zeros(1, dtype=seg_ids.dtype)
 
-    if hide_ids is not None:
-        for hide_id in hide_ids:
-            replace_dict[hide_id] = 0 if remap_background is None else remap_background
+    keys = np.union1d(np.union1d(seg_ids, hide_ids), background)
+    values = np.zeros(len(keys), dtype=labels.dtype)
+    values[np.searchsorted(keys, seg_ids)] = labels
+    values[np.searchsorted(keys, hide_ids)] = 0 if remap_background is None else remap_background
     if remap_background is not None:
-        replace_dict[0] = remap_background
+        values[0] = remap_background
 
-    return apply_dict_to_array(edges, replace_dict)
+    return map_values(edges, keys, values)
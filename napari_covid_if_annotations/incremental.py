@@ -0,0 +1,213 @@
+"""
+Incremental computation of the data derived from the cell segmentation.
+
+Painting usually only changes a few cells, so instead of recomputing the
+segment ids, centroids and edges for the whole image on every update,
+we keep the pixel counts and coordinate sums per id and the edge segmentation
+from the last update and only recompute them for the regions that were changed since.
+"""
+import numpy as np
+
+from .image_utils import (MAX_DENSE_LUT_SIZE, compute_label_sums, expand_bounding_box,
+                          get_bounding_box, get_edge_segmentation,
+                          get_label_sums, update_edge_segmentation)
+from .profiling import timed_stage
+
+# if the modified regions cover more than this fraction of the image,
+# recomputing everything is faster than the incremental update
+FULL_UPDATE_FRACTION = 0.25
+
+
+def _overlaps(bb_a, bb_b):
+    return all(a.start <= b.stop and b.start <= a.stop for a, b in zip(bb_a, bb_b))
+
+
+def _merge(bb_a, bb_b):
+    return tuple(slice(min(a.start, b.start), max(a.stop, b.stop)) for a, b in zip(bb_a, bb_b))
+
+
+def _size(bb):
+    return int(np.prod([b.stop - b.start for b in bb]))
+
+
+def get_brush_bounding_box(coord, brush_size, shape):
+    """ Get the bounding box of the pixels a brush stroke at coord can change.
+    """
+    coord = coord[-len(shape):]
+    radius = brush_size / 2. + 1
+    bb = tuple(slice(int(np.floor(c - radius)), int(np.ceil(c + radius)) + 1) for c in coord)
+    return expand_bounding_box(bb, 0, shape)
+
+
+class DirtyRegions:
+    """ Bounding boxes of the segmentation regions that were modified since the last update.
+
+    If the modified region is not known, e.g. after a fill operation, mark_unknown
+    needs to be called, so that the changes are found by comparing with the last state.
+    """
+    def __init__(self):
+        self.bounding_boxes = []
+        self.unknown = False
+
+    def add(self, bb):
+        # merge with all overlapping boxes to keep the number of regions small
+        # (subsequent brush strokes mostly overlap)
+        remaining = []
+        for other in self.bounding_boxes:
+            if _overlaps(bb, other):
+                bb = _merge(bb, other)
+            else:
+                remaining.append(other)
+        remaining.append(bb)
+        self.bounding_boxes = remaining
+
+    def mark_unknown(self):
+        self.unknown = True
+
+    def clear(self):
+        self.bounding_boxes = []
+        self.unknown = False
+
+
+class SegmentationCache:
+    """ Segment ids, centroids and edges of a segmentation that can be updated incrementally.
+
+    Keeps a copy of the segmentation at the last update, which is used to
+    find the pixels that were changed inside of the dirty regions.
+    The pixel counts and coordinate sums are indexed by id; for large ids they are
+    indexed by the position of the id in the sorted array ids instead.
+    """
+    def __init__(self, seg, edge_width):
+        self.edge_width = edge_width
+        self.recompute(seg)
+
+    def recompute(self, seg):
+        self.source = seg
+        self.seg = seg.copy()
+        with timed_stage('ids_and_centroids'):
+            if seg.size > 0 and seg.max() >= MAX_DENSE_LUT_SIZE:
+                self.ids, consecutive_seg = np.unique(seg, return_inverse=True)
+                self.counts, self.sums = get_label_sums(consecutive_seg.reshape(seg.shape))
+            else:
+                self.ids = None
+                self.counts, self.sums = get_label_sums(seg)
+        with timed_stage('boundaries'):
+            self.edges = get_edge_segmentation(seg, self.edge_width)
+
+    def is_valid(self, seg, edge_width):
+        # the cache becomes invalid if the layer data was replaced
+        return seg is self.source and seg.shape == self.seg.shape and edge_width == self.edge_width
+
+    @property
+    def seg_ids(self):
+        index = np.flatnonzero(self.counts)
+        return index.astype(self.seg.dtype) if self.ids is None else self.ids[index]
+
+    @property
+    def centroids(self):
+        index = np.flatnonzero(self.counts)
+        ids = index if self.ids is None else self.ids[index]
+        index = index[ids != 0]
+        return self.sums[index] / self.counts[index, None]
+
+    def _grow(self, n_ids):
+        n_prev = len(self.counts)
+        if n_ids <= n_prev:
+            return
+        self.counts = np.concatenate([self.counts, np.zeros(n_ids - n_prev, dtype=self.counts.dtype)])
+        self.sums = np.concatenate([self.sums, np.zeros((n_ids - n_prev, self.sums.shape[1]),
+                                                        dtype=self.sums.dtype)])
+
+    def _get_index(self, ids):
+        """ Get the index of the ids in counts and sums, adding the ids that are not in the cache yet.
+        """
+        if self.ids is None:
+            max_id = int(ids.max())
+            if max_id < MAX_DENSE_LUT_SIZE:
+                self._grow(max_id + 1)
+                return ids
+            # a large id was painted, so we switch to indexing by position
+            index = np.flatnonzero(self.counts)
+            self.ids = index.astype(self.seg.dtype)
+            self.counts, self.sums = self.counts[index], self.sums[index]
+
+        all_ids = np.union1d(self.ids, ids)
+        if len(all_ids) > len(self.ids):
+            index = np.searchsorted(all_ids, self.ids)
+            counts = np.zeros(len(all_ids), dtype=self.counts.dtype)
+            sums = np.zeros((len(all_ids), self.sums.shape[1]), dtype=self.sums.dtype)
+            counts[index], sums[index] = self.counts, self.sums
+            self.ids, self.counts, self.sums = all_ids, counts, sums
+        return np.searchsorted(self.ids, ids)
+
+    def _update_region(self, seg, bb):
+        old, new = self.seg[bb], seg[bb]
+        changed = old != new
+        changed_bb = get_bounding_box(changed)
+        if changed_bb is None:
+            return None
+
+        coords = np.nonzero(changed)
+        old_ids, new_ids = old[coords], new[coords]
+        coords = [coord + b.start for coord, b in zip(coords, bb)]
+
+        with timed_stage('ids_and_centroids'):
+            # the index of both needs to be computed together, because adding ids can change the indexing
+            index = self._get_index(np.concatenate([old_ids, new_ids]))
+            old_index, new_index = index[:len(old_ids)], index[len(old_ids):]
+            n_ids = len(self.counts)
+            old_counts, old_sums = compute_label_sums(old_index, coords, n_ids)
+            new_counts, new_sums = compute_label_sums(new_index, coords, n_ids)
+            self.counts += new_counts - old_counts
+            self.sums += new_sums - old_sums
+
+        self.seg[bb] = new
+        changed_bb = tuple(slice(b.start + ch.start, b.start + ch.stop) for b, ch in zip(bb, changed_bb))
+        with timed_stage('boundaries'):
+            return update_edge_segmentation(self.edges, seg, self.edge_width, changed_bb)
+
+    def update(self, seg, bounding_boxes=None):
+        """ Update the cache for changes of seg inside of the bounding boxes.
+
+        If bounding_boxes is None, the changed region is found by comparing with the
+        last state. Returns the list of regions where the edges have changed or None
+        if everything was recomputed.
+        """
+        if bounding_boxes is None:
+            with timed_stage('find_changes'):
+                bounding_boxes = [get_bounding_box(seg != self.seg)]
+            bounding_boxes = [bb for bb in bounding_boxes if bb is not None]
+
+        if sum(_size(bb) for bb in bounding_boxes) > FULL_UPDATE_FRACTION * seg.size:
+            self.recompute(seg)
+            return None
+
+        updated = [self._update_region(seg, bb) for bb in bounding_boxes]
+        return [bb for bb in updated if bb is not None]
+
+
+def update_segmentation_cache(cache, seg, edge_width, dirty_regions=None):
+    """ Bring the cache up to date with the segmentation, recomputing everything if necessary.
+
+    Returns the (new) cache and the regions where the edges have changed
+    or None if everything was recomputed.
+    The segmentation can also be changed outside of the dirty regions without marking them,
+    e.g. by undo or by writing to the layer data directly, so we check that the cached segmentation
+    is in sync after updating the dirty regions and find the other changes by comparing otherwise.
+    """
+    if cache is None or not cache.is_valid(seg, edge_width):
+        cache = SegmentationCache(seg, edge_width)
+        updated_regions = None
+    elif dirty_regions is None or dirty_regions.unknown:
+        updated_regions = cache.update(seg)
+    else:
+        updated_regions = cache.update(seg, dirty_regions.bounding_boxes)
+        with timed_stage('find_changes'):
+            in_sync = updated_regions is None or np.array_equal(cache.seg, seg)
+        if not in_sync:
+            untracked_regions = cache.update(seg)
+            updated_regions = None if untracked_regions is None else updated_regions + untracked_regions
+
+    if dirty_regions is not None:
+        dirty_regions.clear()
+    return cache, updated_regions
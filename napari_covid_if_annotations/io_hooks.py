@@ -9,16 +9,13 @@ see: https://napari.org/docs/plugins/hook_specifications.html
 Replace code below accordingly.  For complete documentation see:
 https://napari.org/docs/plugins/for_plugin_developers.html
 """
-import os
-
-import h5py
-
 from napari_plugin_engine import napari_hook_implementation
 
-from .layers import get_layers_from_file, save_labels, load_labels
+from .io_utils import get_file_type, open_file
+from .profiling import timed
 
-
-H5_EXTS = ['.hdf', '.hdf5', '.h5']
+# NOTE the layers and key bindings are only imported when a file is read or written,
+# so that napari can import the plugin without importing vispy, dask and napari internals
 
 
 # NOTE this doesn't work yet, but also doesn'make much sense in this context
@@ -27,12 +24,12 @@ def napari_get_writer(path, layers):
 
     print("Hook!")
 
-    ext = os.path.splitext(path)[1]
-    if not ext.lower() in H5_EXTS:
+    if get_file_type(path) is None:
         return None
 
     # make sure we have exactly one labels layer
     if any(layer == 'labels' for layer in layers):
+        from .layers import save_labels
         return save_labels
 
     return None
@@ -60,12 +57,14 @@ def napari_get_reader(path):
         path = path[0]
 
     # if we know we cannot read the file, we immediately return None.
-    if not os.path.splitext(path)[1].lower() in H5_EXTS:
+    # zarr and n5 containers are directories, so we only check the extension
+    if get_file_type(path) is None:
         return None
 
     return reader_function
 
 
+@timed()
 def reader_function(path):
     """Take a path or list of paths and return a list of LayerData tuples.
 
@@ -88,17 +87,21 @@ def reader_function(path):
         Both "meta", and "layer_type" are optional. napari will default to
         layer_type=="image" if not provided
     """
-    # can only read a single h5 input file
+    # can only read a single h5 file or zarr / n5 container
     if not isinstance(path, str):
         return None
 
+    from .layers import get_layers_from_file, load_labels
+    # importing the key bindings registers them for the viewer
+    from . import _key_bindings  # noqa
+
     layers = []
 
-    with h5py.File(path, 'r') as f:
+    with open_file(path, 'r') as f:
         # check if we have raw data
         # -> load all data
         if 'serum_IgG' in f:
-            layers = get_layers_from_file(f)
+            layers = get_layers_from_file(f, use_cache=True)
         # otherwise, we only have labels
         # -> load them
         else:
@@ -1,15 +1,38 @@
 import json
 import os
+import sys
 
 import h5py
 import numpy as np
-import pandas as pd
 
-DEFAULT_CHUNKS = tuple(json.loads(os.environ.get('DEFAULT_CHUNKS', '[256, 256]')))
+from .image_utils import downscale_image
+
+# hdf5plugin registers the blosc and zstd filters, so they can be used for reading and writing
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# NOTE we import dask and zarr only when they are needed, so that the
+# reader hook and the batch scripts start fast, see benchmarks/bench_import_time.py
 
+H5_EXTS = ['.hdf', '.hdf5', '.h5']
+ZARR_EXTS = ['.zarr']
+N5_EXTS = ['.n5']
 
-def get_default_chunks(data):
-    chunks = DEFAULT_CHUNKS
+DEFAULT_CHUNKS = tuple(json.loads(os.environ.get('DEFAULT_CHUNKS', '[256, 256]')))
+# compression for the datasets that are written, one of 'gzip', 'lzf', 'none',
+# 'blosc' or 'zstd' (require hdf5plugin), optionally with the level, e.g. 'gzip:1'
+DEFAULT_COMPRESSION = os.environ.get('DEFAULT_COMPRESSION', 'gzip')
+COMPRESSIONS = ('gzip', 'lzf', 'none', 'blosc', 'zstd')
+# files larger than this (in bytes) are loaded lazily by default
+LAZY_LOADING_THRESHOLD = int(os.environ.get('LAZY_LOADING_THRESHOLD', 256 * 1024 ** 2))
+# number of h5 chunks per axis that are combined into one chunk of a lazy array
+LAZY_CHUNK_FACTOR = 4
+
+
+def get_default_chunks(data, chunks=None):
+    chunks = DEFAULT_CHUNKS if chunks is None else tuple(chunks)
     shape = data.shape
 
     len_diff = len(shape) - len(chunks)
@@ -21,42 +44,301 @@ def get_default_chunks(data):
     return chunks
 
 
+def set_write_options(compression=None, chunks=None):
+    """ Set the default compression and chunks for the datasets that are written.
+    """
+    global DEFAULT_COMPRESSION, DEFAULT_CHUNKS
+    if compression is not None:
+        get_compression_options(compression)
+        DEFAULT_COMPRESSION = compression
+    if chunks is not None:
+        DEFAULT_CHUNKS = tuple(chunks)
+
+
+def get_compression_options(compression=None):
+    """ Get the keyword arguments for h5py.Group.create_dataset for the compression.
+    """
+    compression = DEFAULT_COMPRESSION if compression is None else compression
+    name, _, level = compression.partition(':')
+    level = int(level) if level else None
+    if name not in COMPRESSIONS:
+        raise ValueError(f"Invalid compression {compression}, expected one of {COMPRESSIONS}")
+    if level is not None and name in ('lzf', 'none'):
+        raise ValueError(f"Compression {name} does not support a compression level")
+
+    if name == 'none':
+        return {}
+    if name == 'lzf':
+        return {'compression': 'lzf'}
+    if name == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if level is None else level}
+
+    if hdf5plugin is None:
+        raise ValueError(f"Compression {name} requires hdf5plugin, which is not installed")
+    if name == 'blosc':
+        filter_ = hdf5plugin.Blosc(cname='zstd', clevel=5 if level is None else level,
+                                   shuffle=hdf5plugin.Blosc.SHUFFLE)
+    else:
+        filter_ = hdf5plugin.Zstd(clevel=3 if level is None else level)
+    return dict(filter_)
+
+
+def _import_zarr():
+    # zarr is optional and only needed to read and write zarr or n5 containers
+    try:
+        import zarr
+    except ImportError:
+        raise ValueError("Reading or writing zarr or n5 containers requires zarr, which is not installed")
+    return zarr
+
+
+def _loaded_zarr():
+    # zarr objects can only exist if zarr has been imported already
+    return sys.modules.get('zarr')
+
+
+def get_zarr_compressor(compression=None):
+    """ Get the numcodecs compressor corresponding to the compression.
+    """
+    _import_zarr()
+    import numcodecs
+    compression = DEFAULT_COMPRESSION if compression is None else compression
+    name, _, level = compression.partition(':')
+    level = int(level) if level else None
+    if name not in COMPRESSIONS:
+        raise ValueError(f"Invalid compression {compression}, expected one of {COMPRESSIONS}")
+
+    if name == 'none':
+        return None
+    if name == 'gzip':
+        return numcodecs.GZip(level=4 if level is None else level)
+    if name == 'blosc':
+        return numcodecs.Blosc(cname='zstd', clevel=5 if level is None else level,
+                               shuffle=numcodecs.Blosc.SHUFFLE)
+    if name == 'zstd':
+        return numcodecs.Zstd(level=3 if level is None else level)
+    raise ValueError(f"Compression {name} is not supported for zarr or n5")
+
+
+def get_file_type(path):
+    ext = os.path.splitext(path.rstrip('/'))[1].lower()
+    if ext in H5_EXTS:
+        return 'h5'
+    if ext in ZARR_EXTS:
+        return 'zarr'
+    if ext in N5_EXTS:
+        return 'n5'
+    return None
+
+
+def open_file(path, mode='r'):
+    """ Open a h5 file or a zarr or n5 container, depending on the file extension.
+
+    The returned object is used as a context manager, like h5py.File.
+    """
+    file_type = get_file_type(path)
+    if file_type == 'h5':
+        return h5py.File(path, mode)
+    if file_type is None:
+        raise ValueError(f"Invalid file extension for {path}, expected one of {H5_EXTS + ZARR_EXTS + N5_EXTS}")
+    zarr = _import_zarr()
+    if mode == 'r' and not os.path.exists(path):
+        raise FileNotFoundError(path)
+    store = zarr.N5Store(path) if file_type == 'n5' else zarr.DirectoryStore(path)
+    return zarr.open_group(store, mode=mode)
+
+
+def is_h5(obj):
+    return isinstance(obj, (h5py.File, h5py.Group, h5py.Dataset))
+
+
+def is_n5(obj):
+    zarr = _loaded_zarr()
+    return zarr is not None and not is_h5(obj) and isinstance(obj.store, zarr.N5Store)
+
+
+def get_file_path(f):
+    """ Get the path of an open h5 file or zarr container.
+    """
+    return f.filename if is_h5(f) else f.store.path
+
+
+def get_file_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
 def is_dataset(obj):
     if isinstance(obj, h5py.Dataset):
         return True
-    return False
+    zarr = _loaded_zarr()
+    return zarr is not None and isinstance(obj, zarr.Array)
 
 
 def is_group(obj):
     if isinstance(obj, h5py.Group):
         return True
-    return False
+    zarr = _loaded_zarr()
+    return zarr is not None and isinstance(obj, zarr.Group)
+
+
+def require_dataset(g, name, shape, dtype, chunks=None, compression=None):
+    """ Get or create the dataset in a h5 or zarr group with the given compression.
+    """
+    if is_h5(g):
+        return g.require_dataset(name, shape=shape, dtype=dtype, chunks=chunks,
+                                 **get_compression_options(compression))
+    return g.require_dataset(name, shape=shape, dtype=dtype, chunks=True if chunks is None else chunks,
+                             compressor=get_zarr_compressor(compression))
+
+
+def load_lazy(f):
+    """ Check whether the file is large enough to load the images lazily.
+    """
+    return get_file_size(get_file_path(f)) > LAZY_LOADING_THRESHOLD
+
+
+class LazyDataset:
+    """ Read-only array-like wrapper around a h5 dataset that opens the file for each read.
+
+    This allows wrapping the dataset in a dask array that stays valid after
+    the file it was read from has been closed.
+    """
+    def __init__(self, ds):
+        self.path, self.key = ds.file.filename, ds.name
+        self.shape, self.dtype, self.chunks = ds.shape, ds.dtype, ds.chunks
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, index):
+        with h5py.File(self.path, 'r') as f:
+            return f[self.key][index]
+
+
+def _read_lazy(ds):
+    import dask.array as da
+    if ds.chunks is None:
+        chunks = 'auto'
+    else:
+        chunks = tuple(min(LAZY_CHUNK_FACTOR * ch, sh) for ch, sh in zip(ds.chunks, ds.shape))
+    # zarr arrays can be read concurrently and stay valid, so we can wrap them directly
+    return da.from_array(LazyDataset(ds) if is_h5(ds) else ds, chunks=chunks)
+
+
+def read_mmap(ds):
+    """ Get a read-only memory map of a h5 dataset, or None if the dataset cannot be memory mapped.
+
+    Only datasets that are stored contiguous and uncompressed in the file can be memory mapped.
+    """
+    if not is_h5(ds) or ds.chunks is not None or ds.external is not None:
+        return None
+    if ds.file.driver not in ('sec2', 'stdio') or ds.dtype.kind not in 'biuf':
+        return None
+    # the offset is None if the data has not been written yet
+    offset = ds.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(ds.file.filename, mode='r', dtype=ds.dtype, shape=ds.shape, offset=offset)
 
 
 # read/write images
-def read_image(f, key, scale=0, channel=None):
+def read_image(f, key, scale=0, channel=None, lazy=False, mmap=False):
+    """ Read image data from the file.
+
+    If lazy is True a dask array is returned that only reads the chunks
+    of the dataset when they are accessed.
+    If mmap is True and the dataset is stored contiguous and uncompressed,
+    it is returned as read-only memory map instead of being loaded into memory.
+    """
     ds = f[key]
     if is_group(ds):
         ds = ds['s%i' % scale]
     assert is_dataset(ds)
+    data = read_mmap(ds) if mmap else None
+    if data is not None:
+        if lazy:
+            import dask.array as da
+            data = da.from_array(data, chunks='auto')
+        return data if channel is None else data[channel]
+    if lazy:
+        data = _read_lazy(ds)
+        return data if channel is None else data[channel]
     data = ds[:] if channel is None else ds[channel]
     return data
 
 
-def _write_single_scale(g, out_key, image):
-    chunks = get_default_chunks(image)
-    ds = g.require_dataset(out_key, shape=image.shape, dtype=image.dtype,
-                           compression='gzip', chunks=chunks)
+def get_changed_chunks(image, reference, chunks):
+    """ Get the bounding boxes of all chunks in which image and reference differ.
+    """
+    grid = tuple((sh + ch - 1) // ch for sh, ch in zip(image.shape, chunks))
+    padding = [(0, gr * ch - sh) for gr, ch, sh in zip(grid, chunks, image.shape)]
+    changed = np.pad(image != reference, padding)
+    block_shape = sum(((gr, ch) for gr, ch in zip(grid, chunks)), ())
+    changed = changed.reshape(block_shape).any(axis=tuple(range(1, 2 * image.ndim, 2)))
+    return [tuple(slice(i * ch, min((i + 1) * ch, sh)) for i, ch, sh in zip(block_id, chunks, image.shape))
+            for block_id in zip(*np.nonzero(changed))]
+
+
+def _write_single_scale(g, out_key, image, only_changed=False, reference=None,
+                        compression=None, chunks=None, contiguous=False):
+    if only_changed and out_key in g:
+        ds = g[out_key]
+        if ds.shape == image.shape and ds.dtype == image.dtype and ds.chunks is not None:
+            if reference is None:
+                reference = ds[:]
+            # only rewrite (and recompress) the chunks that have changed
+            for bb in get_changed_chunks(image, reference, ds.chunks):
+                ds[bb] = image[bb]
+            return ds
+
+    if contiguous and is_h5(g):
+        ds = g.require_dataset(out_key, shape=image.shape, dtype=image.dtype)
+    else:
+        ds = require_dataset(g, out_key, image.shape, image.dtype,
+                             chunks=get_default_chunks(image, chunks), compression=compression)
     ds[:] = image
     return ds
 
 
-def write_image(f, name, image, viewer_settings={}):
+def write_image(f, name, image, viewer_settings={}, n_scales=1, is_label=False,
+                only_changed=False, reference=None, compression=None, chunks=None, contiguous=False):
+    """ Write image to the group name/s0.
+
+    If n_scales is larger than one, also write a pyramid downscaled by a factor of two
+    per scale to name/s1, name/s2, ..., using nearest neighbor downscaling for label images.
+    If only_changed is True and the image exists already, only the chunks of s0 that differ
+    from reference are written. If no reference is given, the data in the file is used.
+    The compression and chunks default to DEFAULT_COMPRESSION and DEFAULT_CHUNKS.
+    If contiguous is True, h5 datasets are written contiguous and uncompressed instead,
+    so that they can be memory mapped when reading them.
+    """
     g = f.require_group(name)
-    _write_single_scale(g, "s0", image)
+    _write_single_scale(g, "s0", image, only_changed=only_changed, reference=reference,
+                        compression=compression, chunks=chunks, contiguous=contiguous)
+    for scale in range(1, n_scales):
+        image = downscale_image(image, is_label=is_label)
+        _write_single_scale(g, "s%i" % scale, image, compression=compression, chunks=chunks,
+                            contiguous=contiguous)
     assert isinstance(viewer_settings, dict)
 
 
+def get_n_scales(f, name):
+    ds = f[name]
+    if is_dataset(ds):
+        return 1
+    n_scales = 0
+    while 's%i' % n_scales in ds:
+        n_scales += 1
+    return n_scales
+
+
+def read_multiscale_image(f, key, lazy=False):
+    """ Read all scales of the image pyramid.
+    """
+    return [read_image(f, key, scale=scale, lazy=lazy) for scale in range(get_n_scales(f, key))]
+
+
 def has_image(f, name):
     if name not in f:
         return False
@@ -64,72 +346,132 @@ def has_image(f, name):
 
 
 # read/write tables
-def read_table(f, name, table_string_type='U100'):
+#
+# we use the following layout for a table:
+# table/columns - contains the column names
+# table/visible - contains which columns are visible in the plate-viewer
+# table/column_data/<i> - contains the values of the i-th column with its native dtype
+# older files store all values cast to strings in table/cells instead of column_data,
+# these tables can still be read.
+# n5 does not support string dtypes, so we store strings as uint8 arrays in n5 containers
+def _read_dataset(ds):
+    data = ds[:]
+    if ds.attrs.get('is_string', False):
+        data = np.ascontiguousarray(data).view('S%i' % data.shape[-1])[..., 0]
+    return data
+
+
+def _stack_columns(columns):
+    n_rows = len(columns[0]) if columns else 0
+    if all(col.dtype.kind in 'biuf' for col in columns):
+        dtype = np.result_type(*columns) if columns else 'float64'
+        table = np.empty((n_rows, len(columns)), dtype=dtype)
+    else:
+        table = np.empty((n_rows, len(columns)), dtype=object)
+    for ii, col in enumerate(columns):
+        table[:, ii] = col
+    return table
+
+
+def _read_string_table(g, table_string_type):
+    table = g['cells'][:]
+
+    def _cast_column(column):
+        for dtype in ('int', 'float'):
+            try:
+                return column.astype(dtype)
+            except ValueError:
+                pass
+        return np.char.decode(column, 'utf-8').astype(table_string_type)
+
+    return [_cast_column(col) for col in table.T]
+
+
+def read_columns(f, name, table_string_type='U100'):
+    """ Read table and return the column names and the list of columns.
+    """
     key = 'tables/%s' % name
     g = f[key]
-    ds = g['cells']
-    table = ds[:]
+    column_names = [col_name.decode('utf-8') for col_name in _read_dataset(g['columns'])]
+
+    if 'column_data' in g:
+        columns = [_read_dataset(g['column_data'][str(ii)]) for ii in range(len(column_names))]
+        columns = [np.char.decode(col, 'utf-8') if col.dtype.kind == 'S' else col for col in columns]
+    else:
+        columns = _read_string_table(g, table_string_type)
+    return column_names, columns
 
-    ds = g['columns']
-    column_names = [col_name.decode('utf-8') for col_name in ds[:]]
 
-    def _col_dtype(column):
-        try:
-            column.astype('int')
-            return 'int'
-        except ValueError:
-            pass
-        try:
-            column.astype('float')
-            return 'float'
-        except ValueError:
-            pass
-        return table_string_type
+def read_table(f, name, table_string_type='U100'):
+    """ Read table and return the column names and the values as 2d array.
+
+    The array has the common dtype of the columns if all columns are numeric,
+    otherwise it is an object array.
+    """
+    column_names, columns = read_columns(f, name, table_string_type)
+    return column_names, _stack_columns(columns)
 
-    # find the proper dtypes for the columns and cast
-    dtypes = [_col_dtype(col) for col in table.T]
-    columns = [col.astype(dtype) for col, dtype in zip(table.T, dtypes)]
-    n_rows = table.shape[0]
 
-    table = [[col[row] for col in columns] for row in range(n_rows)]
+def _to_native_column(col):
+    """ Get the native dtype of an object column, e.g. from a mixed table returned by read_table.
 
-    # a bit hacky, but we use pandas to handle the mixed dataset
-    df = pd.DataFrame(table)
-    return column_names, df.values
+    Columns of numbers are converted to a numeric dtype, all other columns to utf-8 encoded strings.
+    """
+    values = col.tolist()
+    if all(isinstance(val, (int, float, np.number)) and not isinstance(val, bool) for val in values):
+        numeric = np.array(values)
+        if numeric.dtype.kind in 'iuf':
+            return numeric
+    return np.char.encode(np.array([str(val) for val in values], dtype='U'), 'utf-8')
 
 
 def write_table(f, name, column_names, table,
                 visible=None, force_write=False, table_string_type='S100'):
-    if len(column_names) != table.shape[1]:
-        raise ValueError(f"Number of columns does not match: {len(column_names)}, {table.shape[1]}")
+    """ Write table, which can be a 2d array or a list of columns.
 
-    # make the table datasets. we follow the layout
-    # table/cells - contains the data
-    # table/columns - containse the column names
-    # table/visible - contains which columns are visible in the plate-viewer
+    Each column is stored as a separate dataset with its native dtype,
+    string columns are stored as utf-8 encoded fixed length strings.
+    The dtype of object columns, e.g. of a mixed table from read_table, is inferred from their values.
+    """
+    columns = list(table.T) if isinstance(table, np.ndarray) else [np.asarray(col) for col in table]
+    if len(column_names) != len(columns):
+        raise ValueError(f"Number of columns does not match: {len(column_names)}, {len(columns)}")
 
     key = 'tables/%s' % name
     g = f.require_group(key)
-
-    def _write_dataset(name, data):
-        if name in g:
-            shape = g[name].shape
-            if shape != data.shape and force_write:
-                del g[name]
-
-        ds = g.require_dataset(name, shape=data.shape, dtype=data.dtype,
-                               compression='gzip')
+    # remove the data from the old string layout and columns that don't exist anymore
+    if 'cells' in g:
+        del g['cells']
+    if 'column_data' in g and len(g['column_data']) != len(columns):
+        del g['column_data']
+
+    def _write_dataset(group, name, data):
+        is_string = is_n5(group) and data.dtype.kind == 'S'
+        if is_string:
+            data = data.view('uint8').reshape(data.shape + (data.itemsize,))
+
+        if name in group:
+            ds = group[name]
+            if (ds.shape != data.shape and (force_write or is_string)) or ds.dtype != data.dtype:
+                del group[name]
+
+        ds = require_dataset(group, name, data.shape, data.dtype)
         ds[:] = data
-
-    # TODO try varlen string, and if that doesn't work with java,
-    # issue a warning if a string is cut
-    # cast all values to numpy string
-    _write_dataset('cells', table.astype(table_string_type))
-    _write_dataset('columns', np.array(column_names, dtype=table_string_type))
+        if is_string:
+            ds.attrs['is_string'] = True
+
+    g_data = g.require_group('column_data')
+    for ii, col in enumerate(columns):
+        if col.dtype.kind == 'O':
+            col = _to_native_column(col)
+        if col.dtype.kind == 'U':
+            col = np.char.encode(col, 'utf-8')
+        _write_dataset(g_data, str(ii), col)
+    _write_dataset(g, 'columns', np.array(column_names, dtype=table_string_type))
 
     if visible is None:
         visible = np.ones(len(column_names), dtype='uint8')
-    _write_dataset('visible', visible)
+    _write_dataset(g, 'visible', visible)
 
 
 def has_table(f, name):
@@ -137,6 +479,56 @@ def has_table(f, name):
     if actual_key not in f:
         return False
     g = f[actual_key]
-    if not ('cells' in g and 'columns' in g and 'visible' in g):
+    if not (('column_data' in g or 'cells' in g) and 'columns' in g and 'visible' in g):
         return False
     return True
+
+
+# convert between file formats
+def _to_json(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value.tolist() if hasattr(value, 'tolist') else value
+
+
+def _copy_dataset(ds, g, name, compression=None, chunks=None, contiguous=False):
+    if contiguous and is_h5(g):
+        out = g.require_dataset(name, shape=ds.shape, dtype=ds.dtype)
+    else:
+        if chunks is None and ds.chunks is not None:
+            chunks = ds.chunks
+        out = require_dataset(g, name, ds.shape, ds.dtype,
+                              chunks=get_default_chunks(ds, chunks), compression=compression)
+    # we read in parallel, but need to lock the writes because the chunks might not be aligned
+    import dask.array as da
+    da.store(_read_lazy(ds), out, lock=True)
+    out.attrs.update({key: _to_json(val) for key, val in ds.attrs.items()})
+
+
+def convert_file(in_path, out_path, compression=None, chunks=None, contiguous=False):
+    """ Copy all images and tables from in_path to out_path.
+
+    Used to convert h5 files to zarr or n5 containers and vice versa;
+    the file formats are determined from the file extensions.
+    If contiguous is True, the images are stored contiguous and uncompressed in h5 files,
+    so that they can be memory mapped.
+    """
+    with open_file(in_path, 'r') as f_in, open_file(out_path, 'a') as f_out:
+
+        def _copy_group(g_in, g_out):
+            g_out.attrs.update({key: _to_json(val) for key, val in g_in.attrs.items()})
+            # we need a list here, iterating over h5 items holds the global h5py lock
+            for name, obj in list(g_in.items()):
+                # the tables are copied separately to convert them to the current layout
+                if g_in is f_in and name == 'tables':
+                    continue
+                if is_group(obj):
+                    _copy_group(obj, g_out.require_group(name))
+                else:
+                    _copy_dataset(obj, g_out, name, compression, chunks, contiguous)
+
+        _copy_group(f_in, f_out)
+        for name in (f_in['tables'] if 'tables' in f_in else []):
+            column_names, columns = read_columns(f_in, name)
+            visible = f_in['tables'][name]['visible'][:]
+            write_table(f_out, name, column_names, columns, visible=visible, force_write=True)
@@ -1,36 +1,70 @@
 import argparse
-import h5py
+import os
+
 import napari
 
 from napari.layers.points import Points
 from napari.layers.labels import Labels
 from napari.layers.image import Image
+from napari_covid_if_annotations.io_utils import COMPRESSIONS, open_file, set_write_options
 from napari_covid_if_annotations.layers import get_layers_from_file, load_labels
-from napari_covid_if_annotations.gui import connect_to_viewer
-from napari_covid_if_annotations._key_bindings import modify_points_layer, update_layers
+from napari_covid_if_annotations.gui import add_session_controls, connect_to_viewer
+from napari_covid_if_annotations.prefetch import Prefetcher
+from napari_covid_if_annotations.profiling import TIMINGS
+from napari_covid_if_annotations._key_bindings import (get_saver,
+                                                      modify_points_layer,
+                                                      modify_segmentation_layer,
+                                                      update_layers,
+                                                      _save_labels)
 
 
-def initialize_from_file(viewer, path, saturation_factor, edge_width):
-    with h5py.File(path, 'r') as f:
-        layers = get_layers_from_file(f, saturation_factor, edge_width)
+def initialize_from_file(viewer, path, saturation_factor, edge_width, use_cache=True):
+    with open_file(path, 'r') as f:
+        layers = get_layers_from_file(f, saturation_factor, edge_width, use_cache=use_cache)
 
     for (data, kwargs, layer_type) in layers:
         adder = getattr(viewer, f'add_{layer_type}')
         adder(data, **kwargs)
 
 
+def set_layers(viewer, layers):
+    """ Replace the data of the existing layers with the same name and add the other layers.
+    """
+    layer_names = [layer.name for layer in viewer.layers]
+    for (data, kwargs, layer_type) in layers:
+        name = kwargs['name']
+        if name not in layer_names:
+            adder = getattr(viewer, f'add_{layer_type}')
+            adder(data, **kwargs)
+            continue
+
+        layer = viewer.layers[name]
+        layer.data = data
+        if 'metadata' in kwargs:
+            layer.metadata = kwargs['metadata']
+        if 'properties' in kwargs:
+            layer.properties = kwargs['properties']
+
+
 def initialize_annotations(viewer, path):
-    with h5py.File(path, 'r') as f:
+    with open_file(path, 'r') as f:
         new_layers = load_labels(f)
-    seg_layer = new_layers[0]
-    point_layer = new_layers[1]
+    set_layers(viewer, new_layers)
 
-    viewer.layers['cell-segmentation'].data = seg_layer[0]
-    viewer.layers['cell-segmentation'].metadata = seg_layer[1]['metadata']
 
-    viewer.layers['infected-vs-control'].data = point_layer[0]
-    viewer.layers['infected-vs-control'].metadata = point_layer[1]['metadata']
-    viewer.layers['infected-vs-control'].properties = point_layer[1]['properties']
+def load_data_and_annotations(paths, saturation_factor, edge_width, use_cache=True):
+    """ Load the layers for a data file and optionally the annotations for it.
+    """
+    data_path, annotation_path = paths
+    with open_file(data_path, 'r') as f:
+        layers = get_layers_from_file(f, saturation_factor, edge_width, use_cache=use_cache)
+
+    annotation_layers = None
+    if annotation_path is not None:
+        with open_file(annotation_path, 'r') as f:
+            annotation_layers = load_labels(f)
+
+    return layers, annotation_layers
 
 
 def replace_layer(new_layer, layers, name_to_replace, protected_metadata=None):
@@ -51,9 +85,77 @@ def replace_layer(new_layer, layers, name_to_replace, protected_metadata=None):
     layers.remove(new_layer.name)
 
 
+def connect_layer_events(viewer):
+    """ Replace existing layers when new layers are added (e.g. via drag and drop) instead
+    of adding them and modify the functionality of the points and segmentation layers.
+    """
+    # the event object will have the following useful things:
+    # event.source -> the full viewer.layers object itself
+    # event.item -> the specific layer that cause the change
+    # event.type -> a string like 'added', 'removed'
+    def on_layer_change(event):
+        try:
+            needs_update = False
+            layers = event.source
+            layer = event.item
+
+            def replace_image_layer(name, im_layer):
+                im_layers = [ll for ll in layers if name in ll.name]
+                if name in im_layer.name and len(im_layers) > 1:
+                    replace_layer(im_layer, layers, name)
+
+            # replace the raw data image layers
+            if isinstance(layer, Image) and event.type == 'added':
+                replace_image_layer('raw', layer)
+                replace_image_layer('virus-marker', layer)
+                replace_image_layer('cell-outlines', layer)
+
+            # if we add new labels or new points, we need to replace instead
+            # of adding them
+            if isinstance(layer, Labels) and event.type == 'added':
+                if len([ll for ll in layers if isinstance(ll, Labels)]) > 1:
+                    replace_layer(layer, layers, 'cell-segmentation')
+
+            if isinstance(layer, Points) and event.type == 'added':
+                if len([ll for ll in layers if isinstance(ll, Points)]) > 1:
+                    replace_layer(layer, layers, 'infected-vs-control')
+
+                    # select the new points layer
+                    layer = viewer.layers['infected-vs-control']
+                    viewer.layers.unselect_all()
+                    layer.selected = True
+                    needs_update = True
+
+                # modifty the new points layer
+                # set the corect color maps
+                face_color_cycle_map = {0: (1, 1, 1, 1),
+                                        1: (1, 0, 0, 1),
+                                        2: (0, 1, 1, 1),
+                                        3: (1, 1, 0, 1)}
+
+                viewer.layers['infected-vs-control'].face_color_cycle_map = face_color_cycle_map
+                viewer.layers['infected-vs-control'].refresh_colors()
+
+            # always modify the points layer to deactivate the buttons we don't need
+            if isinstance(event.item, Points):
+                modify_points_layer(viewer)
+
+            # track the regions that are painted in the segmentation layer
+            if isinstance(event.item, Labels):
+                modify_segmentation_layer(viewer)
+
+            if needs_update:
+                update_layers(viewer)
+
+        except AttributeError:
+            pass
+
+    viewer.layers.events.changed.connect(on_layer_change)
+
+
 # should be installed as a script in setup.py
 def launch_covid_if_annotation_tool(data_path=None, annotation_path=None,
-                                    saturation_factor=1, edge_width=1):
+                                    saturation_factor=1, edge_width=1, use_cache=True):
     """ Launch the Covid IF anootation tool.
 
     Based on https://github.com/transformify-plugins/segmentify/blob/master/examples/launch.py
@@ -68,67 +170,10 @@ def launch_covid_if_annotation_tool(data_path=None, annotation_path=None,
     with napari.gui_qt():
         viewer = napari.Viewer()
 
-        # the event object will have the following useful things:
-        # event.source -> the full viewer.layers object itself
-        # event.item -> the specific layer that cause the change
-        # event.type -> a string like 'added', 'removed'
-        def on_layer_change(event):
-            try:
-                needs_update = False
-                layers = event.source
-                layer = event.item
-
-                def replace_image_layer(name, im_layer):
-                    im_layers = [ll for ll in layers if name in ll.name]
-                    if name in im_layer.name and len(im_layers) > 1:
-                        replace_layer(im_layer, layers, name)
-
-                # replace the raw data image layers
-                if isinstance(layer, Image) and event.type == 'added':
-                    replace_image_layer('raw', layer)
-                    replace_image_layer('virus-marker', layer)
-                    replace_image_layer('cell-outlines', layer)
-
-                # if we add new labels or new points, we need to replace instead
-                # of adding them
-                if isinstance(layer, Labels) and event.type == 'added':
-                    if len([ll for ll in layers if isinstance(ll, Labels)]) > 1:
-                        replace_layer(layer, layers, 'cell-segmentation')
-
-                if isinstance(layer, Points) and event.type == 'added':
-                    if len([ll for ll in layers if isinstance(ll, Points)]) > 1:
-                        replace_layer(layer, layers, 'infected-vs-control')
-
-                        # select the new points layer
-                        layer = viewer.layers['infected-vs-control']
-                        viewer.layers.unselect_all()
-                        layer.selected = True
-                        needs_update = True
-
-                    # modifty the new points layer
-                    # set the corect color maps
-                    face_color_cycle_map = {0: (1, 1, 1, 1),
-                                            1: (1, 0, 0, 1),
-                                            2: (0, 1, 1, 1),
-                                            3: (1, 1, 0, 1)}
-
-                    viewer.layers['infected-vs-control'].face_color_cycle_map = face_color_cycle_map
-                    viewer.layers['infected-vs-control'].refresh_colors()
-
-                # always modify the points layer to deactivate the buttons we don't need
-                if isinstance(event.item, Points):
-                    modify_points_layer(viewer)
-
-                if needs_update:
-                    update_layers(viewer)
-
-            except AttributeError:
-                pass
-
-        viewer.layers.events.changed.connect(on_layer_change)
+        connect_layer_events(viewer)
         if with_data:
             initialize_from_file(viewer, data_path,
-                                 saturation_factor, edge_width)
+                                 saturation_factor, edge_width, use_cache)
 
         if with_annotations:
             initialize_annotations(viewer, annotation_path)
@@ -140,16 +185,86 @@ def launch_covid_if_annotation_tool(data_path=None, annotation_path=None,
             update_layers(viewer)
 
 
+def make_show_next_image(file_pairs, prefetcher):
+    """ Get the function that saves the annotations of the current file and shows the next one.
+    """
+    current_index = -1
+
+    def show_next_image(viewer):
+        nonlocal current_index
+        # save the annotations of the current file, the layers are replaced afterwards;
+        # the saver keeps the pending saves for each file, so a save that is still running
+        # for another file does not drop the annotations of this one
+        if current_index >= 0:
+            _save_labels(viewer)
+        if current_index + 1 >= len(prefetcher):
+            print("All files have been proofread")
+            return
+        current_index += 1
+
+        layers, annotation_layers = prefetcher.get(current_index)
+        set_layers(viewer, layers)
+        if annotation_layers is not None:
+            set_layers(viewer, annotation_layers)
+            update_layers(viewer)
+
+        data_path = file_pairs[current_index][0]
+        viewer.title = os.path.split(data_path)[1]
+        print("Proofread:", data_path, f"({current_index + 1} / {len(prefetcher)})")
+
+    return show_next_image
+
+
+def launch_proofreading_session(file_pairs, saturation_factor=1, edge_width=1,
+                                use_cache=True, n_prefetch=2):
+    """ Proofread several files in one viewer.
+
+    file_pairs is a list of (data_path, annotation_path) tuples. The next n_prefetch
+    files are loaded and preprocessed in the background while the current one is proofread,
+    use the 'next image' button or shift + n to go to the next file.
+    The annotations of the current file are saved before going to the next file.
+    """
+    def load(paths):
+        return load_data_and_annotations(paths, saturation_factor, edge_width, use_cache)
+    prefetcher = Prefetcher(file_pairs, load, n_prefetch=n_prefetch)
+    show_next_image = make_show_next_image(file_pairs, prefetcher)
+
+    with napari.gui_qt():
+        viewer = napari.Viewer()
+        connect_layer_events(viewer)
+        show_next_image(viewer)
+
+        # connect the gui elements and modify layer functionality
+        connect_to_viewer(viewer)
+        add_session_controls(viewer, show_next_image)
+
+    # wait for the last save to finish before exiting
+    get_saver(viewer).wait()
+    prefetcher.close()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', type=str, default=None)
     parser.add_argument('--annotation_path', type=str, default=None)
     parser.add_argument('--saturation_factor', type=float, default=1)
     parser.add_argument('--edge_width', type=int, default=1)
+    parser.add_argument('--use_cache', type=int, default=1)
+    parser.add_argument('--compression', type=str, default=None,
+                        help=f"compression for the saved annotations, one of {COMPRESSIONS}, "
+                        "optionally with the level, e.g. gzip:1")
+    parser.add_argument('--chunks', type=int, nargs=2, default=None,
+                        help="chunk shape for the saved annotations")
+    parser.add_argument('--timing_log', type=str, default=None,
+                        help="append the timings of updating, loading and saving to this JSON-lines file")
 
     args = parser.parse_args()
+    set_write_options(args.compression, args.chunks)
+    if args.timing_log is not None:
+        TIMINGS.path = args.timing_log
     launch_covid_if_annotation_tool(args.path, args.annotation_path,
-                                    args.saturation_factor, args.edge_width)
+                                    args.saturation_factor, args.edge_width,
+                                    bool(args.use_cache))
 
 
 if __name__ == '__main__':
@@ -1,11 +1,16 @@
-import h5py
+import os
+
 import numpy as np
-import skimage.color as skc
-from vispy.color import Colormap
 
-from .image_utils import (get_centroids, get_edge_segmentation, map_labels_to_edges,
-                          quantile_normalize)
-from .io_utils import has_table, read_image, read_table, write_image, write_table
+from .cache import get_cache_key, load_from_cache, save_to_cache
+from .image_utils import (get_segmentation_features, get_sorted_values, histogram_quantile,
+                          map_labels_to_edges, use_histogram)
+from .io_utils import (get_file_path, get_n_scales, has_table, load_lazy, open_file, read_image, read_table,
+                       write_image, write_table)
+from .profiling import timed, timed_stage
+
+# maximal number of blocks of lazily loaded images used to estimate the intensity statistics
+MAX_SAMPLE_BLOCKS = 16
 
 
 def get_seg_kwargs(f, seg_ids, infected_labels):
@@ -14,7 +19,7 @@ def get_seg_kwargs(f, seg_ids, infected_labels):
         'metadata': {'seg_ids': seg_ids,
                      'infected_labels': infected_labels,
                      'hide_annotated_segments': False,
-                     'filename': f.filename}
+                     'filename': get_file_path(f)}
     }
     return seg_kwargs
 
@@ -59,6 +64,74 @@ def load_labels(f):
     return layers
 
 
+def get_save_path(filename):
+    # we modify the save path, because we don't want to let the filenaming
+    # patterns go out of sync
+    root, ext = os.path.splitext(filename.rstrip('/'))
+    identifier = '_annotations'
+    if root.endswith(identifier):
+        return filename
+    return root + identifier + ext
+
+
+def write_labels(save_path, seg, seg_ids, infected_labels, reference=None):
+    """ Write the segmentation and infected labels.
+
+    Only the chunks of the segmentation that have changed compared to reference,
+    or to the segmentation in the file if reference is None, are rewritten.
+    """
+    assert len(seg_ids) == len(infected_labels)
+    assert infected_labels[0] == 0
+
+    infected_labels_columns = ['label_id', 'infected_label']
+
+    with timed_stage('write'), open_file(save_path, 'a') as f:
+        write_image(f, 'cell_segmentation', seg, only_changed=True, reference=reference)
+        write_table(f, 'infected_cell_labels', infected_labels_columns, [seg_ids, infected_labels],
+                    force_write=True)
+
+
+def _file_state(path):
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    # for zarr containers we need to check all the files in the container
+    stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    return max((stat.st_mtime_ns for stat in stats), default=0), sum(stat.st_size for stat in stats)
+
+
+class LabelsWriter:
+    """ Write labels and keep the last written segmentation as reference for the next save,
+    so that the changed chunks can be found without reading the segmentation from the file.
+
+    The segmentations passed to it must not be modified afterwards, e.g. by passing snapshots.
+    """
+    def __init__(self):
+        self._last_written = None
+
+    @timed('save_labels')
+    def __call__(self, save_path, seg, seg_ids, infected_labels):
+        reference = None
+        # the reference can only be used if the file was not modified since our last save
+        if self._last_written is not None:
+            last_path, last_state, last_seg = self._last_written
+            if last_path == save_path and os.path.exists(save_path) and _file_state(save_path) == last_state:
+                reference = last_seg
+        self._last_written = None
+
+        write_labels(save_path, seg, seg_ids, infected_labels, reference=reference)
+        self._last_written = (save_path, _file_state(save_path), seg)
+
+
+def get_labels_snapshot(layer):
+    """ Copy the data needed to save the labels, so that they can be written in the background.
+    """
+    metadata = layer.metadata
+    return (get_save_path(metadata['filename']), layer.data.copy(),
+            np.array(metadata['seg_ids']), np.array(metadata['infected_labels']))
+
+
+@timed()
 def save_labels(layers):
     layer = None
     for this_layer, kwargs, layer_type in layers:
@@ -67,62 +140,148 @@ def save_labels(layers):
             break
     assert layer is not None
 
-    seg = layer.data
     metadata = layer.metadata
-    seg_ids = metadata['seg_ids']
-    infected_labels = metadata['infected_labels']
-    assert len(seg_ids) == len(infected_labels)
-    assert infected_labels[0] == 0
-
-    infected_labels_columns = ['label_id', 'infected_label']
-    infected_labels_table = np.concatenate([seg_ids[:, None], infected_labels[:, None]], axis=1)
-
-    # we modify the save path, because we don't want to let the filenaming
-    # patterns go out of sync
-    save_path = metadata['filename']
-    identifier = '_annotations.h5'
-    if identifier not in save_path:
-        save_path = save_path.replace('.h5', identifier)
-
-    with h5py.File(save_path, 'a') as f:
-        write_image(f, 'cell_segmentation', seg)
-        write_table(f, 'infected_cell_labels', infected_labels_columns, infected_labels_table,
-                    force_write=True)
+    save_path = get_save_path(metadata['filename'])
+    write_labels(save_path, layer.data, metadata['seg_ids'], metadata['infected_labels'])
 
     return [save_path]
 
 
-def get_raw_data(f, seg, saturation_factor):
-
-    serum = quantile_normalize(read_image(f, 'serum_IgG'))
-    marker = quantile_normalize(read_image(f, 'marker'))
-    nuclei = quantile_normalize(read_image(f, 'nuclei'))
-    bg_mask = seg == 0
+def increase_saturation(raw, saturation_factor, out=None):
+    """ Scale the saturation of the rgb image, keeping hue and value fixed.
+
+    Scaling the hsv saturation by a factor k maps each channel c to v - k * (v - c),
+    where v is the maximum over the channels, so we can do this without
+    the round trip through the hsv color space.
+    """
+    value = raw.max(axis=-1, keepdims=True)
+    out = np.subtract(raw, value, out=out)
+    out *= saturation_factor
+    out += value
+    return np.clip(out, 0., 1., out=out)
+
+
+def _sample_blocks(images, seg):
+    """ Load evenly spaced blocks of the lazy images and the corresponding segmentation.
+    """
+    offsets = [np.cumsum((0,) + chunks) for chunks in images[0].chunks]
+    block_ids = list(np.ndindex(*images[0].numblocks))
+    step = max(len(block_ids) // MAX_SAMPLE_BLOCKS, 1)
+    bbs = [tuple(slice(off[i], off[i + 1]) for off, i in zip(offsets, block_id))
+           for block_id in block_ids[::step]]
+
+    samples = [np.concatenate([im[bb].compute().ravel() for bb in bbs]) for im in images]
+    bg_mask = np.concatenate([seg[bb].ravel() == 0 for bb in bbs])
+    return samples, bg_mask
+
+
+def get_normalization(im, bg_mask):
+    """ Get the quantile normalization thresholds and the background intensity after normalization.
+
+    For 8 and 16 bit data the quantiles and the background median are computed
+    from histograms, which avoids sorting and converting the image to float.
+    """
+    if not use_histogram(im):
+        im = im.astype('float32')
+        tlow, thigh = float(np.quantile(im, .01)), float(np.quantile(im, .99))
+        bg = float(np.median(np.clip((im[bg_mask] - tlow) / thigh, 0., 1.))) if bg_mask.any() else 0.
+        return tlow, thigh, bg
+
+    hist = np.bincount(im.ravel())
+    tlow, thigh = float(histogram_quantile(hist, .01)), float(histogram_quantile(hist, .99))
+    if not bg_mask.any():
+        return tlow, thigh, 0.
+
+    # the normalization is monotonic, so the median of the normalized background
+    # is the mean of the normalized middle values of the background
+    bg_hist = np.bincount(im[bg_mask])
+    pos = (bg_hist.sum() - 1) / 2
+    middle = get_sorted_values(bg_hist, [int(np.floor(pos)), int(np.ceil(pos))])
+    bg = float(np.mean(np.clip((middle - tlow) / thigh, 0., 1.)))
+    return tlow, thigh, bg
+
+
+def normalize_channel(im, normalization, out=None):
+    tlow, thigh, bg = normalization
+    # lazy (dask) arrays are normalized lazily, numpy arrays in-place
+    if not isinstance(im, np.ndarray):
+        return ((im.astype('float32') - tlow) / thigh).clip(0., 1.) - bg
+    out = np.subtract(im, np.float32(tlow), out=out, dtype='float32')
+    out /= np.float32(thigh)
+    np.clip(out, 0., 1., out=out)
+    out -= np.float32(bg)
+    return out
+
+
+def _get_rgb_lazy(images, normalizations, saturation_factor):
+    import dask.array as da
+    channels = [normalize_channel(im, normalization) for im, normalization in zip(images, normalizations)]
+    raw = da.stack(channels, axis=-1)
+    if saturation_factor > 1:
+        raw = raw.rechunk({raw.ndim - 1: 3}).map_blocks(increase_saturation, saturation_factor,
+                                                        dtype=raw.dtype)
+    return raw, channels[0]
 
-    def subtract_bg(im):
-        bg = np.median(im[bg_mask])
-        im -= bg
-        return im
 
-    serum = subtract_bg(serum)
-    marker = subtract_bg(marker)
-    nuclei = subtract_bg(nuclei)
+def _get_rgb(images, normalizations, saturation_factor):
+    # normalize all channels in-place into the rgb image
+    raw = np.empty(images[0].shape + (3,), dtype='float32')
+    for channel_id, (im, normalization) in enumerate(zip(images, normalizations)):
+        normalize_channel(im, normalization, out=raw[..., channel_id])
 
-    raw = np.concatenate([marker[..., None], serum[..., None], nuclei[..., None]], axis=-1)
     if saturation_factor > 1:
-        raw = skc.rgb2hsv(raw)
-        raw[..., 1] *= saturation_factor
-        raw = skc.hsv2rgb(raw).clip(0, 1)
+        marker = raw[..., 0].copy()
+        increase_saturation(raw, saturation_factor, out=raw)
+    else:
+        marker = raw[..., 0]
+    return raw, marker
+
 
+def get_raw_data(f, seg, saturation_factor, lazy=False):
+    """ Get the normalized rgb composite of the marker, serum and nuclei channels and the normalized marker.
+
+    If the images are stored as multiscale pyramids, the composite and marker
+    are returned as lists with one image per scale.
+    """
+    # the channels in rgb order
+    names = ('marker', 'serum_IgG', 'nuclei')
+    n_scales = min(get_n_scales(f, name) for name in names)
+    # the channels are memory mapped if they are stored contiguous and uncompressed
+    scales = [[read_image(f, name, scale=scale, lazy=lazy, mmap=True) for name in names]
+              for scale in range(n_scales)]
+
+    # estimate the normalization from the lowest resolution if we have a pyramid,
+    # from a sample of blocks for lazy data and from the full images otherwise
+    if n_scales > 1:
+        samples = [np.asarray(im) for im in scales[-1]]
+        factor = 2 ** (n_scales - 1)
+        bg_mask = seg[::factor, ::factor] == 0
+        assert bg_mask.shape == samples[0].shape, f"{bg_mask.shape}, {samples[0].shape}"
+    elif lazy:
+        samples, bg_mask = _sample_blocks(scales[0], seg)
+    else:
+        samples, bg_mask = scales[0], seg == 0
+    normalizations = [get_normalization(sample, bg_mask) for sample in samples]
+
+    get_rgb = _get_rgb_lazy if lazy else _get_rgb
+    raw, marker = [], []
+    for images in scales:
+        rgb, marker_channel = get_rgb(images, normalizations, saturation_factor)
+        raw.append(rgb)
+        marker.append(marker_channel)
+
+    if n_scales == 1:
+        return raw[0], marker[0]
     return raw, marker
 
 
 def get_segmentation_data(f, seg, edge_width, infected_label_name='infected_cell_labels'):
 
-    seg_ids = np.unique(seg)
+    seg_ids, centroids, edges = get_segmentation_features(seg, edge_width)
     # TODO log if labels were loaded or initialized to be zero
     if has_table(f, infected_label_name):
-        _, infected_labels = read_table(f, infected_label_name)
+        with timed_stage('read'):
+            _, infected_labels = read_table(f, infected_label_name)
         assert infected_labels.shape[1] == 2
         infected_labels = infected_labels[:, 1]
         infected_labels = infected_labels.astype('int32')
@@ -139,10 +298,8 @@ def get_segmentation_data(f, seg, edge_width, infected_label_name='infected_cell
 
     assert seg_ids.shape == infected_labels.shape, f"{seg_ids.shape}, {infected_labels.shape}"
 
-    edges = get_edge_segmentation(seg, edge_width)
-    infected_edges = map_labels_to_edges(edges, seg_ids, infected_labels, remap_background=4)
-
-    centroids = get_centroids(seg)
+    with timed_stage('remap'):
+        infected_edges = map_labels_to_edges(edges, seg_ids, infected_labels, remap_background=4)
 
     return seg_ids, centroids, infected_edges, infected_labels
 
@@ -154,18 +311,55 @@ def get_centroid_properties(centroids, infected_labels):
     return properties
 
 
-def get_layers_from_file(f, saturation_factor=1., edge_width=2):
-    seg = read_image(f, 'cell_segmentation')
-
-    raw, marker = get_raw_data(f, seg, saturation_factor)
-    (seg_ids, centroids,
-     infected_edges, infected_labels) = get_segmentation_data(f, seg, edge_width)
+def _get_derived_data(f, seg, saturation_factor, edge_width, lazy, use_cache):
+    # we don't cache lazy data, because we would need to load all of it
+    if not use_cache or lazy:
+        with timed_stage('raw'):
+            raw, marker = get_raw_data(f, seg, saturation_factor, lazy=lazy)
+        return (raw, marker) + get_segmentation_data(f, seg, edge_width)
+
+    names = ['raw', 'marker', 'seg_ids', 'centroids', 'infected_edges', 'infected_labels']
+    cache_key = get_cache_key(get_file_path(f), saturation_factor=saturation_factor, edge_width=edge_width)
+    # the raw data is memory mapped, the other arrays need to be writable
+    with timed_stage('cache'):
+        data = load_from_cache(cache_key, mmap=('raw', 'marker'))
+    if data is not None:
+        return tuple(data[name] for name in names)
+
+    with timed_stage('raw'):
+        raw, marker = get_raw_data(f, seg, saturation_factor, lazy=lazy)
+    derived_data = (raw, marker) + get_segmentation_data(f, seg, edge_width)
+    with timed_stage('cache'):
+        save_to_cache(cache_key, dict(zip(names, derived_data)))
+    return derived_data
+
+
+@timed()
+def get_layers_from_file(f, saturation_factor=1., edge_width=2, lazy=None, use_cache=False):
+    """ Get the layer data for all layers from the file.
+
+    If lazy is True, the raw data layers are returned as dask arrays that only
+    load the image chunks when they are displayed. By default, this is done for large files.
+    If use_cache is True, the derived data is loaded from the on-disk cache if the same
+    file was opened before and is added to the cache otherwise.
+    """
+    if lazy is None:
+        lazy = load_lazy(f)
+
+    # the segmentation is always loaded, because we need to paint it
+    with timed_stage('read'):
+        seg = read_image(f, 'cell_segmentation')
+
+    (raw, marker, seg_ids, centroids,
+     infected_edges, infected_labels) = _get_derived_data(f, seg, saturation_factor, edge_width,
+                                                          lazy, use_cache)
 
     # the keyword arguments passed to 'add_labels' for the cell segmentation layer
     seg_kwargs = get_seg_kwargs(f, seg_ids, infected_labels)
 
     # the keyword arguments passed to 'add_image' for the edge layer
     # custom colormap to have colors in sync with the point layer
+    from vispy.color import Colormap
     cmap = Colormap([
         [1., 1., 1., 1.],  # label 0 is white
         [1., 0., 0., 1.],  # label 1 is red
@@ -185,9 +379,20 @@ def get_layers_from_file(f, saturation_factor=1., edge_width=2):
     # centroid layer
     centroid_kwargs = get_centroid_kwargs(centroids, infected_labels)
 
+    raw_kwargs = {'name': 'raw'}
+    marker_kwargs = {'name': 'virus-marker', 'visible': False}
+    multiscale = isinstance(raw, list)
+    if multiscale:
+        raw_kwargs['multiscale'] = True
+        marker_kwargs['multiscale'] = True
+    # set the contrast limits for lazy data, otherwise napari would need to load all of it to compute them
+    if lazy or multiscale:
+        raw_kwargs['contrast_limits'] = [0., 1.]
+        marker_kwargs['contrast_limits'] = [0., 1.]
+
     layers = [
-        (raw, {'name': 'raw'}, 'image'),
-        (marker, {'name': 'virus-marker', 'visible': False}, 'image'),
+        (raw, raw_kwargs, 'image'),
+        (marker, marker_kwargs, 'image'),
         (seg, seg_kwargs, 'labels'),
         (infected_edges, edge_kwargs, 'image'),
         (centroids, centroid_kwargs, 'points')
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """ Load the items of a sequence in background threads, keeping the next n_prefetch items ready.
+
+    Used to load and preprocess the next files of a proofreading session
+    while the current one is being annotated.
+    """
+    def __init__(self, items, load_function, n_prefetch=2, n_workers=1):
+        self.items = list(items)
+        self.load_function = load_function
+        self.n_prefetch = n_prefetch
+        self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        self._futures = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def _schedule(self, index):
+        if 0 <= index < len(self.items) and index not in self._futures:
+            self._futures[index] = self._executor.submit(self.load_function, self.items[index])
+
+    def get(self, index):
+        """ Get the loaded data for the item at index and start prefetching the next items.
+
+        Blocks if the item has not been loaded yet and raises the error if loading failed.
+        """
+        if not 0 <= index < len(self.items):
+            raise IndexError(f"Index {index} is out of range for {len(self.items)} items")
+        for next_index in range(index, index + self.n_prefetch + 1):
+            self._schedule(next_index)
+
+        # we don't need the data of the previous items anymore
+        for prev_index in [ii for ii in self._futures if ii < index]:
+            self._futures.pop(prev_index).cancel()
+
+        return self._futures.pop(index).result()
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,143 @@
+"""
+Lightweight timing of the hot paths, e.g. updating the layers or saving the labels.
+
+An operation is timed with timed_operation (or the timed decorator) and the stages inside of it
+with timed_stage. Stages are only recorded if they run inside of an operation in the same thread,
+otherwise timed_stage does nothing, so the stages can be used in functions that are also called
+outside of the viewer. The timings of the last operations are kept in TIMINGS, they are shown
+in the viewer dock and can be written to a JSON-lines file for offline analysis.
+If the environment variable COVID_IF_TIMING_LOG is set, all timings are appended to this file.
+"""
+import json
+import os
+import threading
+import time
+import warnings
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# number of operations that are kept in the rolling log
+MAX_ENTRIES = 200
+DEFAULT_DUMP_PATH = './covid-if-timings.jsonl'
+
+_local = threading.local()
+
+
+class TimingLog:
+    """ Rolling log of the timings of the last operations, safe to use from several threads.
+
+    Each entry is a dict with the operation name, the start time, the total time
+    and the times of the stages in seconds.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, path=None):
+        self.path = path
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+            if self.path is None:
+                return
+            # timing must never make the timed operation fail, so we stop writing to the file if it fails
+            try:
+                _write_entries(self.path, [entry])
+            except OSError as e:
+                warnings.warn(f"Could not write the timings to {self.path}, the log file is disabled: {e}")
+                self.path = None
+
+    def entries(self, operation=None, n=None):
+        """ Get the last n entries, optionally only for the given operation.
+        """
+        with self._lock:
+            entries = list(self._entries)
+        if operation is not None:
+            entries = [entry for entry in entries if entry['operation'] == operation]
+        return entries if n is None else entries[-n:]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def dump(self, path=DEFAULT_DUMP_PATH):
+        """ Append the entries to a JSON-lines file and return the number of written entries.
+        """
+        entries = self.entries()
+        _write_entries(path, entries)
+        return len(entries)
+
+    def summary(self, n=5):
+        return '\n'.join(format_entry(entry) for entry in reversed(self.entries(n=n)))
+
+
+def _write_entries(path, entries):
+    with open(path, 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+
+TIMINGS = TimingLog(path=os.environ.get('COVID_IF_TIMING_LOG'))
+
+
+def format_entry(entry):
+    stages = ', '.join(f'{name} {1000 * t:.0f}' for name, t in entry['stages'].items())
+    message = f"{entry['operation']}: {1000 * entry['total']:.0f} ms"
+    return f"{message} ({stages})" if stages else message
+
+
+@contextmanager
+def timed_operation(name, log=None):
+    """ Time the operation and the stages inside of it and add the timings to the log.
+
+    Operations that are nested inside of another operation are not recorded separately,
+    their stages are added to the outer operation instead.
+    """
+    if getattr(_local, 'stages', None) is not None:
+        yield
+        return
+
+    stages = {}
+    _local.stages = stages
+    start_time, start = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - start
+        _local.stages = None
+        log = TIMINGS if log is None else log
+        log.add({'operation': name, 'time': start_time, 'total': total, 'stages': stages})
+
+
+@contextmanager
+def timed_stage(name):
+    """ Time a stage of the current operation, the times of stages with the same name are summed up.
+    """
+    stages = getattr(_local, 'stages', None)
+    if stages is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.) + time.perf_counter() - start
+
+
+def timed(name=None):
+    """ Decorator to time all calls of the function as an operation.
+    """
+    def decorator(function):
+        operation = function.__name__ if name is None else name
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed_operation(operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
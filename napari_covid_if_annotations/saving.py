@@ -0,0 +1,81 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+
+class BackgroundSaver:
+    """ Run the save function in a background thread, so that saving does not block the viewer.
+
+    Saves that are requested while another save is running are coalesced per save path,
+    which is the first argument of the save function: only the most recent request for each path
+    is executed once the running save has finished, in the order in which the paths were requested.
+    The state can be queried from any thread via status_message.
+    """
+    def __init__(self, save_function):
+        self.save_function = save_function
+        self._lock = threading.Lock()
+        # the pending save arguments, by save path
+        self._pending = OrderedDict()
+        self._thread = None
+        self._running = False
+        self.last_saved = None
+        self.last_error = None
+
+    def submit(self, *args):
+        with self._lock:
+            key = args[0] if args else None
+            self._pending[key] = args
+            if self._thread is None:
+                # not a daemon thread, so that the save is finished before the interpreter exits
+                self._thread = threading.Thread(target=self._run, name='covid-if-saver')
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    self._running = False
+                    return
+                _, args = self._pending.popitem(last=False)
+                self._running = True
+
+            try:
+                self.save_function(*args)
+                error = None
+            except Exception as e:
+                traceback.print_exc()
+                error = e
+
+            with self._lock:
+                self.last_error = error
+                if error is None:
+                    self.last_saved = time.time()
+
+    @property
+    def is_saving(self):
+        with self._lock:
+            return self._running or bool(self._pending)
+
+    def wait(self, timeout=None):
+        """ Wait until all submitted saves are done.
+        """
+        while True:
+            with self._lock:
+                thread = self._thread
+            if thread is None:
+                return
+            thread.join(timeout)
+            if thread.is_alive():
+                return
+
+    def status_message(self):
+        with self._lock:
+            if self._running or bool(self._pending):
+                return "saving ..."
+            if self.last_error is not None:
+                return f"save failed: {self.last_error}"
+            if self.last_saved is not None:
+                return "saved at " + time.strftime('%H:%M:%S', time.localtime(self.last_saved))
+            return "not saved yet"
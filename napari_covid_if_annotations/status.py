@@ -0,0 +1,159 @@
+"""
+Persistent index of the annotation status of the images, stored in a SQLite database.
+
+Each image goes through the statuses 'new' -> 'first_pass' -> 'second_pass' -> 'checked'.
+The index can be initialized from the annotation_status.xlsx table we used before.
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+STATUSES = ('new', 'first_pass', 'second_pass', 'checked')
+# the allowed status transitions, checked images can be sent back for another pass
+TRANSITIONS = {
+    'new': ('first_pass',),
+    'first_pass': ('second_pass', 'checked'),
+    'second_pass': ('checked',),
+    'checked': ('second_pass',),
+}
+# the statuses used in annotation_status.xlsx and the corresponding statuses in the index,
+# proofread images are done, only images marked as second_pass still need to be proofread
+XLSX_STATUSES = {
+    'ok': 'checked',
+    'no_labels': 'checked',
+    'proofread': 'checked',
+    'second_pass': 'second_pass',
+    'first_pass': 'first_pass',
+}
+DEFAULT_INDEX_PATH = './annotation_status.sqlite'
+DEFAULT_XLSX_PATH = './annotation_status.xlsx'
+
+
+class StatusIndex:
+    """ Status of the images, indexed by the file name of the image.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS status ("
+                                     "file_name TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                                     "comment TEXT, updated REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS status_index ON status (status)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM status").fetchone()[0]
+
+    def __contains__(self, file_name):
+        return self.get_status(file_name) is not None
+
+    def get_status(self, file_name):
+        row = self._connection.execute("SELECT status FROM status WHERE file_name = ?", (file_name,)).fetchone()
+        return None if row is None else row[0]
+
+    def names(self, *statuses):
+        """ Get the set of file names with one of the statuses, or of all files if no status is given.
+        """
+        _check_statuses(statuses)
+        if statuses:
+            query = "SELECT file_name FROM status WHERE status IN (%s)" % ', '.join('?' * len(statuses))
+            rows = self._connection.execute(query, statuses)
+        else:
+            rows = self._connection.execute("SELECT file_name FROM status")
+        return {row[0] for row in rows}
+
+    def add(self, file_names, status='new'):
+        """ Add the files with the given status, files that are in the index already are not changed.
+
+        Returns the number of added files.
+        """
+        _check_statuses([status])
+        now = time.time()
+        with self._connection:
+            cursor = self._connection.executemany(
+                "INSERT OR IGNORE INTO status (file_name, status, updated) VALUES (?, ?, ?)",
+                [(file_name, status, now) for file_name in file_names]
+            )
+        return cursor.rowcount
+
+    def set_status(self, file_name, status, comment=None, force=False):
+        """ Change the status of the file, raises ValueError if the transition is not allowed.
+        """
+        _check_statuses([status])
+        current = self.get_status(file_name)
+        if current is None:
+            raise ValueError(f"{file_name} is not in the index")
+        if not force and status not in TRANSITIONS[current]:
+            raise ValueError(f"Invalid status transition for {file_name}: {current} -> {status}")
+        with self._connection:
+            self._connection.execute("UPDATE status SET status = ?, comment = ?, updated = ? WHERE file_name = ?",
+                                     (status, comment, time.time(), file_name))
+
+    def import_xlsx(self, xlsx_path=DEFAULT_XLSX_PATH):
+        """ Import the statuses from the xlsx table, overriding the statuses in the index.
+
+        The original status is kept as comment.
+        """
+        import pandas as pd
+        table = pd.read_excel(xlsx_path)
+        rows = []
+        for file_name, xlsx_status in zip(table['FileName'].values, table['Status'].values):
+            xlsx_status = str(xlsx_status)
+            if xlsx_status not in XLSX_STATUSES:
+                raise ValueError(f"Unknown status {xlsx_status} for {file_name}")
+            rows.append((file_name, XLSX_STATUSES[xlsx_status], xlsx_status, time.time()))
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO status (file_name, status, comment, updated) "
+                                         "VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def counts(self):
+        rows = self._connection.execute("SELECT status, COUNT(*) FROM status GROUP BY status")
+        return dict(rows.fetchall())
+
+
+def _check_statuses(statuses):
+    invalid = set(statuses) - set(STATUSES)
+    if invalid:
+        raise ValueError(f"Invalid statuses {invalid}, expected one of {STATUSES}")
+
+
+def load_status_index(path=DEFAULT_INDEX_PATH, xlsx_path=DEFAULT_XLSX_PATH):
+    """ Open the status index, it is initialized from the xlsx table if it does not exist yet.
+    """
+    initialize = not os.path.exists(path) and xlsx_path is not None and os.path.exists(xlsx_path)
+    index = StatusIndex(path)
+    if initialize:
+        index.import_xlsx(xlsx_path)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or change the annotation status of the images")
+    parser.add_argument('--index_path', type=str, default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--import_xlsx', type=str, default=None,
+                        help="import the statuses from this xlsx table")
+    parser.add_argument('--set_status', type=str, nargs=2, default=None, metavar=('FILE_NAME', 'STATUS'))
+    parser.add_argument('--force', type=int, default=0, help="allow all status transitions")
+    args = parser.parse_args()
+
+    with StatusIndex(args.index_path) as index:
+        if args.import_xlsx is not None:
+            print("Imported", index.import_xlsx(args.import_xlsx), "statuses from", args.import_xlsx)
+        if args.set_status is not None:
+            index.set_status(*args.set_status, force=bool(args.force))
+        print("Number of images per status:", index.counts())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Sync files from S3 compatible object storage, e.g. the uploaded annotations.
+
+The objects are downloaded concurrently and objects that have already been synced
+are skipped based on their size and ETag. Interrupted downloads are resumed.
+S3Storage requires boto3, LocalStorage implements the same interface
+on top of a local folder and is used for testing.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+ObjectInfo = namedtuple('ObjectInfo', ['size', 'etag'])
+
+BLOCK_SIZE = 2 ** 20
+# the etags of the synced objects are stored in this file in the output folder
+STATE_NAME = '.sync-state.json'
+PART_SUFFIX = '.part'
+
+
+class ObjectChangedError(Exception):
+    pass
+
+
+def get_md5(path, block_size=BLOCK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class S3Storage:
+    """ Objects in a S3 bucket under prefix, accessed via a pooled boto3 client.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None, n_connections=8, **client_kwargs):
+        import boto3
+        from botocore.config import Config
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix else ''
+        # the client is thread-safe and shares a pool of n_connections connections
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   config=Config(max_pool_connections=n_connections),
+                                   **client_kwargs)
+
+    def list(self, prefix=''):
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key'][len(self.prefix):]
+                objects[key] = ObjectInfo(obj['Size'], obj['ETag'].strip('"'))
+        return objects
+
+    def read(self, key, start=0, etag=None):
+        """ Iterate over the blocks of the object, starting at the byte offset start.
+
+        Raises ObjectChangedError if etag is given and does not match the object.
+        """
+        from botocore.exceptions import ClientError
+        kwargs = {} if etag is None else {'IfMatch': etag}
+        if start > 0:
+            kwargs['Range'] = f'bytes={start}-'
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                raise ObjectChangedError(key)
+            raise
+        yield from response['Body'].iter_chunks(BLOCK_SIZE)
+
+
+class LocalStorage:
+    """ Files in a local folder, with the same interface as S3Storage.
+
+    The ETags are the md5 checksums of the files, like for objects that were uploaded in one part.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, prefix=''):
+        objects = {}
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    objects[key] = ObjectInfo(os.path.getsize(path), get_md5(path))
+        return objects
+
+    def read(self, key, start=0, etag=None):
+        path = os.path.join(self.root, key)
+        if etag is not None and get_md5(path) != etag:
+            raise ObjectChangedError(key)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            yield from iter(lambda: f.read(BLOCK_SIZE), b'')
+
+
+def _load_state(out_root):
+    path = os.path.join(out_root, STATE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(out_root, state):
+    path = os.path.join(out_root, STATE_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def is_synced(out_path, info, synced_etag=None):
+    """ Check if the local file is the same as the object, based on the size and ETag.
+
+    If the ETag was not recorded when syncing the file, we compare it with the md5 checksum;
+    this only works for objects that were uploaded in one part.
+    """
+    if not os.path.exists(out_path) or os.path.getsize(out_path) != info.size:
+        return False
+    if synced_etag is not None:
+        return synced_etag == info.etag
+    return '-' not in info.etag and get_md5(out_path) == info.etag
+
+
+def download(storage, key, info, out_path):
+    """ Download the object to out_path, resuming a previous download if possible.
+
+    The data is written to out_path + PART_SUFFIX first, together with the ETag of the object,
+    so that we only resume if the object has not changed.
+    """
+    part_path, etag_path = out_path + PART_SUFFIX, out_path + PART_SUFFIX + '.etag'
+    start = 0
+    if os.path.exists(part_path) and os.path.exists(etag_path):
+        with open(etag_path) as f:
+            part_etag = f.read()
+        if part_etag == info.etag and os.path.getsize(part_path) <= info.size:
+            start = os.path.getsize(part_path)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(etag_path, 'w') as f:
+        f.write(info.etag)
+    with open(part_path, 'ab' if start > 0 else 'wb') as f:
+        for block in storage.read(key, start=start, etag=info.etag):
+            f.write(block)
+
+    if os.path.getsize(part_path) != info.size:
+        raise RuntimeError(f"Incomplete download of {key}")
+    os.replace(part_path, out_path)
+    os.remove(etag_path)
+
+
+def sync(storage, out_root, keys=None, prefix='', n_workers=8):
+    """ Download the objects under prefix (or only the objects in keys) to out_root.
+
+    Objects that have been synced already are skipped. Returns the downloaded keys.
+    """
+    objects = storage.list(prefix)
+    if keys is not None:
+        objects = {key: objects[key] for key in keys}
+
+    os.makedirs(out_root, exist_ok=True)
+    state = _load_state(out_root)
+    to_sync = [key for key, info in objects.items()
+               if not is_synced(os.path.join(out_root, key), info, state.get(key))]
+
+    lock = threading.Lock()
+
+    def _sync(key):
+        info = objects[key]
+        download(storage, key, info, os.path.join(out_root, key))
+        with lock:
+            state[key] = info.etag
+
+    # we save the state even if some downloads fail, so that the others are not repeated
+    try:
+        with ThreadPoolExecutor(n_workers) as pool:
+            for future in [pool.submit(_sync, key) for key in to_sync]:
+                future.result()
+    finally:
+        _save_state(out_root, state)
+    return to_sync
@@ -0,0 +1,99 @@
+"""
+Headless validation of the uploaded annotations.
+
+The annotation files are validated in parallel and summarized in a table
+with one row per file, see check_uploads.py.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .image_utils import MAX_DENSE_LUT_SIZE, get_seg_ids, map_values
+from .io_utils import has_table, open_file, read_columns, read_image
+
+# we only support labels [0, 1, 2, 3] = ['unlabeled', 'infected', 'control', 'uncertain']
+LABEL_NAMES = ('unlabeled', 'infected', 'control', 'uncertain')
+# value of the unlabeled cells in the label mask, to distinguish them from the background
+UNLABELED_MASK_VALUE = 4
+
+
+def get_label_mask(seg, seg_ids, infected_labels):
+    """ Map the segmentation to the infected labels, with unlabeled cells mapped to UNLABELED_MASK_VALUE.
+
+    Ids of the segmentation that are not in seg_ids, e.g. if the annotations don't match
+    the segmentation, are mapped to 0.
+    """
+    mask_values = np.where(infected_labels == 0, UNLABELED_MASK_VALUE, infected_labels).astype('uint8')
+    mask_values[seg_ids == 0] = 0
+    # the ids in the table are not necessarily sorted if they don't match the segmentation
+    order = np.argsort(seg_ids, kind='stable')
+    seg_ids, mask_values = seg_ids[order], mask_values[order]
+    if seg.size == 0 or len(seg_ids) == 0:
+        return np.zeros(seg.shape, dtype='uint8')
+
+    # add all ids of the segmentation to the keys, so that we can map them with map_values
+    max_id = max(int(seg.max()), int(seg_ids[-1]))
+    if max_id < MAX_DENSE_LUT_SIZE:
+        keys = np.arange(max_id + 1, dtype=seg.dtype)
+    else:
+        keys = np.union1d(seg_ids, np.unique(seg))
+    values = np.zeros(len(keys), dtype='uint8')
+    values[np.searchsorted(keys, seg_ids)] = mask_values
+    return map_values(seg, keys, values)
+
+
+def validate_annotations(path, infected_label_name='infected_cell_labels'):
+    """ Validate the annotations in path and return a summary of the infected labels.
+    """
+    summary = {'file_name': os.path.basename(path), 'has_labels': False, 'ids_match': False,
+               'unexpected_labels': '', 'n_cells': 0, 'error': ''}
+    for name in LABEL_NAMES:
+        summary[f'n_{name}'] = 0
+        summary[f'frac_{name}'] = 0.
+
+    try:
+        with open_file(path, 'r') as f:
+            seg = read_image(f, 'cell_segmentation')
+            if has_table(f, infected_label_name):
+                _, (label_ids, infected_labels) = read_columns(f, infected_label_name)
+                summary['has_labels'] = True
+
+        seg_ids = get_seg_ids(seg)
+        summary['n_cells'] = int((seg_ids != 0).sum())
+        if not summary['has_labels']:
+            return summary
+
+        summary['ids_match'] = bool(np.array_equal(label_ids, seg_ids))
+        unexpected = np.setdiff1d(infected_labels, np.arange(len(LABEL_NAMES)))
+        summary['unexpected_labels'] = ' '.join(str(label) for label in unexpected)
+
+        # the counts and fractions are computed for the foreground cells
+        cell_labels = infected_labels[label_ids != 0]
+        counts = np.bincount(cell_labels[(cell_labels >= 0) & (cell_labels < len(LABEL_NAMES))],
+                             minlength=len(LABEL_NAMES))
+        for name, count in zip(LABEL_NAMES, counts):
+            summary[f'n_{name}'] = int(count)
+            summary[f'frac_{name}'] = float(count) / max(len(cell_labels), 1)
+    except Exception as e:
+        summary['error'] = f"{type(e).__name__}: {e}"
+
+    return summary
+
+
+def validate_files(paths, n_workers=None):
+    """ Validate the annotation files in parallel and return the summary table.
+    """
+    if len(paths) == 0:
+        return pd.DataFrame()
+    if n_workers == 1:
+        summaries = [validate_annotations(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(n_workers) as pool:
+            summaries = list(pool.map(validate_annotations, paths))
+
+    summary = pd.DataFrame(summaries)
+    summary['valid'] = (summary['has_labels'] & summary['ids_match'] &
+                        (summary['unexpected_labels'] == '') & (summary['error'] == ''))
+    return summary
@@ -1,8 +1,9 @@
 import argparse
 import os
-import pandas as pd
 
-from napari_covid_if_annotations.launcher.covid_if_annotations import launch_covid_if_annotation_tool
+from napari_covid_if_annotations.launcher.covid_if_annotations import (launch_covid_if_annotation_tool,
+                                                                       launch_proofreading_session)
+from napari_covid_if_annotations.status import load_status_index
 
 
 def proofread(data_path, annotation_path):
@@ -11,18 +12,28 @@ def proofread(data_path, annotation_path):
     launch_covid_if_annotation_tool(data_path, annotation_path)
 
 
-def proofread_annotations(table_path, data_root, annotation_root):
-    table = pd.read_excel(table_path)
-    names = table['FileName'].values
-    status = table['Status'].values
+def proofread_annotations(index_path, data_root, annotation_root, session=False, n_prefetch=2):
+    with load_status_index(index_path) as index:
+        names = sorted(index.names('second_pass'))
 
-    for name, stat in zip(names, status):
+    file_pairs = []
+    for name in names:
         data_path = os.path.join(data_root, name)
         annotation_path = os.path.join(annotation_root,
                                        name.replace('.h5', '_annotations.h5'))
-        if stat == 'second_pass':
-            print("Proofread:", name)
-            proofread(data_path, annotation_path)
+        file_pairs.append((data_path, annotation_path))
+
+    # proofread all files in one viewer and load the next files in the background
+    if session:
+        for data_path, annotation_path in file_pairs:
+            assert os.path.exists(data_path), data_path
+            assert os.path.exists(annotation_path), annotation_path
+        launch_proofreading_session(file_pairs, n_prefetch=n_prefetch)
+        return
+
+    for data_path, annotation_path in file_pairs:
+        print("Proofread:", os.path.split(data_path)[1])
+        proofread(data_path, annotation_path)
 
 
 if __name__ == '__main__':
@@ -34,6 +45,10 @@ if __name__ == '__main__':
     annotation_root = '/home/pape/Work/data/covid/ground-truth/embl-annotations'
     parser.add_argument('--annotation_root', default=annotation_root)
 
-    table_path = './annotation_status.xlsx'
+    parser.add_argument('--session', type=int, default=0)
+    parser.add_argument('--n_prefetch', type=int, default=2)
+
+    parser.add_argument('--index_path', default='./annotation_status.sqlite')
     args = parser.parse_args()
-    proofread_annotations(table_path, args.data_root, args.annotation_root)
+    proofread_annotations(args.index_path, args.data_root, args.annotation_root,
+                          bool(args.session), args.n_prefetch)
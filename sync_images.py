@@ -1,42 +1,114 @@
 import argparse
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
 import numpy as np
 import imageio
-from skimage.transform import downscale_local_mean
 
+from napari_covid_if_annotations.cache import get_file_hash
+from napari_covid_if_annotations.image_utils import downscale_image
+from napari_covid_if_annotations.io_utils import H5_EXTS, open_file, read_image
+from napari_covid_if_annotations.layers import get_raw_data
 
-def copy_image(in_path, out_path):
-    im = imageio.imread(in_path)
+# stores the modification time, size and hash of the input files for which thumbnails were made
+STATE_NAME = '.thumbnail-state.json'
 
-    scaled = []
-    for channel_id in range(im.shape[-1]):
-        channel = downscale_local_mean(im[..., channel_id], (2, 2))
-        scaled.append(channel[..., None])
-    im = np.concatenate(scaled, axis=-1)
 
-    imageio.imwrite(out_path, im)
+def copy_image(in_path, out_path, factor=2):
+    im = np.asarray(imageio.imread(in_path))
+    # downscale all channels at once
+    imageio.imwrite(out_path, downscale_image(im, factor=factor, n_axes=2))
 
 
-def sync_images(out_folder):
-    input_files = glob('./img/*.png')
-    input_names = [os.path.split(path)[1] for path in input_files]
+def copy_composite(in_path, out_path, factor=2, saturation_factor=1.):
+    """ Make the thumbnail from the rgb composite of the raw data channels in a h5 file.
+    """
+    with open_file(in_path, 'r') as f:
+        seg = read_image(f, 'cell_segmentation')
+        raw, _ = get_raw_data(f, seg, saturation_factor)
+    if isinstance(raw, list):
+        raw = raw[0]
+    raw = np.round(255 * np.clip(raw, 0, 1)).astype('uint8')
+    imageio.imwrite(out_path, downscale_image(raw, factor=factor, n_axes=2))
 
-    existing_files = glob(os.path.join(out_folder, '*.png'))
-    existing_names = [os.path.split(path)[1] for path in existing_files]
 
-    to_copy = list(set(input_names) - set(existing_names))
+def make_thumbnail(in_path, out_path, factor=2):
+    if os.path.splitext(in_path)[1].lower() in H5_EXTS:
+        copy_composite(in_path, out_path, factor)
+    else:
+        copy_image(in_path, out_path, factor)
+    return get_file_hash(in_path)
 
-    for name in to_copy:
-        in_path = os.path.join('./img', name)
-        out_path = os.path.join(out_folder, name)
-        copy_image(in_path, out_path)
+
+def get_thumbnail_name(in_path):
+    return os.path.splitext(os.path.split(in_path)[1])[0] + '.png'
+
+
+def is_unchanged(in_path, out_path, record):
+    """ Check if the thumbnail is up to date, based on the modification time and size or the hash of the input.
+    """
+    if record is None or not os.path.exists(out_path):
+        return False
+    stat = os.stat(in_path)
+    if (stat.st_mtime_ns, stat.st_size) == (record['mtime'], record['size']):
+        return True
+    # the file might have been touched or copied without changing it
+    if stat.st_size == record['size'] and get_file_hash(in_path) == record['hash']:
+        record['mtime'] = stat.st_mtime_ns
+        return True
+    return False
+
+
+def sync_images(out_folder, in_folder='./img', n_workers=None, factor=2, force=False):
+    input_files = glob(os.path.join(in_folder, '*.png'))
+    input_files += [path for ext in H5_EXTS for path in glob(os.path.join(in_folder, '*' + ext))]
+    input_files.sort()
+
+    # images with the same name but different extensions, e.g. x.png and x.h5, would have the same thumbnail
+    thumbnail_names = {}
+    for in_path in input_files:
+        name = get_thumbnail_name(in_path)
+        if name in thumbnail_names:
+            raise ValueError(f"{thumbnail_names[name]} and {in_path} have the same thumbnail name {name}")
+        thumbnail_names[name] = in_path
+
+    os.makedirs(out_folder, exist_ok=True)
+    state_path = os.path.join(out_folder, STATE_NAME)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    to_copy = []
+    for in_path in input_files:
+        name = os.path.split(in_path)[1]
+        out_path = os.path.join(out_folder, get_thumbnail_name(in_path))
+        if force or not is_unchanged(in_path, out_path, state.get(name)):
+            to_copy.append((in_path, out_path))
+
+    stats = [os.stat(in_path) for in_path, _ in to_copy]
+    with ProcessPoolExecutor(n_workers) as pool:
+        hashes = pool.map(make_thumbnail, *zip(*to_copy), [factor] * len(to_copy)) if to_copy else []
+        for (in_path, _), stat, file_hash in zip(to_copy, stats, hashes):
+            state[os.path.split(in_path)[1]] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                                                'hash': file_hash}
+
+    with open(state_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    print("Made", len(to_copy), "thumbnails for", len(input_files), "images")
+    return [out_path for _, out_path in to_copy]
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     default_out = '../embl-annotation-service/images/static/images/img'
     parser.add_argument('--out_folder', type=str, default=default_out)
+    parser.add_argument('--in_folder', type=str, default='./img',
+                        help="folder with png images or h5 files, for which the raw composite is used")
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--factor', type=int, default=2)
+    parser.add_argument('--force', action='store_true', help="make all thumbnails, also if they are up to date")
     args = parser.parse_args()
-    sync_images(args.out_folder)
+    sync_images(args.out_folder, args.in_folder, args.n_workers, args.factor, args.force)